@@ -0,0 +1,362 @@
+"""Replay benchmark for the Python model workers.
+
+Drives model_loader.py (analysis) or translation-service/model_loader.py over
+their stdin/stdout protocol and prints a JSON report with startup time,
+throughput, latency percentiles and peak RSS, so branches and inference
+backends can be compared on the same workload.
+
+Examples:
+    # Protocol and clustering overhead only, no weights needed
+    python benchmarks/bench_workers.py --worker analysis --workload trending --stub
+
+    # Real models, four answers in flight, replayed from a file
+    python benchmarks/bench_workers.py --worker analysis --replay answers.jsonl --concurrency 4
+
+    # Save a synthetic workload so another branch can replay the exact same requests
+    python benchmarks/bench_workers.py --worker translation --workload translate --write-replay translate.jsonl
+
+    # Cold vs warm latency of the first requests after ready, without and with MODEL_WARMUP
+    python benchmarks/bench_workers.py --worker analysis --compare-warmup --env MODEL_PRELOAD=answer,sentiment
+    python benchmarks/bench_workers.py --worker translation --compare-warmup --env MODEL_COMPILE=1
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_SCRIPTS = {
+    'analysis': os.path.join(REPO_ROOT, 'model_loader.py'),
+    'translation': os.path.join(REPO_ROOT, 'translation-service', 'model_loader.py')
+}
+WORKLOADS = {
+    'analysis': ('answer', 'trending', 'mixed'),
+    'translation': ('translate', 'translate_batch')
+}
+
+QUESTIONS = [
+    'How was your experience?',
+    'What should we improve?',
+    'Would you recommend us to a friend?'
+]
+PHRASES = [
+    'the app is fast and easy to use',
+    'the login page keeps crashing on my phone',
+    'support answered quickly and solved my problem',
+    'the pricing page is confusing',
+    'please add dark mode',
+    'notifications arrive late',
+    'exporting to csv is slow',
+    'i love the new dashboard',
+    'the free plan is too limited',
+    'search does not find older surveys'
+]
+ASK = [
+    'What do users complain about most?',
+    'What do users like about the product?',
+    'Which features are requested?'
+]
+SURVEY_TEXTS = [
+    'Yes',
+    'No',
+    'How satisfied are you with our service?',
+    'Very satisfied',
+    'Please describe what we could improve in the checkout process.',
+    'Would you recommend us to a friend or colleague?'
+]
+
+def synthetic_answer_text(rng, answer_words):
+    """Build a free-text answer of roughly answer_words words from repeated phrases"""
+    words = []
+    while len(words) < answer_words:
+        words.extend(rng.choice(PHRASES).split())
+        words[-1] += '.'
+    return ' '.join(words[:answer_words])
+
+def synthetic_requests(worker, workload, count, feedback_counts, answer_words, lang_pairs, seed):
+    """Generate benchmark requests in the worker protocol"""
+    rng = random.Random(seed)
+    for index in range(count):
+        feedback_count = rng.choice(feedback_counts)
+        if worker == 'analysis':
+            action = workload if workload != 'mixed' else rng.choice(('answer', 'trending'))
+            if action == 'answer':
+                yield {
+                    'action': 'answer',
+                    'question': rng.choice(ASK),
+                    'feedbacks': [
+                        {'questions': [
+                            {'question': question, 'answer': synthetic_answer_text(rng, answer_words)}
+                            for question in QUESTIONS
+                        ]}
+                        for _ in range(feedback_count)
+                    ]
+                }
+            else:
+                yield {
+                    'action': 'extract_trending_sentences',
+                    'feedbacks': {
+                        str(number): {
+                            'question': rng.choice(QUESTIONS),
+                            'answer': synthetic_answer_text(rng, answer_words)
+                        }
+                        for number in range(feedback_count)
+                    }
+                }
+        else:
+            source_lang, target_lang = rng.choice(lang_pairs)
+            if workload == 'translate':
+                yield {
+                    'text': rng.choice(SURVEY_TEXTS + [synthetic_answer_text(rng, answer_words)]),
+                    'source_lang': source_lang,
+                    'target_lang': target_lang
+                }
+            else:
+                yield {
+                    'action': 'translate_batch',
+                    'items': [
+                        {
+                            'text': rng.choice(SURVEY_TEXTS + [synthetic_answer_text(rng, answer_words)]),
+                            'source_lang': source_lang,
+                            'target_lang': target_lang
+                        }
+                        for _ in range(feedback_count)
+                    ]
+                }
+
+def read_replay(path):
+    with open(path) as replay_file:
+        for line in replay_file:
+            if line.strip():
+                yield json.loads(line)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def process_tree_peak_rss(pid):
+    """Sum of peak RSS (VmHWM) over a process and its children, shared pages count once per process"""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as status_file:
+                for line in status_file:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as children_file:
+                    pids.extend(int(child) for child in children_file.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+class WorkerDriver:
+    """Runs one worker process and matches its responses to requests by ID"""
+
+    def __init__(self, worker, env):
+        self.worker = worker
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.latencies = []
+        self.latency_by_id = {}
+        self.errors = 0
+        self.done = threading.Condition(self.lock)
+        self.start_time = time.perf_counter()
+        script = WORKER_SCRIPTS[worker]
+        self.process = subprocess.Popen(
+            [sys.executable, script],
+            cwd=os.path.dirname(script),
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        threading.Thread(target=self.read_stdout, daemon=True).start()
+        threading.Thread(target=self.read_stderr, daemon=True).start()
+
+    def read_stdout(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if response.get('status') == 'ready' and 'id' not in response:
+                self.mark_ready()
+                continue
+            received = time.perf_counter()
+            with self.lock:
+                sent = self.sent.pop(response.get('id'), None)
+                if sent is None:
+                    continue
+                self.latencies.append(received - sent)
+                self.latency_by_id[response.get('id')] = received - sent
+                if 'error' in response:
+                    self.errors += 1
+                self.done.notify_all()
+
+    def read_stderr(self):
+        for line in self.process.stderr:
+            # The translation worker only announces readiness on stderr
+            if 'Translation service ready' in line:
+                self.mark_ready()
+
+    def mark_ready(self):
+        if not self.ready.is_set():
+            self.startup_seconds = time.perf_counter() - self.start_time
+            self.ready.set()
+
+    def send(self, request_id, request):
+        request = {**request, 'id': request_id}
+        with self.lock:
+            self.sent[request_id] = time.perf_counter()
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+
+    def wait_in_flight(self, limit):
+        """Block until fewer than limit requests are outstanding"""
+        with self.lock:
+            while len(self.sent) >= limit:
+                self.done.wait(timeout=1.0)
+                if self.process.poll() is not None:
+                    raise SystemExit(f"Worker exited with code {self.process.returncode}")
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'max': latencies[-1] if latencies else None
+    }
+
+def run_benchmark(args, extra_env=()):
+    env = dict(os.environ)
+    for assignment in list(args.env) + list(extra_env):
+        key, _, value = assignment.partition('=')
+        env[key] = value
+    if args.stub:
+        env['INFERENCE_BACKEND'] = 'stub'
+
+    if args.replay:
+        requests = list(read_replay(args.replay))
+    else:
+        requests = list(synthetic_requests(
+            args.worker,
+            args.workload or WORKLOADS[args.worker][0],
+            args.requests,
+            args.feedbacks,
+            args.answer_words,
+            [tuple(pair.split(':', 1)) for pair in args.lang_pairs],
+            args.seed
+        ))
+    if args.write_replay:
+        with open(args.write_replay, 'w') as replay_file:
+            for request in requests:
+                replay_file.write(json.dumps(request) + '\n')
+
+    driver = WorkerDriver(args.worker, env)
+    if not driver.ready.wait(args.startup_timeout):
+        driver.process.kill()
+        raise SystemExit(f"Worker did not become ready within {args.startup_timeout}s")
+
+    # Warm-up requests are sent first and left out of the measurements
+    for index, request in enumerate(requests[:args.warmup]):
+        driver.send(f'warmup-{index}', request)
+        driver.wait_in_flight(1)
+    with driver.lock:
+        driver.latencies.clear()
+        driver.latency_by_id.clear()
+        driver.errors = 0
+
+    start_time = time.perf_counter()
+    for index, request in enumerate(requests):
+        driver.wait_in_flight(args.concurrency)
+        driver.send(f'bench-{index}', request)
+    driver.wait_in_flight(1)
+    wall_seconds = time.perf_counter() - start_time
+
+    peak_rss = process_tree_peak_rss(driver.process.pid)
+    driver.close()
+
+    latencies = driver.latencies
+    # In send order, the first requests after ready are the ones a cold worker makes slow
+    ordered = [driver.latency_by_id[f'bench-{index}'] for index in range(len(requests)) if f'bench-{index}' in driver.latency_by_id]
+    return {
+        'worker': args.worker,
+        'workload': 'replay' if args.replay else (args.workload or WORKLOADS[args.worker][0]),
+        'backend': env.get('INFERENCE_BACKEND', 'pytorch'),
+        'env': list(args.env) + list(extra_env),
+        'requests': len(latencies),
+        'errors': driver.errors,
+        'concurrency': args.concurrency,
+        'startup_seconds': driver.startup_seconds,
+        'wall_seconds': wall_seconds,
+        'throughput_rps': len(latencies) / wall_seconds if wall_seconds else None,
+        'latency_seconds': latency_summary(latencies),
+        'first_request_seconds': ordered[0] if ordered else None,
+        'cold_latency_seconds': latency_summary(ordered[:args.cold_requests]),
+        'warm_latency_seconds': latency_summary(ordered[args.cold_requests:]),
+        'peak_rss_bytes': peak_rss
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the model workers over their stdin/stdout protocol")
+    parser.add_argument('--worker', choices=sorted(WORKER_SCRIPTS), default='analysis')
+    parser.add_argument('--workload', help="analysis: answer, trending or mixed; translation: translate or translate_batch")
+    parser.add_argument('--replay', help="JSONL file of requests to replay instead of a synthetic workload")
+    parser.add_argument('--write-replay', help="Save the requests that were sent to this JSONL file")
+    parser.add_argument('--requests', type=int, default=50, help="Number of synthetic requests")
+    parser.add_argument('--feedbacks', type=int, nargs='+', default=[10, 100],
+                        help="Feedback counts per request (or items per translation batch) to pick from")
+    parser.add_argument('--answer-words', type=int, default=30, help="Words per synthetic free-text answer")
+    parser.add_argument('--lang-pairs', nargs='+', default=['en:fr', 'en:he', 'en:es'],
+                        help="source:target language pairs for translation workloads")
+    parser.add_argument('--concurrency', type=int, default=1, help="Requests kept in flight at once")
+    parser.add_argument('--warmup', type=int, default=0, help="Requests to send before measuring")
+    parser.add_argument('--cold-requests', type=int, default=5,
+                        help="First measured requests reported as cold latency, the rest as warm")
+    parser.add_argument('--compare-warmup', action='store_true',
+                        help="Run twice, with MODEL_WARMUP=0 and MODEL_WARMUP=1, and report both")
+    parser.add_argument('--stub', action='store_true', help="Run the worker with INFERENCE_BACKEND=stub, no weights needed")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="Extra environment for the worker, e.g. WORKER_POOL_SIZE=4 (repeatable)")
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Also write the JSON report to this file")
+    args = parser.parse_args(argv)
+    if args.workload and args.workload not in WORKLOADS[args.worker]:
+        parser.error(f"--workload for {args.worker} must be one of {', '.join(WORKLOADS[args.worker])}")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.compare_warmup:
+        report = {
+            'without_warmup': run_benchmark(args, ['MODEL_WARMUP=0']),
+            'with_warmup': run_benchmark(args, ['MODEL_WARMUP=1'])
+        }
+    else:
+        report = run_benchmark(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
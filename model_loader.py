@@ -1,54 +1,235 @@
 import os
 import sys
+import gc
+import csv
 import json
+import math
+import time
+import hashlib
+import heapq
+import itertools
+import queue
+import pickle
+import signal
+import statistics
+import multiprocessing
+import threading
 import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, pipeline
-from collections import defaultdict
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, AutoModelForSequenceClassification, pipeline
+from collections import defaultdict, Counter, OrderedDict, deque
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from difflib import SequenceMatcher
 import re
+from worker_common import (
+    WORKER_POOL_SIZE, MAX_QUEUED_REQUESTS, METRICS_FILE,
+    INFERENCE_BACKEND, MODEL_OFFLINE, MODEL_DTYPE, MODEL_WARMUP, MODEL_COMPILE,
+    stats_lock, token_counts, timed_stage, log_event, onnx_model_path,
+    StubTokenizer, StubSeq2SeqModel, peak_rss_bytes,
+    pretrained_kwargs, model_kwargs, compile_model, warmup_text, warmup_batches, run_warmup,
+    WARMUP_GENERATE_LENGTH, ModelResidency, TwoTierCache, get_request_control, finish_request,
+    stopping_criteria, stream_generate, ResponseStream, wants_stream, parse_action_priorities, RequestQueue,
+    send_response, start_metrics_writer, collect_worker_stats, render_prometheus, read_requests,
+    start_heartbeat, serve_pool_requests, serve_with_pool, backend_argument_parser, timed_repeats,
+    profile_backends, agreement, similarity, check_framing
+)
 
 # Global variables to store the loaded models and tokenizers
 model = None
 tokenizer = None
 sentiment_classifier = None
 
-def load_model(cache_dir=None):
-    """Load the BART model for question answering and sentiment analysis"""
-    global model, tokenizer, sentiment_classifier
-    try:
-        if model is not None and tokenizer is not None and sentiment_classifier is not None:
-            print("Models already loaded", file=sys.stderr)
-            return model, tokenizer, sentiment_classifier
+ANSWER_MODEL_NAME = "facebook/bart-large-cnn"
+SENTIMENT_MODEL_NAME = "distilbert-base-uncased-finetuned-sst-2-english"
 
-        # Use environment variable for cache directory or default to ./models
-        cache_dir = cache_dir or os.getenv('TRANSFORMERS_CACHE', './models')
-        os.makedirs(cache_dir, exist_ok=True)
-        
-        print(f"Using cache directory: {cache_dir}", file=sys.stderr)
-        
-        # Load BART model and tokenizer
-        model_name = "facebook/bart-large-cnn"
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-            cache_dir=cache_dir,
-            local_files_only=False
-        )
-        
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            model_name,
-            cache_dir=cache_dir,
-            local_files_only=False
-        )
-        model.eval()
-        
-        # Load sentiment analysis model
-        sentiment_classifier = pipeline(
+# Models to load in the background right after signalling ready, e.g. "sentiment,answer".
+# Anything not listed loads on the first request that needs it. With MODEL_WARMUP the
+# preloaded models (all of them when MODEL_PRELOAD is empty) load before signalling ready
+MODEL_PRELOAD = os.getenv('MODEL_PRELOAD', '')
+# Token lengths run through each model after it loads when MODEL_WARMUP is set
+MODEL_WARMUP_LENGTHS = os.getenv('MODEL_WARMUP_LENGTHS', '32,256,1024')
+
+# Fast tokenizers can't be used from two threads at once
+tokenizer_lock = threading.Lock()
+sentiment_lock = threading.Lock()
+
+# Number of sentences scored per sentiment forward pass
+SENTIMENT_BATCH_SIZE = int(os.getenv('SENTIMENT_BATCH_SIZE', '32'))
+
+# Character n-gram size used to shortlist similar sentences
+SIMILARITY_NGRAM_SIZE = 3
+# Lowest sequence ratio are_sentences_similar can ever accept
+SIMILARITY_FLOOR = 0.6
+
+# Surveys whose trending state is kept between requests, least recently used ones are dropped
+TRENDING_STATE_SURVEYS = int(os.getenv('TRENDING_STATE_SURVEYS', '64'))
+TRENDING_TOP_SENTENCES = 10
+# Sentences a compact (bulk) trending state remembers the group of, older ones are looked up again
+TRENDING_MATCH_MEMO_SIZE = int(os.getenv('TRENDING_MATCH_MEMO_SIZE', '100000'))
+
+# How many requests of each action may run at the same time, e.g. "extract_trending_sentences=2".
+# Answers are not limited here, they go through the AnswerBatcher instead, except streamed
+# answers which run under "answer_stream"
+ACTION_CONCURRENCY = os.getenv('ACTION_CONCURRENCY', 'extract_trending_sentences=1')
+DEFAULT_ACTION_CONCURRENCY = 1
+# Admission control priorities by action, lower ones start first (see worker_common.RequestQueue)
+ACTION_PRIORITIES = os.getenv('ACTION_PRIORITIES', 'answer=0,stats=0,extract_trending_sentences=1')
+
+# BART input size and generation settings for answers
+MAX_INPUT_TOKENS = 1024
+ANSWER_GENERATION_KWARGS = {
+    'max_length': 150,
+    'num_beams': 4,
+    'length_penalty': 2.0,
+    'early_stopping': True
+}
+# Streamed answers decode greedily, transformers streamers don't support beam search
+ANSWER_STREAM_GENERATION_KWARGS = {
+    'max_length': 150,
+    'num_beams': 1
+}
+
+# Context retrieval: BM25 indexes over the Q/A parts of recently seen feedback sets
+CONTEXT_INDEX_CACHE_SIZE = int(os.getenv('CONTEXT_INDEX_CACHE_SIZE', '32'))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Answer cache: in-process LRU entries (0 disables the cache), an optional SQLite file
+# and the most rows it keeps (0 for no limit)
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_PATH = os.getenv('ANSWER_CACHE_PATH')
+ANSWER_CACHE_DISK_ENTRIES = int(os.getenv('ANSWER_CACHE_DISK_ENTRIES', '100000'))
+
+# Answer micro-batching: how long to wait for more requests and how big a batch may get
+ANSWER_BATCH_WINDOW_MS = float(os.getenv('ANSWER_BATCH_WINDOW_MS', '20'))
+ANSWER_MAX_BATCH_SIZE = int(os.getenv('ANSWER_MAX_BATCH_SIZE', '4'))
+ANSWER_MAX_BATCH_TOKENS = int(os.getenv('ANSWER_MAX_BATCH_TOKENS', '4096'))  # batch size x longest input
+
+# Echoed answer context: "full" sends the context text, "hash" only its SHA-256 and length,
+# "none" leaves it out. Requests can pick one with "context_mode"
+RESPONSE_CONTEXT = os.getenv('RESPONSE_CONTEXT', 'full')
+CONTEXT_MODES = ('full', 'hash', 'none')
+
+queue_depth = Counter()  # requests waiting to start, by action
+
+def track_queued(action, delta):
+    with stats_lock:
+        queue_depth[action] += delta
+
+def stub_sentiment_classifier(texts, **kwargs):
+    """Keyword based stand-in for the sentiment pipeline, for INFERENCE_BACKEND=stub"""
+    negative_words = {'not', 'no', 'bad', 'slow', 'crash', 'crashes', 'broken', 'confusing', 'late', 'hate'}
+    if isinstance(texts, str):
+        texts = [texts]
+    results = []
+    for text in texts:
+        negative = bool(negative_words.intersection(text.lower().split()))
+        results.append({'label': 'NEGATIVE' if negative else 'POSITIVE', 'score': 0.95})
+    return results
+
+def load_answer_model(cache_dir, backend):
+    """Load the BART tokenizer and model for the given inference backend"""
+    if backend == 'stub':
+        return StubTokenizer(), StubSeq2SeqModel()
+    if backend == 'onnx':
+        # Optional dependency, only needed for the ONNX Runtime backend
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        model_path = onnx_model_path(ANSWER_MODEL_NAME, cache_dir)
+        return AutoTokenizer.from_pretrained(model_path), ORTModelForSeq2SeqLM.from_pretrained(model_path)
+
+    answer_tokenizer = AutoTokenizer.from_pretrained(ANSWER_MODEL_NAME, **pretrained_kwargs(cache_dir))
+    answer_model = AutoModelForSeq2SeqLM.from_pretrained(ANSWER_MODEL_NAME, **model_kwargs(cache_dir, backend))
+    answer_model.eval()
+    if backend == 'int8':
+        answer_model = torch.quantization.quantize_dynamic(answer_model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif MODEL_COMPILE:
+        answer_model = compile_model(answer_model)
+    return answer_tokenizer, answer_model
+
+def load_sentiment_classifier(cache_dir, backend):
+    """Load the sentiment analysis pipeline for the given inference backend"""
+    if backend == 'stub':
+        return stub_sentiment_classifier
+    if backend == 'onnx':
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        model_path = onnx_model_path(SENTIMENT_MODEL_NAME, cache_dir)
+        return pipeline(
             "sentiment-analysis",
-            model="distilbert-base-uncased-finetuned-sst-2-english",
-            cache_dir=cache_dir
+            model=ORTModelForSequenceClassification.from_pretrained(model_path),
+            tokenizer=AutoTokenizer.from_pretrained(model_path)
         )
-        
+
+    # Always float32, older pipelines can't postprocess bfloat16 logits
+    classifier_model = AutoModelForSequenceClassification.from_pretrained(SENTIMENT_MODEL_NAME, **model_kwargs(cache_dir))
+    classifier_model.eval()
+    if backend == 'int8':
+        classifier_model = torch.quantization.quantize_dynamic(classifier_model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif MODEL_COMPILE:
+        classifier_model = compile_model(classifier_model)
+    return pipeline(
+        "sentiment-analysis",
+        model=classifier_model,
+        tokenizer=AutoTokenizer.from_pretrained(SENTIMENT_MODEL_NAME, **pretrained_kwargs(cache_dir))
+    )
+
+def load_named_model(name, cache_dir, backend):
+    """Load "answer" or "sentiment" into the module globals requests use, for the ModelResidency"""
+    global model, tokenizer, sentiment_classifier
+    if name == 'answer':
+        tokenizer, model = load_answer_model(cache_dir, backend)
+        return (tokenizer, model), model
+    sentiment_classifier = load_sentiment_classifier(cache_dir, backend)
+    return sentiment_classifier, getattr(sentiment_classifier, 'model', None)
+
+def drop_model(name):
+    """Clear the module globals of an unloaded model, so its weights can be freed"""
+    global model, tokenizer, sentiment_classifier
+    if name == 'answer':
+        model = tokenizer = None
+    else:
+        sentiment_classifier = None
+
+WARMUP_TEXT = "The app is fast and easy to use, but the login page keeps crashing on my phone."
+
+def warmup_model(name, loaded):
+    """Run representative input lengths and batch sizes through a freshly loaded model"""
+    def warm(lengths):
+        if name == 'answer':
+            answer_tokenizer, answer_model = loaded
+            with tokenizer_lock:
+                encoded = [
+                    answer_tokenizer(warmup_text(WARMUP_TEXT, length), max_length=length, truncation=True)['input_ids']
+                    for length in lengths
+                ]
+            for batch in warmup_batches(encoded, ANSWER_MAX_BATCH_SIZE):
+                with tokenizer_lock:
+                    inputs = answer_tokenizer.pad({'input_ids': batch}, return_tensors="pt")
+                answer_model.generate(**inputs, **{**ANSWER_GENERATION_KWARGS, 'max_length': WARMUP_GENERATE_LENGTH})
+        else:
+            for length in lengths:
+                with sentiment_lock:
+                    loaded([warmup_text(WARMUP_TEXT, length)] * SENTIMENT_BATCH_SIZE, batch_size=SENTIMENT_BATCH_SIZE, truncation=True)
+
+    run_warmup(name, MODEL_WARMUP_LENGTHS, MAX_INPUT_TOKENS, warm)
+
+# Both models load on first use, unload when idle and share MODEL_MEMORY_BUDGET_MB
+residency = ModelResidency(('answer', 'sentiment'), load_named_model, drop_model, warmup_model)
+
+def preload_models(names):
+    """Load models in the background so the first requests don't pay for it"""
+    for name in names:
+        try:
+            residency.ensure(name)
+        except Exception:
+            # Already reported, the next request needing the model retries the load
+            pass
+
+def load_model(cache_dir=None, backend=None):
+    """Load the BART model for question answering and sentiment analysis"""
+    try:
+        residency.ensure('answer', cache_dir, backend)
+        residency.ensure('sentiment', cache_dir, backend)
         print(f"Models loaded successfully", file=sys.stderr)
         return model, tokenizer, sentiment_classifier
         
@@ -58,9 +239,13 @@ def load_model(cache_dir=None):
 
 def format_context(feedbacks):
     """Format all feedback questions and answers into a single context string"""
+    return "\n\n".join(format_context_parts(feedbacks))
+
+def format_context_parts(feedbacks):
+    """Format each feedback question and answer as a separate context part"""
     try:
         if not feedbacks:
-            return ""
+            return []
             
         context_parts = []
         for feedback in feedbacks:
@@ -76,64 +261,483 @@ def format_context(feedbacks):
                 # Handle direct text feedback
                 context_parts.append(feedback)
                 
-        return "\n\n".join(context_parts)
+        return context_parts
     except Exception as e:
         print(f"Error formatting context: {str(e)}", file=sys.stderr)
-        return ""
+        return []
 
-def answer_question(context, question):
-    """Generate an answer for a question based on the given context"""
+def context_terms(text):
+    return re.findall(r'\w+', text.lower())
+
+class ContextIndex:
+    """BM25 index over the Q/A parts of one feedback set, with their token lengths"""
+
+    def __init__(self, parts, token_lengths):
+        self.parts = parts
+        self.token_lengths = token_lengths
+        self.postings = defaultdict(list)  # term -> [(part index, term frequency)]
+        self.part_lengths = []
+        for index, part in enumerate(parts):
+            term_freqs = Counter(context_terms(part))
+            self.part_lengths.append(sum(term_freqs.values()))
+            for term, freq in term_freqs.items():
+                self.postings[term].append((index, freq))
+        self.average_length = sum(self.part_lengths) / len(parts) if parts else 1.0
+        self.idf = {
+            term: math.log(1 + (len(parts) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def scores(self, question):
+        scores = [0.0] * len(self.parts)
+        for term in set(context_terms(question)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, freq in self.postings[term]:
+                length_norm = 1 - BM25_B + BM25_B * self.part_lengths[index] / max(self.average_length, 1e-9)
+                scores[index] += idf * freq * (BM25_K1 + 1) / (freq + BM25_K1 * length_norm)
+        return scores
+
+    def select(self, question, budget):
+        """Indices of the best scoring parts that fit in budget tokens, in survey order"""
+        if sum(self.token_lengths) <= budget:
+            return list(range(len(self.parts)))
+        scores = self.scores(question)
+        selected = []
+        used = 0
+        # Unmatched parts score 0 and fill whatever budget is left in survey order
+        for index in sorted(range(len(self.parts)), key=lambda index: -scores[index]):
+            if used + self.token_lengths[index] <= budget:
+                selected.append(index)
+                used += self.token_lengths[index]
+        return sorted(selected)
+
+context_index_cache = OrderedDict()  # feedback set hash -> ContextIndex
+context_index_lock = threading.Lock()
+context_index_stats = Counter()
+
+def get_context_index(feedbacks):
+    """Build the context index for a feedback set, or reuse it from a previous question"""
+    key = hashlib.sha256(json.dumps(feedbacks, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    with context_index_lock:
+        index = context_index_cache.get(key)
+        if index is not None:
+            context_index_cache.move_to_end(key)
+            context_index_stats['hits'] += 1
+            return index
+        context_index_stats['misses'] += 1
+
+    parts = format_context_parts(feedbacks)
+    token_lengths = []
+    if parts:
+        with residency.using('answer'), tokenizer_lock:
+            part_ids = tokenizer(parts, add_special_tokens=False)['input_ids']
+        # Two extra tokens per part for the blank line that joins them
+        token_lengths = [len(input_ids) + 2 for input_ids in part_ids]
+    index = ContextIndex(parts, token_lengths)
+
+    with context_index_lock:
+        context_index_cache[key] = index
+        while len(context_index_cache) > CONTEXT_INDEX_CACHE_SIZE:
+            context_index_cache.popitem(last=False)
+    return index
+
+def select_context(feedbacks, question, spans=None):
+    """Context made of the feedback parts most relevant to the question that fit the model input.
+
+    Replaces truncating the full context, which dropped the question itself
+    along with everything past the first MAX_INPUT_TOKENS tokens.
+    """
+    with timed_stage('retrieve', spans):
+        index = get_context_index(feedbacks)
+        if not index.parts or not question:
+            return "\n\n".join(index.parts)
+        with residency.using('answer'), tokenizer_lock:
+            prompt_tokens = len(tokenizer(f"Context: \nQuestion: {question}")['input_ids'])
+        selected = index.select(question, MAX_INPUT_TOKENS - prompt_tokens)
+        if spans is not None:
+            spans['context_parts'] = [len(selected), len(index.parts)]
+        return "\n\n".join(index.parts[i] for i in selected)
+
+class AnswerCache(TwoTierCache):
+    """Generated answers, in memory and optionally in a SQLite file.
+
+    Entries are keyed on the formatted context, the question, the model, the
+    inference backend, the weight precision and the generation settings, so a
+    changed feedback set or setting never serves a stale answer. Each entry keeps
+    the context the answer was generated from and when it was generated.
+    """
+
+    def __init__(self, path=None, max_entries=None, max_disk_entries=None):
+        super().__init__(
+            'Answer cache', 'answers', ('answer', 'context'), path,
+            ANSWER_CACHE_SIZE if max_entries is None else max_entries,
+            ANSWER_CACHE_DISK_ENTRIES if max_disk_entries is None else max_disk_entries
+        )
+
+    @staticmethod
+    def make_key(feedbacks, question):
+        return TwoTierCache.hash_key([
+            format_context(feedbacks),
+            ' '.join(question.split()),
+            ANSWER_MODEL_NAME,
+            INFERENCE_BACKEND,
+            MODEL_DTYPE,
+            MAX_INPUT_TOKENS,
+            ANSWER_GENERATION_KWARGS
+        ])
+
+    def get(self, key):
+        """Return (answer, context, created_at, tier) or None"""
+        return self.lookup(key)
+
+    def put(self, key, answer, context):
+        self.store(key, answer, context)
+
+answer_cache = None
+
+def open_answer_cache():
+    """Open the answer cache, each pool worker opens its own after the fork"""
+    global answer_cache
+    if ANSWER_CACHE_SIZE > 0:
+        answer_cache = AnswerCache(ANSWER_CACHE_PATH)
+
+def cached_answer_response(input_data, spans=None):
+    """Look a request up in the answer cache, returns (response or None, cache key)"""
+    question = input_data.get('question', '')
+    if not isinstance(question, str):
+        # Checked here, the first thing every answer request goes through
+        raise ValueError("question must be a string")
+    if answer_cache is None or not question:
+        return None, None
+    with timed_stage('cache_lookup', spans):
+        key = AnswerCache.make_key(input_data.get('feedbacks', {}), question)
+        cached = answer_cache.get(key)
+    if cached is None:
+        return None, key
+    answer, context, created_at, tier = cached
+    return {
+        'answer': answer,
+        'context': context,
+        'question': question,
+        'cache': {'status': 'hit', 'tier': tier, 'age_seconds': max(0.0, time.time() - created_at)}
+    }, key
+
+def tokenize_answer_input(context, question, spans=None):
+    """Tokenize the combined context and question, truncated to the model's input size"""
+    global tokenizer
+
+    # Prepare the input by combining context and question
+    input_text = f"Context: {context}\nQuestion: {question}"
+
+    # Tokenize with basic settings
+    with residency.using('answer'), timed_stage('tokenize', spans), tokenizer_lock:
+        return tokenizer(input_text, max_length=MAX_INPUT_TOKENS, truncation=True)['input_ids']
+
+def generate_answers(input_ids_batch, spans=None, controls=None):
+    """Generate answers for already tokenized inputs as one padded batch.
+
+    With request controls, generation stops early once all of them are
+    cancelled or past their deadline.
+    """
     global model, tokenizer
+    with residency.using('answer'):
+        with timed_stage('generate', spans):
+            with tokenizer_lock:
+                inputs = tokenizer.pad({'input_ids': input_ids_batch}, return_tensors="pt")
+
+            # Generate answers
+            with torch.no_grad():
+                outputs = model.generate(**inputs, stopping_criteria=stopping_criteria(controls), **ANSWER_GENERATION_KWARGS)
+
+        input_tokens = sum(len(input_ids) for input_ids in input_ids_batch)
+        output_tokens = int((outputs != tokenizer.pad_token_id).sum())
+        with stats_lock:
+            token_counts['input_tokens'] += input_tokens
+            token_counts['output_tokens'] += output_tokens
+        if spans is not None:
+            spans['input_tokens'] = input_tokens
+            spans['output_tokens'] = output_tokens
+
+        # Decode the answers
+        with timed_stage('decode', spans), tokenizer_lock:
+            return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+class LockedDecoder:
+    """Tokenizer stand-in for streamers, decodes under the tokenizer lock"""
+
+    def __init__(self, tokenizer, lock):
+        self.tokenizer = tokenizer
+        self.lock = lock
+
+    def decode(self, *args, **kwargs):
+        with self.lock:
+            return self.tokenizer.decode(*args, **kwargs)
+
+def stream_answer(context, question, stream, spans=None, control=None):
+    """Generate an answer while streaming it, returns (answer, failed)"""
     try:
         if not context or not question:
-            return "No context or question provided"
-            
-        # Prepare the input by combining context and question
-        input_text = f"Context: {context}\nQuestion: {question}"
-        
-        # Tokenize with basic settings
-        inputs = tokenizer(input_text, return_tensors="pt", max_length=1024, truncation=True)
-        
-        # Generate answer
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_length=150,
-                num_beams=4,
-                length_penalty=2.0,
-                early_stopping=True
-            )
-        
-        # Decode the answer
-        answer = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return answer
+            return "No context or question provided", False
+
+        input_ids = tokenize_answer_input(context, question, spans)
+        with residency.using('answer'):
+            with tokenizer_lock:
+                inputs = tokenizer.pad({'input_ids': [input_ids]}, return_tensors="pt")
+            with timed_stage('generate', spans):
+                answer = stream_generate(
+                    model,
+                    LockedDecoder(tokenizer, tokenizer_lock),
+                    {**inputs, 'stopping_criteria': stopping_criteria([control])},
+                    ANSWER_STREAM_GENERATION_KWARGS,
+                    stream.send_delta
+                )
+        return answer.strip(), False
+
+    except Exception as e:
+        print(f"Question answering error: {str(e)}", file=sys.stderr)
+        return "Error generating answer", True
+
+def answer_question(context, question, spans=None):
+    """Generate an answer for a question based on the given context"""
+    return answer_question_checked(context, question, spans)[0]
+
+def answer_question_checked(context, question, spans=None, control=None):
+    """Like answer_question, but also tells whether generation failed"""
+    try:
+        if not context or not question:
+            return "No context or question provided", False
+
+        input_ids = tokenize_answer_input(context, question, spans)
+        return generate_answers([input_ids], spans, [control])[0], False
         
     except Exception as e:
         print(f"Question answering error: {str(e)}", file=sys.stderr)
-        return "Error generating answer"
+        return "Error generating answer", True
+
+class AnswerBatcher:
+    """Groups answer requests arriving within a short window into one padded generate call.
+
+    A batch closes when the window expires, when it reaches max_batch_size, or
+    when the next request would push batch size x longest input past
+    max_batch_tokens; that request then opens the following batch. Batches run
+    one after another on the batcher thread, so requests arriving during a
+    generate are picked up together by the next one.
+    """
+
+    def __init__(self, window_ms=None, max_batch_size=None, max_batch_tokens=None, on_take=None):
+        self.window = (ANSWER_BATCH_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_batch_size = max_batch_size or ANSWER_MAX_BATCH_SIZE
+        self.max_batch_tokens = max_batch_tokens or ANSWER_MAX_BATCH_TOKENS
+        self.on_take = on_take  # called whenever a request leaves the batcher's queue
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="answer-batcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, input_data, spans=None, cache_key=None, received=None):
+        """Queue an answer request, received is its arrival perf_counter so queue_wait covers the work queue too"""
+        received = received if received is not None else time.perf_counter()
+        self.requests.put((received, input_data, spans if spans is not None else {}, cache_key))
+
+    def has_room(self):
+        """Whether another request would be picked up by the next batch instead of waiting here"""
+        return self.requests.qsize() < self.max_batch_size
+
+    def close(self):
+        """Answer everything already submitted, then stop the batcher thread"""
+        self.requests.put(None)
+        self.thread.join()
+
+    def prepare(self, entry):
+        received, input_data, spans, cache_key = entry
+        track_queued('answer', -1)
+        if self.on_take is not None:
+            self.on_take()
+        spans['queue_wait'] = time.perf_counter() - received
+        item = {
+            'id': input_data.get('id'),
+            'question': input_data.get('question', ''),
+            'received': received,
+            'spans': spans,
+            'cache_key': cache_key,
+            'context_mode': context_mode(input_data),
+            'control': get_request_control(input_data.get('id')),
+            'input_ids': None,
+            'answer': None
+        }
+        if item['control'] is not None and item['control'].should_stop():
+            # Nobody is waiting for this answer anymore
+            item['context'] = ''
+            item['stopped'] = item['control'].stopped_response()
+            return item
+        try:
+            residency.ensure('answer')
+        except Exception as e:
+            item['context'] = ''
+            item['error'] = f"Error loading answer model: {str(e)}"
+            return item
+        try:
+            item['context'] = select_context(input_data.get('feedbacks', {}), item['question'], spans)
+            if not item['context'] or not item['question']:
+                item['answer'] = "No context or question provided"
+            else:
+                item['input_ids'] = tokenize_answer_input(item['context'], item['question'], spans)
+        except Exception as e:
+            print(f"Question answering error: {str(e)}", file=sys.stderr)
+            item.setdefault('context', '')
+            item['answer'] = "Error generating answer"
+        return item
+
+    def run(self):
+        held = None
+        while True:
+            if held is None:
+                entry = self.requests.get()
+                if entry is None:
+                    return
+                held = self.prepare(entry)
+
+            batch = [held]
+            held = None
+            longest = len(batch[0]['input_ids'] or [])
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    entry = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    # Stop once the held request has been answered too
+                    self.requests.put(None)
+                    break
+                item = self.prepare(entry)
+                padded_length = max(longest, len(item['input_ids'] or []))
+                if padded_length * (len(batch) + 1) > self.max_batch_tokens:
+                    held = item
+                    break
+                batch.append(item)
+                longest = padded_length
+
+            self.run_batch(batch, longest)
+
+    def run_batch(self, batch, longest):
+        start_time = time.perf_counter()
+        batch_spans = {}
+        generated = [item for item in batch if item['answer'] is None and 'error' not in item and 'stopped' not in item]
+        if generated:
+            controls = [item['control'] for item in generated]
+            try:
+                answers = generate_answers([item['input_ids'] for item in generated], batch_spans, controls)
+                failed = False
+            except Exception as e:
+                print(f"Question answering error: {str(e)}", file=sys.stderr)
+                answers = ["Error generating answer"] * len(generated)
+                failed = True
+            # The stopping criteria cut generation short only when every request had stopped
+            if all(control is not None and control.should_stop() for control in controls):
+                for item in generated:
+                    item['stopped'] = item['control'].stopped_response()
+                generated = []
+            for item, answer in zip(generated, answers):
+                item['answer'] = answer
+                if item['cache_key'] is not None:
+                    item['cache'] = {'status': 'miss'}
+                    if not failed:
+                        answer_cache.put(item['cache_key'], answer, item['context'])
+                # Every request in the batch waited for the whole generate and decode
+                for stage in ('generate', 'decode'):
+                    if stage in batch_spans:
+                        item['spans'][stage] = batch_spans[stage]
+                item['spans']['input_tokens'] = len(item['input_ids'])
+
+        for item in batch:
+            finish_request(item['id'])
+            if 'stopped' in item:
+                send_response(item['stopped'], item['id'])
+                continue
+            if 'error' in item:
+                send_response({'error': item['error']}, item['id'])
+                continue
+            response = {
+                'answer': item['answer'],
+                'context': item['context'],
+                'question': item['question']
+            }
+            if 'cache' in item:
+                response['cache'] = item['cache']
+            send_response(shape_context(response, item['context_mode']), item['id'])
+
+        end_time = time.perf_counter()
+        elapsed = end_time - start_time
+        latencies = [end_time - item['received'] for item in batch]
+        for item, latency in zip(batch, latencies):
+            log_event('request', id=item['id'], action='answer', total_seconds=latency, spans=item['spans'])
+        log_event(
+            'answer_batch',
+            ids=[item['id'] for item in batch],
+            size=len(batch),
+            padded_shape=[len(generated), longest],
+            input_tokens=batch_spans.get('input_tokens', 0),
+            output_tokens=batch_spans.get('output_tokens', 0),
+            seconds=elapsed,
+            requests_per_second=len(batch) / max(elapsed, 1e-9),
+            latency_mean_seconds=sum(latencies) / len(latencies),
+            latency_max_seconds=max(latencies)
+        )
+
+def map_sentiment_label(result):
+    """Map a raw classifier result to a sentiment category"""
+    label = result['label'].lower()
+    score = result['score']
+
+    # Map sentiment labels to categories
+    if label == 'positive':
+        if score > 0.9:
+            return 'very_positive'
+        return 'positive'
+    elif label == 'negative':
+        if score > 0.9:
+            return 'very_negative'
+        return 'negative'
+    return 'neutral'
 
 def get_sentiment_category(text):
     """Get the sentiment category of a text"""
     global sentiment_classifier
     try:
-        result = sentiment_classifier(text)[0]
-        label = result['label'].lower()
-        score = result['score']
-        
-        # Map sentiment labels to categories
-        if label == 'positive':
-            if score > 0.9:
-                return 'very_positive'
-            return 'positive'
-        elif label == 'negative':
-            if score > 0.9:
-                return 'very_negative'
-            return 'negative'
-        return 'neutral'
+        with residency.using('sentiment'), sentiment_lock:
+            result = sentiment_classifier(text)[0]
+        return map_sentiment_label(result)
     except Exception as e:
         print(f"Error in sentiment analysis: {str(e)}", file=sys.stderr)
         return 'neutral'
 
+def get_sentiment_categories(texts, batch_size=None):
+    """Get the sentiment categories of many texts using padded batches"""
+    global sentiment_classifier
+    if not texts:
+        return []
+    batch_size = batch_size or SENTIMENT_BATCH_SIZE
+    residency.ensure('sentiment')
+    try:
+        # The pipeline pads each batch to its longest sentence
+        with residency.using('sentiment'), sentiment_lock:
+            results = sentiment_classifier(texts, batch_size=batch_size, truncation=True)
+        return [map_sentiment_label(result) for result in results]
+    except Exception as e:
+        # Fall back to scoring one by one so a single bad input doesn't drop the batch
+        print(f"Error in batched sentiment analysis: {str(e)}", file=sys.stderr)
+        return [get_sentiment_category(text) for text in texts]
+
+def split_sentences(text):
+    """Split text into sentences that are long enough to be meaningful"""
+    sentences = [s.strip() for s in re.split(r'[.!?]+', text) if s.strip()]
+    return [s for s in sentences if len(s.split()) >= 2]  # Reduced minimum length to catch short meaningful sentences
+
 def clean_sentence(sentence):
     """Clean and normalize a sentence for comparison"""
     # Convert to lowercase
@@ -193,14 +797,15 @@ def clean_sentence(sentence):
 
 def are_sentences_similar(s1, s2, threshold=0.7):
     """Check if two sentences are similar using sequence matching"""
-    s1_clean = clean_sentence(s1)
-    s2_clean = clean_sentence(s2)
-    
+    return are_cleaned_sentences_similar(clean_sentence(s1), clean_sentence(s2), threshold)
+
+def are_cleaned_sentences_similar(s1_clean, s2_clean, threshold=0.7):
+    """Check if two already cleaned sentences are similar using sequence matching"""
     # Calculate similarity ratio
     ratio = SequenceMatcher(None, s1_clean, s2_clean).ratio()
     
     # If ratio is close but not quite there, try word-based comparison
-    if 0.6 <= ratio < threshold:
+    if SIMILARITY_FLOOR <= ratio < threshold:
         words1 = set(s1_clean.split())
         words2 = set(s2_clean.split())
         common_words = words1.intersection(words2)
@@ -210,143 +815,941 @@ def are_sentences_similar(s1, s2, threshold=0.7):
     
     return ratio >= threshold
 
-def extract_trending_sentences(feedbacks, time_window_days=30):
-    """Extract trending sentences from feedback by finding similar/repeated sentences with same sentiment"""
-    global model, tokenizer, sentiment_classifier
-    try:
-        if not feedbacks:
-            return []
-            
-        # Extract all sentences from feedback with their sentiment
-        all_sentences = []
-        for question_id, feedback in feedbacks.items():
-            if isinstance(feedback, dict):
-                question = feedback.get('question', '')
-                answer = feedback.get('answer', '')
-                if answer:
-                    # Split answer into sentences
-                    sentences = [s.strip() for s in re.split(r'[.!?]+', answer) if s.strip()]
-                    for sentence in sentences:
-                        if len(sentence.split()) >= 2:  # Reduced minimum length to catch short meaningful sentences
-                            sentiment = get_sentiment_category(sentence)
-                            all_sentences.append({
-                                'text': sentence,
-                                'sentiment': sentiment,
-                                'question': question  # Store the question for context
-                            })
-            elif isinstance(feedback, str):
-                # Handle direct text feedback
-                sentences = [s.strip() for s in re.split(r'[.!?]+', feedback) if s.strip()]
-                for sentence in sentences:
-                    if len(sentence.split()) >= 2:
-                        sentiment = get_sentiment_category(sentence)
-                        all_sentences.append({
-                            'text': sentence,
-                            'sentiment': sentiment,
-                            'question': None  # No question context for direct feedback
-                        })
-        
-        # Group similar sentences with same sentiment
-        sentence_groups = []
-        for sentence_data in all_sentences:
-            sentence = sentence_data['text']
-            sentiment = sentence_data['sentiment']
-            question = sentence_data['question']
-            
-            # Check if sentence is similar to any existing group with same sentiment
-            found_group = False
-            for group in sentence_groups:
-                if (group['sentiment'] == sentiment and 
-                    are_sentences_similar(sentence, group['representative'])):
-                    group['sentences'].append(sentence)
-                    group['questions'].add(question)  # Add question to the set
-                    found_group = True
+def sentence_ngrams(cleaned, n=SIMILARITY_NGRAM_SIZE):
+    """Get the set of character n-grams of a cleaned sentence"""
+    padded = f" {cleaned} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+def is_indexable(cleaned):
+    """Whether a sentence has a word long enough for its n-grams to shortlist its matches"""
+    return any(len(word) >= SIMILARITY_NGRAM_SIZE for word in cleaned.split())
+
+class SentenceGroupIndex:
+    """Inverted character n-gram index over group representatives, kept per sentiment.
+
+    Only groups sharing an n-gram with a sentence are shortlisted, and those are
+    further filtered with the same length and character-count upper bounds that
+    SequenceMatcher.real_quick_ratio/quick_ratio use, so the exact similarity
+    check only runs on plausible candidates.
+
+    Sentences without a word of n characters can match through short blocks
+    that span no shared n-gram ('a a' and 'ab ab' have a ratio of 0.75), so
+    they are compared with the whole bucket. The shortlist is still a
+    heuristic: sentences with long words can in rare cases match only through
+    blocks shorter than n, which real feedback text practically never does.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(partial(defaultdict, set))  # sentiment -> n-gram -> group ids
+        self.short_groups = defaultdict(list)  # sentiment -> groups without an indexable word
+        self.char_counts = {}  # group id -> character counts of the representative
+
+    def add(self, group_id, sentiment, cleaned):
+        self.char_counts[group_id] = Counter(cleaned)
+        if not is_indexable(cleaned):
+            self.short_groups[sentiment].append(group_id)
+            return
+        postings = self.postings[sentiment]
+        for ngram in sentence_ngrams(cleaned):
+            postings[ngram].add(group_id)
+
+    def remove(self, group_id, sentiment, cleaned):
+        del self.char_counts[group_id]
+        if not is_indexable(cleaned):
+            self.short_groups[sentiment].remove(group_id)
+            return
+        postings = self.postings[sentiment]
+        for ngram in sentence_ngrams(cleaned):
+            group_ids = postings.get(ngram)
+            if group_ids is not None:
+                group_ids.discard(group_id)
+                if not group_ids:
+                    del postings[ngram]
+
+    def candidates(self, sentiment, cleaned):
+        """Return group ids that may be similar to the sentence, in creation order"""
+        postings = self.postings[sentiment]
+        if not is_indexable(cleaned):
+            # Sentences of short words can match without sharing an n-gram, check the whole bucket
+            shortlist = set().union(*postings.values()) if postings else set()
+        else:
+            shortlist = set()
+            for ngram in sentence_ngrams(cleaned):
+                shortlist.update(postings.get(ngram, ()))
+        shortlist.update(self.short_groups[sentiment])
+
+        counts = Counter(cleaned)
+        length = len(cleaned)
+        candidates = []
+        for group_id in sorted(shortlist):
+            group_counts = self.char_counts[group_id]
+            total = length + sum(group_counts.values())
+            if not total:
+                candidates.append(group_id)
+                continue
+            # Upper bounds on the sequence ratio from lengths and shared characters
+            group_length = total - length
+            if 2.0 * min(length, group_length) / total < SIMILARITY_FLOOR:
+                continue
+            matches = sum(min(count, group_counts[char]) for char, count in counts.items())
+            if 2.0 * matches / total < SIMILARITY_FLOOR:
+                continue
+            candidates.append(group_id)
+        return candidates
+
+def feedback_timestamp(feedback, default):
+    """Epoch seconds a feedback was created, from created_at/createdAt (epoch or ISO 8601)"""
+    if not isinstance(feedback, dict):
+        return default
+    value = feedback.get('created_at', feedback.get('createdAt'))
+    if isinstance(value, (int, float)):
+        # JavaScript timestamps are in milliseconds
+        return value / 1000.0 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            print(f"Ignoring invalid feedback timestamp: {value}", file=sys.stderr)
+    return default
+
+def feedback_sentences(feedback):
+    """Split one feedback into (sentence, question) pairs"""
+    if isinstance(feedback, dict):
+        question = feedback.get('question', '')
+        answer = feedback.get('answer', '')
+        # Store the question for context
+        return [(sentence, question) for sentence in split_sentences(answer)] if answer else []
+    elif isinstance(feedback, str):
+        # Handle direct text feedback, no question context
+        return [(sentence, None) for sentence in split_sentences(feedback)]
+    return []
+
+class TrendingState:
+    """Sentence groups of one survey's feedback inside a sliding time window.
+
+    Feedbacks are added as they arrive and evicted once they fall out of the
+    window. Group counts, questions and representatives are updated in place,
+    so a refresh costs time in proportion to the new and expired feedback
+    rather than the whole history. Feedback keys identify feedbacks, a key
+    that is already in the window is not added again.
+
+    A compact state never evicts, for bulk runs that filter their rows to the
+    window up front. It keeps group counts instead of member sentences, only
+    the keys of its feedbacks, and a bounded match memo that checkpoints leave
+    out. Its representatives never change, so the memo is only a shortcut.
+    """
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        self.groups = {}  # group id -> group, in creation order
+        self.next_group_id = 0
+        self.group_index = SentenceGroupIndex()
+        self.feedbacks = {}  # feedback key -> [(group id, member key)], None in a compact state
+        self.expiry = []  # heap of (timestamp, feedback key)
+        # (sentiment, cleaned sentence) -> (group id, representative version), only for sentences in the window
+        self.matched_groups = OrderedDict() if compact else {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Bulk runs pickle the state into their checkpoints
+        state = self.__dict__.copy()
+        del state['lock']
+        if self.compact:
+            state['matched_groups'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_feedbacks(self, feedbacks, now, spans=None):
+        """Group the sentences of feedbacks not seen before, returns how many feedbacks were added"""
+        new_feedbacks = []
+        sentences = []
+        with timed_stage('split', spans):
+            for key, feedback in feedbacks.items():
+                if key in self.feedbacks:
+                    continue
+                new_feedbacks.append((key, feedback_timestamp(feedback, now)))
+                sentences.append(feedback_sentences(feedback))
+
+        # Score every new sentence in padded batches
+        with timed_stage('sentiment', spans):
+            flat = [sentence for feedback in sentences for sentence, _ in feedback]
+            sentiments = iter(get_sentiment_categories(flat))
+
+        with timed_stage('clustering', spans):
+            cleaned_cache = {}  # sentence -> cleaned sentence
+            for (key, timestamp), feedback in zip(new_feedbacks, sentences):
+                scored = []
+                for sentence, question in feedback:
+                    cleaned = cleaned_cache.get(sentence)
+                    if cleaned is None:
+                        cleaned = cleaned_cache[sentence] = clean_sentence(sentence)
+                    scored.append((sentence, cleaned, next(sentiments), question))
+                self.add_scored(key, timestamp, scored)
+        return len(new_feedbacks)
+
+    def add_scored(self, key, timestamp, scored):
+        """Group one feedback's sentences, already cleaned and scored as (sentence, cleaned, sentiment, question)"""
+        members = []
+        for position, (sentence, cleaned, sentiment, question) in enumerate(scored):
+            member_key = (key, position)
+            group_id = self.add_sentence(member_key, sentence, cleaned, sentiment, question)
+            members.append((group_id, member_key))
+        if self.compact:
+            self.feedbacks[key] = None
+            return
+        self.feedbacks[key] = members
+        heapq.heappush(self.expiry, (timestamp, key))
+
+    def add_sentence(self, member_key, sentence, cleaned, sentiment, question):
+        # Representatives only change on eviction, so a repeated sentence joins the same group again
+        group_id = None
+        matched = self.matched_groups.get((sentiment, cleaned))
+        if matched is not None and matched[0] in self.groups and self.groups[matched[0]]['version'] == matched[1]:
+            group_id = matched[0]
+        else:
+            # Check shortlisted groups with same sentiment, first similar one wins
+            for candidate_id in self.group_index.candidates(sentiment, cleaned):
+                if are_cleaned_sentences_similar(cleaned, self.groups[candidate_id]['cleaned']):
+                    group_id = candidate_id
                     break
-            
+
+        if group_id is None:
             # If no similar group found with same sentiment, create new group
-            if not found_group:
-                sentence_groups.append({
-                    'representative': sentence,
-                    'sentences': [sentence],
-                    'sentiment': sentiment,
-                    'questions': {question}  # Initialize with a set containing the question
-                })
-        
-        # Score groups by size and return top sentences
-        scored_groups = []
-        for group in sentence_groups:
-            if len(group['sentences']) > 1:  # Only include groups with multiple similar sentences
-                scored_groups.append({
-                    'sentence': group['representative'],
-                    'count': len(group['sentences']),
-                    'sentiment': group['sentiment'],
-                    'questions': list(group['questions']),  # Convert set to list
-                    'examples': group['sentences'][:3]  # Include up to 3 examples
-                })
-        
-        # Sort by count and return top sentences
-        scored_groups.sort(key=lambda x: x['count'], reverse=True)
+            group_id = self.next_group_id
+            self.next_group_id += 1
+            self.group_index.add(group_id, sentiment, cleaned)
+            group = self.groups[group_id] = {
+                'representative': sentence,
+                'representative_key': member_key,
+                'cleaned': cleaned,
+                'sentiment': sentiment,
+                'count': 0,
+                'questions': Counter(),
+                'version': 0
+            }
+            if not self.compact:
+                group['members'] = {}  # member key -> (sentence, question, cleaned), oldest first
+                group['cleaned_counts'] = Counter()  # cleaned sentence -> members in the window
+        group = self.groups[group_id]
+        group['count'] += 1
+        group['questions'][question] += 1
+        if not self.compact:
+            group['members'][member_key] = (sentence, question, cleaned)
+            group['cleaned_counts'][cleaned] += 1
+        self.matched_groups[(sentiment, cleaned)] = (group_id, group['version'])
+        if self.compact and len(self.matched_groups) > TRENDING_MATCH_MEMO_SIZE:
+            self.matched_groups.popitem(last=False)
+        return group_id
+
+    def evict_before(self, cutoff):
+        """Drop feedbacks created before cutoff, returns how many were dropped. Compact states keep no expiry"""
+        evicted = 0
+        while self.expiry and self.expiry[0][0] < cutoff:
+            _, key = heapq.heappop(self.expiry)
+            for group_id, member_key in self.feedbacks.pop(key, ()):
+                self.remove_member(group_id, member_key)
+            evicted += 1
+        return evicted
+
+    def remove_member(self, group_id, member_key):
+        group = self.groups[group_id]
+        _, question, cleaned = group['members'].pop(member_key)
+        group['count'] -= 1
+        group['questions'][question] -= 1
+        if not group['questions'][question]:
+            del group['questions'][question]
+        group['cleaned_counts'][cleaned] -= 1
+        if not group['cleaned_counts'][cleaned]:
+            del group['cleaned_counts'][cleaned]
+            # Forget the match once its last sentence leaves the window, so the memo doesn't outgrow it
+            matched = self.matched_groups.get((group['sentiment'], cleaned))
+            if matched is not None and matched[0] == group_id:
+                del self.matched_groups[(group['sentiment'], cleaned)]
+
+        if not group['count']:
+            self.group_index.remove(group_id, group['sentiment'], group['cleaned'])
+            del self.groups[group_id]
+        elif member_key == group['representative_key']:
+            # The oldest remaining sentence takes over, as if the group had been built without the evicted ones
+            self.group_index.remove(group_id, group['sentiment'], group['cleaned'])
+            group['representative_key'], (group['representative'], _, group['cleaned']) = next(iter(group['members'].items()))
+            group['version'] += 1
+            self.group_index.add(group_id, group['sentiment'], group['cleaned'])
+
+    def top(self, limit=TRENDING_TOP_SENTENCES):
+        """Largest groups with more than one sentence, ties in creation order"""
+        groups = (group for group in self.groups.values() if group['count'] > 1)
         return [{
-            'text': group['sentence'],
+            'text': group['representative'],
             'sentiment': group['sentiment'],
             'count': group['count'],
-            'questions': group['questions']  # Include the questions this sentence appeared in
-        } for group in scored_groups[:10]]
+            'questions': list(group['questions'])  # Include the questions this sentence appeared in
+        } for group in heapq.nlargest(limit, groups, key=lambda group: group['count'])]
+
+trending_states = OrderedDict()  # survey ID -> TrendingState
+trending_states_lock = threading.Lock()
+
+def get_trending_state(survey_id, reset=False):
+    """Trending state of a survey and whether it was just created, on first use, reset or after it was lost"""
+    with trending_states_lock:
+        state = None if reset else trending_states.get(survey_id)
+        created = state is None
+        if created:
+            state = trending_states[survey_id] = TrendingState()
+        trending_states.move_to_end(survey_id)
+        while len(trending_states) > TRENDING_STATE_SURVEYS:
+            trending_states.popitem(last=False)
+        return state, created
+
+def refresh_trending_state(state, feedbacks, time_window_days=30, spans=None):
+    """Add new feedbacks to a survey's trending state, evict expired ones and return the top sentences"""
+    now = time.time()
+    cutoff = now - timedelta(days=time_window_days).total_seconds()
+    with state.lock:
+        # Feedbacks that are already too old never enter the state
+        fresh = {
+            str(key): feedback for key, feedback in (feedbacks or {}).items()
+            if feedback_timestamp(feedback, now) >= cutoff
+        }
+        added = state.add_feedbacks(fresh, now, spans)
+        evicted = state.evict_before(cutoff)
+        sentences = state.top()
+        window = {
+            'feedbacks': len(state.feedbacks),
+            'groups': len(state.groups),
+            'added': added,
+            'evicted': evicted
+        }
+    log_event(
+        'trending',
+        sentiment_batch_size=SENTIMENT_BATCH_SIZE,
+        window=window,
+        spans={stage: (spans or {}).get(stage) for stage in ('split', 'sentiment', 'clustering')}
+    )
+    return sentences, window
+
+def extract_trending_sentences(feedbacks, time_window_days=30, spans=None):
+    """Extract trending sentences from feedback by finding similar/repeated sentences with same sentiment"""
+    global model, tokenizer, sentiment_classifier
+    try:
+        if not feedbacks:
+            return []
+
+        # A one-off state over the whole feedback set, feedbacks without a timestamp always count
+        sentences, _ = refresh_trending_state(TrendingState(), feedbacks, time_window_days, spans)
+        return sentences
         
     except Exception as e:
         print(f"Error extracting trending sentences: {str(e)}", file=sys.stderr)
         return []
 
+def parse_action_concurrency(spec):
+    """Parse an "action=limit,..." spec into a dict of per-action concurrency limits"""
+    limits = {}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        action, limit = part.split('=', 1)
+        try:
+            limits[action.strip()] = max(1, int(limit))
+        except ValueError:
+            print(f"Ignoring invalid concurrency limit: {part}", file=sys.stderr)
+    return limits
+
+def context_mode(input_data):
+    mode = input_data.get('context_mode', RESPONSE_CONTEXT)
+    return mode if mode in CONTEXT_MODES else 'full'
+
+def shape_context(result, mode):
+    """Replace or drop the echoed context of an answer response according to mode"""
+    if mode == 'full' or 'context' not in result:
+        return result
+    context = result.pop('context')
+    if mode == 'hash':
+        result['context_hash'] = hashlib.sha256(context.encode('utf-8')).hexdigest()
+        result['context_length'] = len(context)
+    return result
+
+def cache_stats():
+    """Hit and size counters of the worker's caches, keyed by cache name"""
+    with context_index_lock:
+        stats = {
+            'context_index': {
+                **context_index_stats,
+                'entries': len(context_index_cache)
+            }
+        }
+    if answer_cache is not None:
+        stats['answer_cache'] = answer_cache.get_stats()
+    with trending_states_lock:
+        stats['trending_state'] = {
+            'surveys': len(trending_states),
+            'feedbacks': sum(len(state.feedbacks) for state in trending_states.values())
+        }
+    return stats
+
+def collect_stats():
+    """Snapshot of the stage latencies, token counts, queue depth, caches and memory"""
+    with stats_lock:
+        depth = {action: count for action, count in queue_depth.items() if count}
+    return collect_worker_stats(depth, cache_stats(), residency)
+
+
+def process_request(input_data, spans=None, stream=None):
+    """Run a single parsed request and return its result"""
+    feedbacks = input_data.get('feedbacks', {})
+    question = input_data.get('question', '')
+    action = input_data.get('action', 'answer')  # Default to answer if not specified
+
+    if action == 'status':
+        return {
+            'status': 'ready',
+            'backend': INFERENCE_BACKEND,
+            'offline': MODEL_OFFLINE,
+            'dtype': MODEL_DTYPE,
+            'models': {name: dict(state) for name, state in residency.states.items()}
+        }
+    elif action == 'stats':
+        return collect_stats()
+    elif action == 'extract_trending_sentences':
+        # Surface model load failures instead of returning no trending sentences
+        residency.ensure('sentiment')
+
+        time_window_days = input_data.get('time_window_days', 30)
+        survey_id = input_data.get('survey_id')
+        if survey_id is None:
+            # Extract trending sentences
+            sentences = extract_trending_sentences(feedbacks, time_window_days, spans)
+            return {
+                'sentences': sentences,
+                'count': len(sentences)
+            }
+
+        # Stateful mode: feedbacks only needs the responses that arrived since the last refresh
+        state, created = get_trending_state(str(survey_id), input_data.get('reset', False))
+        sentences, window = refresh_trending_state(state, feedbacks, time_window_days, spans)
+        return {
+            'sentences': sentences,
+            'count': len(sentences),
+            'survey_id': survey_id,
+            'window': window,
+            # "created" means the worker had no state for the survey, because it is new, was reset,
+            # evicted past TRENDING_STATE_SURVEYS or lost in a restart. The result then only covers
+            # these feedbacks, so a caller that sent an increment should resend the full window
+            'state': 'created' if created else 'updated'
+        }
+    elif action == 'answer':
+        # Default to question answering
+        control = get_request_control(input_data.get('id'))
+        cached, cache_key = cached_answer_response(input_data, spans)
+        if cached is not None:
+            return cached
+        context = select_context(feedbacks, question, spans)
+        if stream is not None:
+            answer, _ = stream_answer(context, question, stream, spans, control)
+            if control is not None and control.should_stop():
+                return control.stopped_response()
+            # Greedy answers are not cached, the cache holds beam search answers only
+            return {
+                'answer': answer,
+                'context': context,
+                'question': question
+            }
+        answer, failed = answer_question_checked(context, question, spans, control)
+        if control is not None and control.should_stop():
+            return control.stopped_response()
+        result = {
+            'answer': answer,
+            'context': context,
+            'question': question
+        }
+        if cache_key is not None and context and not failed:
+            answer_cache.put(cache_key, answer, context)
+            result['cache'] = {'status': 'miss'}
+        return result
+    return {"error": f"Unknown action: {action}"}
+
+def handle_request(input_data, spans=None, received=None):
+    """Process a request on a worker thread and send back its response"""
+    request_id = input_data.get('id')
+    action = input_data.get('action', 'answer')
+    spans = spans if spans is not None else {}
+    start_time = time.perf_counter()
+    track_queued(action, -1)
+    if received is not None:
+        spans['queue_wait'] = start_time - received
+    control = get_request_control(request_id)
+    stream = ResponseStream(request_id, control) if wants_stream(input_data) else None
+    try:
+        if control is not None and control.should_stop():
+            # Skip requests whose caller has already given up
+            result = control.stopped_response()
+        else:
+            result = process_request(input_data, spans, stream)
+    except Exception as e:
+        result = {"error": f"Error processing request: {str(e)}"}
+    finally:
+        finish_request(request_id)
+    if action == 'answer':
+        shape_context(result, context_mode(input_data))
+    if stream is not None:
+        stream.finish(result)
+    else:
+        send_response(result, request_id)
+    if action != 'stats':
+        log_event(
+            'request',
+            id=request_id,
+            action=action,
+            total_seconds=time.perf_counter() - (received if received is not None else start_time),
+            spans=spans
+        )
+
+# Representative inputs used to profile and compare inference backends
+SAMPLE_FEEDBACKS = [
+    {'questions': [
+        {'question': 'How was your experience?', 'answer': 'The app is fast but the login page keeps crashing on my phone.'},
+        {'question': 'What should we improve?', 'answer': 'Please add dark mode and make the export to CSV faster.'}
+    ]},
+    {'questions': [
+        {'question': 'How was your experience?', 'answer': 'Support answered quickly and solved my billing problem.'},
+        {'question': 'What should we improve?', 'answer': 'The pricing page is confusing and the free plan is too limited.'}
+    ]},
+    {'questions': [
+        {'question': 'How was your experience?', 'answer': 'I love the new dashboard, it is clean and easy to use.'},
+        {'question': 'What should we improve?', 'answer': 'Notifications arrive late and sometimes not at all.'}
+    ]}
+]
+SAMPLE_QUESTIONS = [
+    'What do users complain about most?',
+    'What do users like about the product?',
+    'Which features are requested?'
+]
+
+def profile_backend(backend, repeats=3):
+    """Load the models with one backend and measure load time, latency, memory and outputs"""
+    start_time = time.perf_counter()
+    load_model(backend=backend)
+    load_seconds = time.perf_counter() - start_time
+
+    context = format_context(SAMPLE_FEEDBACKS)
+    sentences = [
+        sentence
+        for feedback in SAMPLE_FEEDBACKS
+        for q in feedback['questions']
+        for sentence in split_sentences(q['answer'])
+    ]
+
+    answer_latencies = []
+    answers = [
+        timed_repeats(lambda: answer_question(context, question), repeats, answer_latencies)
+        for question in SAMPLE_QUESTIONS
+    ]
+    sentiment_latencies = []
+    sentiments = timed_repeats(lambda: get_sentiment_categories(sentences), repeats, sentiment_latencies)
+
+    return {
+        'backend': backend,
+        'load_seconds': load_seconds,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'answer_latency_median_seconds': statistics.median(answer_latencies),
+        'sentiment_batch_latency_median_seconds': statistics.median(sentiment_latencies),
+        'answers': answers,
+        'sentiments': sentiments
+    }
+
+def compare_backends(backend, repeats=3):
+    """Compare a backend against PyTorch fp32, each profiled in a fresh process"""
+    baseline, candidate = profile_backends(os.path.abspath(__file__), backend, repeats)
+    return {
+        'baseline': baseline,
+        'candidate': candidate,
+        'answer_exact_agreement': agreement(baseline['answers'], candidate['answers']),
+        'answer_similarity': similarity(baseline['answers'], candidate['answers']),
+        'sentiment_agreement': agreement(baseline['sentiments'], candidate['sentiments']),
+        'answer_speedup': baseline['answer_latency_median_seconds'] / candidate['answer_latency_median_seconds'],
+        'sentiment_speedup': baseline['sentiment_batch_latency_median_seconds'] / candidate['sentiment_batch_latency_median_seconds'],
+        'peak_rss_ratio': candidate['peak_rss_bytes'] / baseline['peak_rss_bytes']
+    }
+
+
+# Columns of the feedback CSV export that hold metadata, every other column is a question.
+# None means the column is ignored
+BULK_CSV_META_COLUMNS = {
+    'Feedback ID': 'id',
+    'Survey ID': 'survey_id',
+    'Created At': 'created_at',
+    'Updated At': None,
+    'Is Read': None
+}
+
+def bulk_row_from_csv(record):
+    """Normalize one row of the feedback CSV export"""
+    row = {'id': None, 'survey_id': None, 'created_at': None, 'answers': []}
+    for column, value in record.items():
+        # Cells beyond the header end up under None, empty cells are unanswered questions
+        if not isinstance(column, str) or not isinstance(value, str) or not value.strip():
+            continue
+        if column in BULK_CSV_META_COLUMNS:
+            if BULK_CSV_META_COLUMNS[column]:
+                row[BULK_CSV_META_COLUMNS[column]] = value
+        else:
+            row['answers'].append((column, value))
+    return row
+
+def bulk_row_from_json(record):
+    """Normalize one JSONL feedback with "questions", "responses" or a single "answer"/"text" """
+    answers = [(q.get('question', ''), q.get('answer')) for q in record.get('questions') or []]
+    for question_id, response in (record.get('responses') or {}).items():
+        if isinstance(response, dict):
+            answers.append((response.get('title') or question_id, response.get('value')))
+    if 'answer' in record or 'text' in record:
+        answers.append((record.get('question', ''), record.get('answer', record.get('text'))))
+    return {
+        'id': record.get('id', record.get('_id')),
+        'survey_id': record.get('survey_id', record.get('surveyId')),
+        'created_at': record.get('created_at', record.get('createdAt')),
+        'answers': [(question, answer) for question, answer in answers if isinstance(answer, str) and answer.strip()]
+    }
+
+def read_bulk_rows(path):
+    """Yield normalized feedback rows from a CSV export or a JSONL file, one at a time"""
+    with open(path, newline='', encoding='utf-8') as input_file:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in input_file:
+                if line.strip():
+                    yield bulk_row_from_json(json.loads(line))
+        else:
+            for record in csv.DictReader(input_file):
+                yield bulk_row_from_csv(record)
+
+def chunked(items, size):
+    """Group an iterable into lists of up to size items without reading ahead"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def score_bulk_rows(rows):
+    """Split, clean and score the sentences of a chunk of rows with one batched sentiment call.
+
+    Returns a list of (sentence, cleaned, sentiment, question) per row. Runs in
+    the bulk worker processes.
+    """
+    split = [
+        [(sentence, question) for question, answer in row['answers'] for sentence in split_sentences(answer)]
+        for row in rows
+    ]
+    sentiments = iter(get_sentiment_categories([sentence for row in split for sentence, _ in row]))
+    return [
+        [(sentence, clean_sentence(sentence), next(sentiments), question) for sentence, question in row]
+        for row in split
+    ]
+
+def init_bulk_worker(threads):
+    # Ctrl-C reaches the whole process group, only the parent handles it and saves the checkpoint
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(threads)
+
+def save_bulk_checkpoint(path, checkpoint):
+    # Written to a temporary file first, so an interrupted save keeps the previous checkpoint
+    with open(f"{path}.tmp", 'wb') as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+def load_bulk_checkpoint(path, source):
+    """Checkpoint of an interrupted run over the same input and settings, or None"""
+    try:
+        with open(path, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    if checkpoint.get('source') != source:
+        print(f"Ignoring checkpoint {path}, it belongs to another input file or settings", file=sys.stderr)
+        return None
+    return checkpoint
+
+def write_bulk_output(path, surveys, top):
+    """Write one JSON line per survey with its sentiment distribution and trending sentences"""
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as output_file:
+        for survey_id, survey in surveys.items():
+            sentences = sum(survey['sentiment'].values())
+            output_file.write(json.dumps({
+                'survey_id': survey_id,
+                'feedbacks': survey['feedbacks'],
+                'sentences': sentences,
+                'sentiment': dict(survey['sentiment']),
+                'sentiment_share': {
+                    category: count / sentences for category, count in survey['sentiment'].items()
+                },
+                'trending': survey['trending'].top(top)
+            }) + '\n')
+    os.replace(f"{path}.tmp", path)
+
+def run_bulk(args):
+    """Analyze a feedback export offline: sentiment distribution and trending sentences per survey.
+
+    Rows are streamed from the input in chunks. Worker processes forked after
+    the sentiment model is loaded score whole chunks with batched calls, while
+    this process groups the scored sentences in input order, so results don't
+    depend on the number of processes. A checkpoint is saved every
+    checkpoint_interval seconds and on Ctrl-C, and a rerun with the same
+    arguments resumes from it.
+    """
+    start_time = time.perf_counter()
+    output_path = args.output or f"{args.bulk}.analysis.jsonl"
+    checkpoint_path = args.checkpoint or f"{output_path}.checkpoint"
+    input_stat = os.stat(args.bulk)
+    source = {
+        'path': os.path.abspath(args.bulk),
+        'size': input_stat.st_size,
+        'mtime': input_stat.st_mtime,
+        'time_window_days': args.time_window_days,
+        # Bumped when the pickled TrendingState layout changes, so older checkpoints are ignored
+        'state_format': 4
+    }
+    checkpoint = load_bulk_checkpoint(checkpoint_path, source)
+    if checkpoint is None:
+        checkpoint = {'source': source, 'now': time.time(), 'rows_done': 0, 'surveys': {}}
+    else:
+        print(f"Resuming {args.bulk} after row {checkpoint['rows_done']}", file=sys.stderr)
+    resumed_rows = checkpoint['rows_done']
+    surveys = checkpoint['surveys']
+    now = checkpoint['now']
+    cutoff = None if args.time_window_days is None else now - timedelta(days=args.time_window_days).total_seconds()
+
+    # Loaded before forking so the workers share the weights
+    residency.ensure('sentiment')
+
+    rows = itertools.islice(enumerate(read_bulk_rows(args.bulk)), resumed_rows, None)
+    if cutoff is not None:
+        rows = ((number, row) for number, row in rows if feedback_timestamp(row, now) >= cutoff)
+    chunks = chunked(rows, args.chunk_rows)
+
+    def apply_chunk(chunk, scored):
+        for (number, row), sentences in zip(chunk, scored):
+            survey = surveys.get(row['survey_id'])
+            if survey is None:
+                survey = surveys[row['survey_id']] = {'feedbacks': 0, 'sentiment': Counter(), 'trending': TrendingState(compact=True)}
+            key = str(row['id']) if row['id'] is not None else f"row:{number}"
+            if key in survey['trending'].feedbacks:
+                # The same feedback exported twice
+                continue
+            survey['feedbacks'] += 1
+            survey['sentiment'].update(sentiment for _, _, sentiment, _ in sentences)
+            survey['trending'].add_scored(key, feedback_timestamp(row, now), sentences)
+        checkpoint['rows_done'] = chunk[-1][0] + 1
+
+    processes = args.processes or os.cpu_count() or 1
+    pool = None
+    if processes > 1:
+        gc.freeze()
+        threads = max(1, (os.cpu_count() or 1) // processes)
+        pool = multiprocessing.get_context('fork').Pool(processes, initializer=init_bulk_worker, initargs=(threads,))
+    # Chunks handed to the pool and not applied yet, a few per process keep every worker busy
+    in_flight = deque()
+    last_checkpoint = time.perf_counter()
+    try:
+        for chunk in chunks:
+            if pool is None:
+                apply_chunk(chunk, score_bulk_rows([row for _, row in chunk]))
+            else:
+                in_flight.append((chunk, pool.apply_async(score_bulk_rows, ([row for _, row in chunk],))))
+                if len(in_flight) < processes * 2:
+                    continue
+                done_chunk, result = in_flight.popleft()
+                apply_chunk(done_chunk, result.get())
+            if time.perf_counter() - last_checkpoint >= args.checkpoint_interval:
+                save_bulk_checkpoint(checkpoint_path, checkpoint)
+                last_checkpoint = time.perf_counter()
+                log_event(
+                    'bulk_progress',
+                    rows=checkpoint['rows_done'],
+                    surveys=len(surveys),
+                    rows_per_second=(checkpoint['rows_done'] - resumed_rows) / (time.perf_counter() - start_time)
+                )
+        while in_flight:
+            done_chunk, result = in_flight.popleft()
+            apply_chunk(done_chunk, result.get())
+    except KeyboardInterrupt:
+        # Chunks still in the pool are lost, the checkpoint only covers applied ones
+        if pool is not None:
+            pool.terminate()
+        save_bulk_checkpoint(checkpoint_path, checkpoint)
+        print(f"Interrupted, checkpoint saved to {checkpoint_path} after row {checkpoint['rows_done']}", file=sys.stderr)
+        sys.exit(130)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    write_bulk_output(output_path, surveys, args.top)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return {
+        'input': args.bulk,
+        'output': output_path,
+        'rows': checkpoint['rows_done'],
+        'resumed_from_row': resumed_rows,
+        'surveys': len(surveys),
+        'processes': processes,
+        'seconds': time.perf_counter() - start_time
+    }
+
+def parse_args(argv):
+    parser = backend_argument_parser("Feedback analysis model worker, reads JSON requests from stdin")
+    parser.add_argument('--bulk', metavar='INPUT',
+                        help="Analyze a feedback CSV export or JSONL file offline instead of serving requests")
+    parser.add_argument('--output', help="--bulk: JSONL file with one line per survey (default: INPUT.analysis.jsonl)")
+    parser.add_argument('--checkpoint', help="--bulk: checkpoint file to resume from (default: OUTPUT.checkpoint)")
+    parser.add_argument('--checkpoint-interval', type=float, default=60, help="--bulk: seconds between checkpoints")
+    parser.add_argument('--processes', type=int, default=0, help="--bulk: sentiment worker processes, 0 uses one per CPU core")
+    parser.add_argument('--chunk-rows', type=int, default=256, help="--bulk: rows scored per worker task")
+    parser.add_argument('--time-window-days', type=float,
+                        help="--bulk: only analyze feedback created this many days before the run (default: all)")
+    parser.add_argument('--top', type=int, default=TRENDING_TOP_SENTENCES, help="--bulk: trending sentences per survey")
+    return parser.parse_args(argv)
+
+def serve_pool_worker():
+    """Pool worker: open this process's answer cache, then handle requests one at a time"""
+    open_answer_cache()
+
+    def handle(input_data, spans, received):
+        track_queued(input_data.get('action', 'answer'), 1)
+        handle_request(input_data, spans, received)
+
+    serve_pool_requests(handle, lambda: render_prometheus(collect_stats()))
+
+def survey_affinity(input_data):
+    # Stateful trending requests of a survey always reach the worker holding its state
+    survey_id = input_data.get('survey_id')
+    return None if survey_id is None else str(survey_id)
+
+def run_pool():
+    """Serve requests from stdin with a pool of forked worker processes"""
+    # Load everything before forking so the workers share the weights
+    load_model()
+    serve_with_pool(serve_pool_worker, ACTION_PRIORITIES, 'answer', lambda: send_response({"status": "ready"}), survey_affinity)
+
 def main():
+    check_framing()
     try:
-        # Load the models once at startup
-        load_model()
-        print("Models loaded and ready for processing", file=sys.stderr)
+        if WORKER_POOL_SIZE > 1:
+            run_pool()
+            return
+
+        preload = [name.strip() for name in MODEL_PRELOAD.split(',') if name.strip() in residency.states]
+        if MODEL_WARMUP:
+            # Load and warm up before signalling ready, so the first requests already run warm
+            preload_models(preload or list(residency.states))
+            preload = []
+            print("Ready for processing, models warmed up", file=sys.stderr)
+        else:
+            # Models load lazily on the first request that needs them, so the worker is ready right away
+            print("Ready for processing, models load on first use", file=sys.stderr)
         sys.stderr.flush()
         
         # Signal initialization complete
-        print(json.dumps({"status": "ready"}))
-        sys.stdout.flush()
-        
+        send_response({"status": "ready"})
+
+        start_metrics_writer(METRICS_FILE, lambda: render_prometheus(collect_stats()))
+        open_answer_cache()
+
+        if preload:
+            threading.Thread(target=preload_models, args=(preload,), name="model-preload", daemon=True).start()
+        # Not in pool mode, where the workers share the weights loaded before forking
+        residency.start_idle_unloader()
+
+        # One executor per action, sized by its concurrency limit, so a slow
+        # generation doesn't hold up cheaper actions queued behind it
+        limits = parse_action_concurrency(ACTION_CONCURRENCY)
+        executors = {}
+        running = Counter()  # requests submitted to each executor and not finished yet
+        running_lock = threading.Lock()
+        work_queue = RequestQueue(MAX_QUEUED_REQUESTS, parse_action_priorities(ACTION_PRIORITIES))
+        answer_batcher = AnswerBatcher(on_take=work_queue.notify)
+        answer_batcher.start()
+        reader = threading.Thread(target=read_requests, args=(work_queue, 'answer'), daemon=True)
+        reader.start()
+        start_heartbeat(work_queue)
+
+        def executor_name(input_data):
+            # Streamed answers can't share a batched generate, they run on their own executor
+            action = input_data.get('action', 'answer')
+            return 'answer_stream' if action == 'answer' else action
+
+        def can_start(entry):
+            # Requests stay in the work queue, where priorities apply, until they can run
+            input_data = entry[0]
+            if input_data.get('action', 'answer') == 'answer' and not wants_stream(input_data):
+                return answer_batcher.has_room()
+            name = executor_name(input_data)
+            with running_lock:
+                return running[name] < limits.get(name, DEFAULT_ACTION_CONCURRENCY)
+
+        def finished(name):
+            with running_lock:
+                running[name] -= 1
+            work_queue.notify()
+
         # Process requests
-        for line in sys.stdin:
-            try:
-                # Parse input JSON
-                input_data = json.loads(line.strip())
-                feedbacks = input_data.get('feedbacks', {})
-                question = input_data.get('question', '')
-                action = input_data.get('action', 'answer')  # Default to answer if not specified
-                
-                if action == 'extract_trending_sentences':
-                    # Extract trending sentences
-                    sentences = extract_trending_sentences(feedbacks)
-                    result = {
-                        'sentences': sentences,
-                        'count': len(sentences)
-                    }
-                elif action == 'answer':
-                    # Default to question answering
-                    context = format_context(feedbacks)
-                    answer = answer_question(context, question)
-                    result = {
-                        'answer': answer,
-                        'context': context,
-                        'question': question
-                    }
-                
-                print(json.dumps(result))
-                sys.stdout.flush()
-                
-            except json.JSONDecodeError as e:
-                print(json.dumps({"error": f"Invalid JSON input: {str(e)}"}))
-                sys.stdout.flush()
-            except Exception as e:
-                print(json.dumps({"error": f"Error processing request: {str(e)}"}))
-                sys.stdout.flush()
+        while True:
+            entry = work_queue.get(can_start)
+            if entry is None:
+                break
+            input_data, spans, received = entry
+            action = input_data.get('action', 'answer')
+            track_queued(action, 1)
+            if action == 'answer' and not wants_stream(input_data):
+                # Batched requests extend this to when their batch takes them
+                spans['queue_wait'] = time.perf_counter() - received
+                # Cached answers go out right away instead of waiting for a batch
+                try:
+                    cached, cache_key = cached_answer_response(input_data, spans)
+                except Exception as e:
+                    # A bad request must not take the dispatcher down with it
+                    cached, cache_key = {"error": f"Error processing request: {str(e)}"}, None
+                if cached is None:
+                    answer_batcher.submit(input_data, spans, cache_key, received)
+                    continue
+                track_queued(action, -1)
+                finish_request(input_data.get('id'))
+                send_response(shape_context(cached, context_mode(input_data)), input_data.get('id'))
+                log_event('request', id=input_data.get('id'), action=action, total_seconds=time.perf_counter() - received, spans=spans)
+                continue
+            name = executor_name(input_data)
+            executor = executors.get(name)
+            if executor is None:
+                executor = executors[name] = ThreadPoolExecutor(
+                    max_workers=limits.get(name, DEFAULT_ACTION_CONCURRENCY),
+                    thread_name_prefix=f"worker-{name}"
+                )
+            with running_lock:
+                running[name] += 1
+            future = executor.submit(handle_request, input_data, spans, received)
+            future.add_done_callback(lambda _, name=name: finished(name))
+
+        # Finish in-flight requests before exiting
+        answer_batcher.close()
+        for executor in executors.values():
+            executor.shutdown(wait=True)
     except Exception as e:
-        print(json.dumps({"error": f"Fatal error: {str(e)}"}))
-        sys.stdout.flush()
+        send_response({"error": f"Fatal error: {str(e)}"})
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    if args.profile_backend:
+        print(json.dumps(profile_backend(args.profile_backend, args.repeats)))
+    elif args.compare_backends:
+        print(json.dumps(compare_backends(args.compare_backends, args.repeats), indent=2))
+    elif args.bulk:
+        print(json.dumps(run_bulk(args)))
+    else:
+        main() 
\ No newline at end of file
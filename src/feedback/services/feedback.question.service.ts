@@ -6,6 +6,15 @@ import { RedisClientType } from 'redis';
 import { Inject } from '@nestjs/common';
 import * as fs from 'fs';
 import * as path from 'path';
+import { v4 as uuidv4 } from 'uuid';
+import { WorkerOutput } from '../../worker/worker-output';
+
+interface PendingRequest {
+    resolve: (result: any) => void;
+    reject: (error: Error) => void;
+    timeoutId: NodeJS.Timeout;
+    onDelta?: (delta: string) => void;
+}
 
 @Injectable()
 export class FeedbackQuestionService {
@@ -16,6 +25,13 @@ export class FeedbackQuestionService {
     private initializationAttempts: number = 0;
     private readonly MAX_INITIALIZATION_ATTEMPTS = 3;
     private readonly MODEL_INITIALIZATION_TIMEOUT = 30000; // 30 seconds
+    private readonly QUESTION_TIMEOUT = 25000; // 25 seconds
+    private readonly pendingRequests = new Map<string, PendingRequest>();
+    private readonly workerOutput = new WorkerOutput(
+        (response) => this.handleResponse(response),
+        (line) => this.logger.warn(`Ignoring malformed Python output: ${line.substring(0, 100)}`)
+    );
+    private outputHandlerAttached: boolean = false;
 
     constructor(
         @Inject('REDIS_CLIENT') private readonly redis: RedisClientType
@@ -24,7 +40,11 @@ export class FeedbackQuestionService {
         // This prevents the service from crashing on startup if the model fails to load
     }
 
-    async getQuestionFeedbacks(feedbacks: FeedbackResponse[], prompt: string): Promise<any[]> {
+    async getQuestionFeedbacks(
+        feedbacks: FeedbackResponse[],
+        prompt: string,
+        onDelta?: (delta: string) => void
+    ): Promise<any[]> {
         try {
             // If still not initialized after attempts, return a fallback response
             if (!this.isInitialized || !this.pythonProcess) {
@@ -36,39 +56,40 @@ export class FeedbackQuestionService {
             }
 
 
-            const context = this.prepareContext(feedbacks);
-            
-            return new Promise((resolve, reject) => {
-                let responseData = '';
-                let timeoutId: NodeJS.Timeout;
-
-                const cleanup = () => {
-                    if (timeoutId) clearTimeout(timeoutId);
-                    this.pythonProcess.stdout.removeListener('data', handleOutput);
-                };
+            this.attachOutputHandler();
+            if (this.workerOutput.isFull()) {
+                // The worker would only turn the request away, don't add to its backlog
+                this.logger.warn(`Question worker queue is full (${this.workerOutput.queueDepth} waiting), shedding request`);
+                return [{
+                    question: prompt,
+                    answer: "I'm sorry, but the AI model is busy right now. Please try again in a moment."
+                }];
+            }
 
-                const handleOutput = (data: Buffer) => {
-                    responseData += data.toString();
-                    try {
-                        const result = JSON.parse(responseData);
-                        cleanup();
-                        resolve(result);
-                    } catch (e) {
-                        // Incomplete JSON, continue collecting data
-                    }
-                };
+            const context = this.prepareContext(feedbacks);
 
-                this.pythonProcess.stdout.on('data', handleOutput);
+            return new Promise((resolve, reject) => {
+                // Responses can arrive out of order, the worker echoes the ID back
+                const requestId = uuidv4();
 
-                timeoutId = setTimeout(() => {
-                    cleanup();
-                    reject(new Error('Question answering timeout'));
-                }, 25000); // 10 seconds timeout
+                this.pendingRequests.set(requestId, {
+                    resolve,
+                    reject,
+                    timeoutId: this.startTimeout(requestId, reject),
+                    onDelta
+                });
 
-                // Send the request to the Python process
+                // Send the request to the Python process, with onDelta the answer is streamed
                 const request = {
+                    id: requestId,
                     context,
-                    question: prompt
+                    question: prompt,
+                    // The worker drops the request once nobody is waiting for it
+                    timeout_ms: this.QUESTION_TIMEOUT,
+                    // Callers never read the echoed context back, its hash is enough
+                    context_mode: 'hash',
+                    // Our timer restarts on every streamed delta, so the worker's deadline does too
+                    ...(onDelta ? { stream: true, idle_timeout_ms: this.QUESTION_TIMEOUT } : {})
                 };
 
                 this.pythonProcess.stdin.write(JSON.stringify(request) + '\n');
@@ -87,6 +108,47 @@ export class FeedbackQuestionService {
         }
     }
 
+    private startTimeout(requestId: string, reject: (error: Error) => void): NodeJS.Timeout {
+        return setTimeout(() => {
+            this.pendingRequests.delete(requestId);
+            // Stop the generation instead of letting it finish for nobody
+            this.pythonProcess?.stdin.write(JSON.stringify({ action: 'cancel', target_id: requestId }) + '\n');
+            reject(new Error('Question answering timeout'));
+        }, this.QUESTION_TIMEOUT);
+    }
+
+    private attachOutputHandler(): void {
+        if (this.outputHandlerAttached) {
+            return;
+        }
+        this.pythonProcess.stdout.on('data', (data: Buffer) => this.workerOutput.push(data));
+        this.outputHandlerAttached = true;
+    }
+
+    private handleResponse(response: any): void {
+        const pending = response.id ? this.pendingRequests.get(response.id) : undefined;
+        if (!pending) {
+            // Late answer for a request that already timed out, or a status line
+            this.logger.debug('Ignoring Python response without a pending request');
+            return;
+        }
+
+        clearTimeout(pending.timeoutId);
+        if (response.done === false) {
+            // Streamed partial answer, the timeout restarts while tokens keep arriving
+            pending.timeoutId = this.startTimeout(response.id, pending.reject);
+            pending.onDelta?.(response.delta);
+            return;
+        }
+
+        this.pendingRequests.delete(response.id);
+        if (response.overloaded) {
+            pending.reject(new Error('Question worker overloaded'));
+            return;
+        }
+        pending.resolve(response);
+    }
+
     private prepareContext(feedbacks: FeedbackResponse[]): string {
         const contextParts: string[] = [];
 
@@ -0,0 +1,58 @@
+/**
+ * Parser for the stdout of the Python model workers (model_loader.py and
+ * translation-service/model_loader.py), shared by the services that spawn them.
+ *
+ * The workers write one JSON message per line. Heartbeat lines only update the
+ * worker's queue depth, every other message is handed to onMessage. The
+ * workers' FRAMING=msgpack is not supported here, spawn them with FRAMING=jsonl.
+ *
+ * translation-service builds from its own directory, its Dockerfile copies this
+ * file to translation-service/src/worker (npm run copy:worker-output in a checkout).
+ */
+export class WorkerOutput {
+    // Queue depth and limit from the worker's last heartbeat line
+    queueDepth: number = 0;
+    maxQueued: number = 0;
+    private buffer: string = '';
+
+    constructor(
+        private readonly onMessage: (message: any) => void,
+        private readonly onMalformed: (line: string) => void = () => undefined
+    ) {}
+
+    push(data: Buffer): void {
+        this.buffer += data.toString();
+
+        let newlineIndex: number;
+        while ((newlineIndex = this.buffer.indexOf('\n')) !== -1) {
+            const line = this.buffer.slice(0, newlineIndex).trim();
+            this.buffer = this.buffer.slice(newlineIndex + 1);
+            if (!line) {
+                continue;
+            }
+
+            let message: any;
+            try {
+                message = JSON.parse(line);
+            } catch (e) {
+                this.onMalformed(line);
+                continue;
+            }
+
+            if (message.status === 'heartbeat') {
+                this.queueDepth = message.queue_depth;
+                this.maxQueued = message.max_queued;
+                continue;
+            }
+            if (message.overloaded) {
+                this.queueDepth = message.queue_depth;
+            }
+            this.onMessage(message);
+        }
+    }
+
+    /** Whether the worker would only turn a new request away as overloaded */
+    isFull(): boolean {
+        return this.maxQueued > 0 && this.queueDepth >= this.maxQueued;
+    }
+}
@@ -0,0 +1,65 @@
+"""Fixtures for the Python worker tests, run with INFERENCE_BACKEND=stub so no weights are needed"""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANALYSIS_WORKER = os.path.join(REPO_ROOT, 'model_loader.py')
+TRANSLATION_WORKER = os.path.join(REPO_ROOT, 'translation-service', 'model_loader.py')
+
+# The workers read their settings when they are imported
+WORKER_ENV = {
+    'INFERENCE_BACKEND': 'stub',
+    'TRANSFORMERS_CACHE': tempfile.mkdtemp(prefix='worker-tests-'),
+    'HEARTBEAT_INTERVAL': '0',
+    'MODEL_IDLE_UNLOAD_SECONDS': '0',
+    'FRAMING': 'jsonl'
+}
+os.environ.update(WORKER_ENV)
+sys.path.insert(0, REPO_ROOT)
+
+def load_worker(path, name):
+    """Import a worker script under its own module name, both are called model_loader.py"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def analysis_worker():
+    return load_worker(ANALYSIS_WORKER, 'analysis_model_loader')
+
+@pytest.fixture(scope='session')
+def translation_worker():
+    return load_worker(TRANSLATION_WORKER, 'translation_model_loader')
+
+def run_worker(script, requests, env=None, timeout=60):
+    """Run a worker over stdin/stdout until it has answered everything, returns its output messages.
+
+    requests are dicts sent as JSON lines, or raw strings sent as they are.
+    """
+    lines = [request if isinstance(request, str) else json.dumps(request) for request in requests]
+    result = subprocess.run(
+        [sys.executable, os.path.basename(script)],
+        input=''.join(line + '\n' for line in lines),
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(script),
+        env={**os.environ, **WORKER_ENV, **(env or {})},
+        timeout=timeout
+    )
+    assert result.returncode == 0, result.stderr
+    return [json.loads(line) for line in result.stdout.splitlines() if line.strip()]
+
+def by_id(messages):
+    """Group output messages by request ID, keeping their order"""
+    grouped = {}
+    for message in messages:
+        grouped.setdefault(message.get('id'), []).append(message)
+    return grouped
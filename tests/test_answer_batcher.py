@@ -0,0 +1,52 @@
+"""AnswerBatcher: batches close on the token budget and every answer goes back to its own request"""
+import json
+
+FEEDBACKS = [{'questions': [{'question': 'How was it?', 'answer': 'The app is slow and the login keeps crashing.'}]}]
+
+def answer_request(request_id, question):
+    return {'id': request_id, 'action': 'answer', 'question': question, 'feedbacks': FEEDBACKS}
+
+def run_batcher(analysis_worker, monkeypatch, requests, **limits):
+    """Answer requests queued before the batcher starts, returning the ids of each batch"""
+    monkeypatch.setattr(analysis_worker, 'answer_cache', analysis_worker.AnswerCache())
+    batcher = analysis_worker.AnswerBatcher(window_ms=0, **limits)
+    batches = []
+    run_batch = batcher.run_batch
+    def record_batch(batch, longest):
+        batches.append([item['id'] for item in batch])
+        run_batch(batch, longest)
+    monkeypatch.setattr(batcher, 'run_batch', record_batch)
+    for request in requests:
+        batcher.submit(request)
+    batcher.start()
+    batcher.close()
+    return batches
+
+def input_tokens(analysis_worker, request):
+    context = analysis_worker.select_context(request['feedbacks'], request['question'], {})
+    return len(analysis_worker.tokenize_answer_input(context, request['question'], {}))
+
+def test_batch_closes_at_the_token_budget(analysis_worker, monkeypatch, capsys):
+    requests = [answer_request(f'r{n}', f'What is slow {n}?') for n in range(5)]
+    length = input_tokens(analysis_worker, requests[0])
+    assert all(input_tokens(analysis_worker, request) == length for request in requests)
+    batches = run_batcher(analysis_worker, monkeypatch, requests, max_batch_size=8, max_batch_tokens=2 * length)
+    assert batches == [['r0', 'r1'], ['r2', 'r3'], ['r4']]
+
+def test_batch_closes_at_the_size_limit(analysis_worker, monkeypatch, capsys):
+    requests = [answer_request(f'r{n}', f'What is slow {n}?') for n in range(5)]
+    batches = run_batcher(analysis_worker, monkeypatch, requests, max_batch_size=3, max_batch_tokens=100000)
+    assert batches == [['r0', 'r1', 'r2'], ['r3', 'r4']]
+
+def test_each_request_gets_its_own_answer(analysis_worker, monkeypatch, capsys):
+    questions = {'a': 'What is slow?', 'b': 'What keeps crashing?', 'c': 'Is the login broken?'}
+    requests = [answer_request(request_id, question) for request_id, question in questions.items()]
+    requests.append(answer_request('empty', ''))
+    batches = run_batcher(analysis_worker, monkeypatch, requests, max_batch_size=8, max_batch_tokens=100000)
+    assert batches == [['a', 'b', 'c', 'empty']]
+    responses = {response['id']: response for response in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert set(responses) == {'a', 'b', 'c', 'empty'}
+    for request_id, question in questions.items():
+        assert responses[request_id]['question'] == question
+        assert responses[request_id]['answer'].endswith(f'Question: {question}')
+    assert responses['empty']['answer'] == 'No context or question provided'
@@ -0,0 +1,37 @@
+"""AnswerCache keying and the cache lookup every answer request goes through"""
+import pytest
+
+FEEDBACKS = [{'questions': [{'question': 'How was it?', 'answer': 'The app is slow.'}]}]
+
+def test_key_ignores_whitespace_in_the_question(analysis_worker):
+    make_key = analysis_worker.AnswerCache.make_key
+    assert make_key(FEEDBACKS, 'What is  slow?\n') == make_key(FEEDBACKS, ' What is slow?')
+
+def test_key_depends_on_feedbacks_and_question(analysis_worker):
+    make_key = analysis_worker.AnswerCache.make_key
+    other_feedbacks = [{'questions': [{'question': 'How was it?', 'answer': 'The app is fast.'}]}]
+    keys = {make_key(FEEDBACKS, 'What is slow?'), make_key(FEEDBACKS, 'What is fast?'), make_key(other_feedbacks, 'What is slow?')}
+    assert len(keys) == 3
+
+def test_key_depends_on_backend_and_precision(analysis_worker, monkeypatch):
+    make_key = analysis_worker.AnswerCache.make_key
+    stub_key = make_key(FEEDBACKS, 'What is slow?')
+    monkeypatch.setattr(analysis_worker, 'INFERENCE_BACKEND', 'pytorch')
+    pytorch_key = make_key(FEEDBACKS, 'What is slow?')
+    monkeypatch.setattr(analysis_worker, 'MODEL_DTYPE', 'bfloat16')
+    assert len({stub_key, pytorch_key, make_key(FEEDBACKS, 'What is slow?')}) == 3
+
+def test_cached_answer_keeps_its_context(analysis_worker, monkeypatch):
+    cache = analysis_worker.AnswerCache()
+    monkeypatch.setattr(analysis_worker, 'answer_cache', cache)
+    request = {'question': 'What is slow?', 'feedbacks': FEEDBACKS}
+    cached, key = analysis_worker.cached_answer_response(request)
+    assert cached is None
+    cache.put(key, 'The app', 'Q: How was it?\nA: The app is slow.')
+    cached, _ = analysis_worker.cached_answer_response(request)
+    assert (cached['answer'], cached['context']) == ('The app', 'Q: How was it?\nA: The app is slow.')
+    assert cached['cache']['tier'] == 'memory'
+
+def test_question_must_be_a_string(analysis_worker):
+    with pytest.raises(ValueError):
+        analysis_worker.cached_answer_response({'question': 123, 'feedbacks': FEEDBACKS})
@@ -0,0 +1,49 @@
+"""BM25 context selection: the most relevant feedback parts that fit the answer model input"""
+from collections import Counter, OrderedDict
+
+import pytest
+
+PARTS = [
+    'Q: How was it?\nA: The dashboard looks nice.',
+    'Q: How was it?\nA: Export to CSV fails with large files.',
+    'Q: Anything else?\nA: Support answered quickly.',
+    'Q: Anything else?\nA: The CSV export also drops the header row of the export.'
+]
+
+@pytest.fixture
+def fresh_index_cache(analysis_worker, monkeypatch):
+    monkeypatch.setattr(analysis_worker, 'context_index_cache', OrderedDict())
+    monkeypatch.setattr(analysis_worker, 'context_index_stats', Counter())
+
+def test_best_matching_parts_fill_the_budget_in_survey_order(analysis_worker):
+    index = analysis_worker.ContextIndex(PARTS, [10, 10, 10, 10])
+    scores = index.scores('Why does CSV export fail?')
+    assert scores[0] == scores[2] == 0
+    assert scores[3] > 0 and scores[1] > 0
+    assert index.select('Why does CSV export fail?', 20) == [1, 3]
+    # Unmatched parts still fill what the matching ones leave
+    assert index.select('Why does CSV export fail?', 30) == [0, 1, 3]
+    assert index.select('Why does CSV export fail?', 40) == [0, 1, 2, 3]
+
+def test_parts_over_the_budget_are_skipped(analysis_worker):
+    index = analysis_worker.ContextIndex(PARTS, [10, 30, 10, 10])
+    assert index.select('Why does CSV export fail?', 25) == [0, 3]
+
+def test_select_context_keeps_the_relevant_parts(analysis_worker, monkeypatch, fresh_index_cache):
+    feedbacks = list(PARTS)
+    assert analysis_worker.select_context(feedbacks, 'How was it?') == '\n\n'.join(PARTS)
+    index = analysis_worker.get_context_index(feedbacks)
+    prompt = len(analysis_worker.tokenizer('Context: \nQuestion: Does CSV export work?')['input_ids'])
+    monkeypatch.setattr(analysis_worker, 'MAX_INPUT_TOKENS', prompt + index.token_lengths[1] + index.token_lengths[3])
+    spans = {}
+    context = analysis_worker.select_context(feedbacks, 'Does CSV export work?', spans)
+    assert context == '\n\n'.join([PARTS[1], PARTS[3]])
+    assert spans['context_parts'] == [2, 4]
+
+def test_index_is_reused_for_the_same_feedbacks(analysis_worker, fresh_index_cache):
+    feedbacks = list(PARTS)
+    first = analysis_worker.get_context_index(feedbacks)
+    assert analysis_worker.get_context_index(list(PARTS)) is first
+    analysis_worker.get_context_index(PARTS[:2])
+    assert analysis_worker.context_index_stats == {'hits': 1, 'misses': 2}
+    assert len(analysis_worker.context_index_cache) == 2
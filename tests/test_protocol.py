@@ -0,0 +1,119 @@
+"""Request/response protocol of both workers over stdin/stdout, with the stub backend"""
+import pytest
+
+import worker_common
+from conftest import ANALYSIS_WORKER, TRANSLATION_WORKER, by_id, run_worker
+
+FEEDBACKS = [{'questions': [{'question': 'How was it?', 'answer': 'The app is slow and the login keeps crashing.'}]}]
+
+def test_analysis_worker_signals_ready_first():
+    messages = run_worker(ANALYSIS_WORKER, [{'id': 1, 'action': 'stats'}])
+    assert messages[0] == {'status': 'ready'}
+
+def test_answer_echoes_request_id():
+    responses = by_id(run_worker(ANALYSIS_WORKER, [
+        {'id': 'a', 'action': 'answer', 'question': 'What is slow?', 'feedbacks': FEEDBACKS},
+        {'id': 'b', 'action': 'answer', 'question': 'What crashes?', 'feedbacks': FEEDBACKS}
+    ]))
+    assert responses['a'][0]['question'] == 'What is slow?'
+    assert responses['b'][0]['question'] == 'What crashes?'
+    assert 'error' not in responses['a'][0]
+
+def test_invalid_input_is_answered_without_stopping_the_worker():
+    for script in (ANALYSIS_WORKER, TRANSLATION_WORKER):
+        messages = run_worker(script, ['not json', '[1, 2]', {'id': 'after', 'action': 'stats'}])
+        errors = [message['error'] for message in messages if 'error' in message]
+        assert errors[0].startswith('Invalid JSON input')
+        assert 'Request must be a JSON object' in errors[1]
+        assert any(message.get('id') == 'after' for message in messages)
+
+def test_cancel_of_unknown_request():
+    for script in (ANALYSIS_WORKER, TRANSLATION_WORKER):
+        responses = by_id(run_worker(script, [{'id': 'c', 'action': 'cancel', 'target_id': 'missing'}]))
+        assert responses['c'] == [{'id': 'c', 'cancelled': False, 'target_id': 'missing'}]
+
+def test_expired_request_is_stopped():
+    responses = by_id(run_worker(TRANSLATION_WORKER, [{'id': 't', 'text': 'too late', 'deadline': 1}]))
+    assert responses['t'][0]['stopped'] == 'deadline_exceeded'
+
+def test_streamed_answer_deltas_add_up_to_the_final_answer():
+    responses = by_id(run_worker(ANALYSIS_WORKER, [
+        {'id': 's', 'action': 'answer', 'question': 'What is slow?', 'feedbacks': FEEDBACKS, 'stream': True}
+    ]))
+    lines = responses['s']
+    assert [line['seq'] for line in lines] == list(range(len(lines)))
+    assert all(line['done'] is False for line in lines[:-1])
+    assert lines[-1]['done'] is True
+    assert ''.join(line['delta'] for line in lines[:-1]).strip() == lines[-1]['answer']
+
+def test_translate_and_batch_keep_their_inputs():
+    responses = by_id(run_worker(TRANSLATION_WORKER, [
+        {'id': 1, 'text': 'hello world', 'source_lang': 'en', 'target_lang': 'de'},
+        {'id': 2, 'action': 'translate_batch', 'items': [
+            {'text': 'first text', 'target_lang': 'fr'},
+            {'text': 'second text', 'target_lang': 'es'}
+        ]}
+    ]))
+    assert responses[1][0] == {'id': 1, 'translation': 'hello world', 'source_lang': 'en', 'target_lang': 'de'}
+    batch = responses[2][0]
+    assert batch['count'] == 2
+    assert batch['translations'] == ['first text', 'second text']
+
+def test_streamed_translation():
+    responses = by_id(run_worker(TRANSLATION_WORKER, [{'id': 's', 'text': 'one two three', 'stream': True}]))
+    lines = responses['s']
+    assert lines[-1]['done'] is True
+    assert ''.join(line['delta'] for line in lines[:-1]).strip() == lines[-1]['translation'] == 'one two three'
+
+def test_stats_report_the_queue():
+    for script in (ANALYSIS_WORKER, TRANSLATION_WORKER):
+        stats = by_id(run_worker(script, [{'id': 'stats', 'action': 'stats'}]))['stats'][0]
+        assert stats['max_queued'] > 0
+        assert 'stages' in stats
+
+def test_pool_stats_merge_every_worker():
+    for script in (ANALYSIS_WORKER, TRANSLATION_WORKER):
+        request = {'id': 'a', 'action': 'answer', 'question': 'What is slow?', 'feedbacks': FEEDBACKS}
+        if script == TRANSLATION_WORKER:
+            request = {'id': 'a', 'text': 'one two three'}
+        responses = by_id(run_worker(script, [request, {**request, 'id': 'b'}, {'id': 'stats', 'action': 'stats'}],
+                                     env={'WORKER_POOL_SIZE': '2'}))
+        stats = responses['stats'][0]
+        assert stats['pool_size'] == 2
+        assert len({worker['pid'] for worker in stats['workers']}) == 2
+        assert stats['stages']['parse']['count'] == sum(worker['stages']['parse']['count'] for worker in stats['workers'])
+
+def test_non_string_question_is_answered_with_an_error():
+    responses = by_id(run_worker(ANALYSIS_WORKER, [
+        {'id': 'bad', 'action': 'answer', 'question': 123, 'feedbacks': FEEDBACKS},
+        {'id': 'good', 'action': 'answer', 'question': 'What is slow?', 'feedbacks': FEEDBACKS}
+    ]))
+    assert 'question must be a string' in responses['bad'][0]['error']
+    assert 'error' not in responses['good'][0]
+
+def test_request_ids_must_be_plain_values():
+    for script in (ANALYSIS_WORKER, TRANSLATION_WORKER):
+        messages = run_worker(script, [{'id': [1], 'action': 'stats'}, {'id': True, 'action': 'stats'}, {'id': 'after', 'action': 'stats'}])
+        errors = [message for message in messages if 'error' in message]
+        assert [message['id'] for message in errors] == [[1], True]
+        assert all(message['error'] == 'Request id must be a string or an integer' for message in errors)
+        assert any(message.get('id') == 'after' for message in messages)
+
+def test_ids_in_flight_are_not_registered_twice():
+    control = worker_common.register_request({'id': 'twice'})
+    try:
+        with pytest.raises(ValueError):
+            worker_common.register_request({'id': 'twice'})
+        assert worker_common.get_request_control('twice') is control
+    finally:
+        worker_common.finish_request('twice')
+
+@pytest.mark.parametrize('framing', ['jsonl', 'msgpack'])
+def test_partial_messages_are_told_apart_without_decoding(monkeypatch, framing):
+    if framing == 'msgpack':
+        pytest.importorskip('msgpack')
+    monkeypatch.setattr(worker_common, 'FRAMING', framing)
+    partial = worker_common.encode_message({'id': 'a', 'seq': 0, 'delta': 'done', 'done': False})
+    final = worker_common.encode_message({'id': 'a', 'seq': 1, 'done': True, 'answer': 'done'})
+    assert worker_common.is_partial_message(partial)
+    assert not worker_common.is_partial_message(final)
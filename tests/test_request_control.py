@@ -0,0 +1,59 @@
+"""Cancellation and deadlines while answers generate, with the stub backend"""
+import json
+import time
+
+import worker_common
+
+FEEDBACKS = [{'questions': [{'question': 'How was it?', 'answer': 'The app is slow and the login keeps crashing.'}]}]
+
+def test_stopping_criteria_need_a_control_for_every_request():
+    first, second = worker_common.RequestControl('a'), worker_common.RequestControl('b')
+    assert worker_common.stopping_criteria([first, None]) is None
+    assert worker_common.stopping_criteria([]) is None
+    (criteria,) = worker_common.stopping_criteria([first, second])
+    first.cancelled.set()
+    assert not criteria(None, None)
+    second.deadline = time.time() - 1
+    assert criteria(None, None)
+
+def prepare_batch(analysis_worker, monkeypatch, requests):
+    """Prepare answer requests for one batch the way the batcher thread does"""
+    cache = analysis_worker.AnswerCache()
+    monkeypatch.setattr(analysis_worker, 'answer_cache', cache)
+    batcher = analysis_worker.AnswerBatcher(window_ms=0)
+    batch = []
+    for request in requests:
+        worker_common.register_request(request)
+        _, cache_key = analysis_worker.cached_answer_response(request)
+        batch.append(batcher.prepare((time.perf_counter(), request, {}, cache_key)))
+    return batcher, batch, cache
+
+def answer_request(request_id, question):
+    return {'id': request_id, 'action': 'answer', 'question': question, 'feedbacks': FEEDBACKS}
+
+def test_request_without_control_keeps_its_whole_answer(analysis_worker, monkeypatch, capsys):
+    batcher, batch, _ = prepare_batch(analysis_worker, monkeypatch, [
+        answer_request('cancelled', 'What is slow?'),
+        answer_request(None, 'What crashes?')
+    ])
+    # Cancelled once the batch has formed, while it generates
+    worker_common.cancel_request('cancelled')
+    batcher.run_batch(batch, max(len(item['input_ids']) for item in batch))
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    unnamed = next(response for response in responses if 'id' not in response)
+    assert unnamed['answer'].endswith('Question: What crashes?')
+    cached = analysis_worker.cached_answer_response(answer_request(None, 'What crashes?'))[0]
+    assert cached['answer'] == unnamed['answer']
+
+def test_batch_stops_once_every_request_stopped(analysis_worker, monkeypatch, capsys):
+    batcher, batch, cache = prepare_batch(analysis_worker, monkeypatch, [
+        answer_request('cancelled', 'What is slow?'),
+        answer_request('expired', 'What crashes?')
+    ])
+    worker_common.cancel_request('cancelled')
+    worker_common.get_request_control('expired').deadline = time.time() - 1
+    batcher.run_batch(batch, max(len(item['input_ids']) for item in batch))
+    responses = {response['id']: response for response in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert responses['cancelled']['stopped'] == 'cancelled'
+    assert responses['expired']['stopped'] == 'deadline_exceeded'
+    assert cache.get_stats()['writes'] == 0
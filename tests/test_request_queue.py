@@ -0,0 +1,45 @@
+"""RequestQueue admission control: priority order, eviction when full and overloaded replies"""
+import json
+
+import worker_common
+
+PRIORITIES = {'answer': 0, 'extract_trending_sentences': 1}
+
+def entry(request_id, action):
+    return ({'id': request_id, 'action': action},)
+
+def test_lower_priorities_start_first_then_by_arrival():
+    work_queue = worker_common.RequestQueue(0, PRIORITIES)
+    for request_id, action in [('t1', 'extract_trending_sentences'), ('a1', 'answer'), ('t2', 'extract_trending_sentences'), ('a2', 'answer')]:
+        assert work_queue.put(entry(request_id, action), action) is None
+    work_queue.close()
+    order = []
+    while (taken := work_queue.get()) is not None:
+        order.append(taken[0]['id'])
+    assert order == ['a1', 'a2', 't1', 't2']
+
+def test_full_queue_evicts_the_newest_lower_priority_request():
+    work_queue = worker_common.RequestQueue(2, PRIORITIES)
+    work_queue.put(entry('t1', 'extract_trending_sentences'), 'extract_trending_sentences')
+    work_queue.put(entry('t2', 'extract_trending_sentences'), 'extract_trending_sentences')
+    assert work_queue.put(entry('a1', 'answer'), 'answer')[0]['id'] == 't2'
+    assert work_queue.depth() == {'answer': 1, 'extract_trending_sentences': 1}
+
+def test_full_queue_turns_away_requests_of_the_same_or_lower_priority():
+    work_queue = worker_common.RequestQueue(1, PRIORITIES)
+    work_queue.put(entry('a1', 'answer'), 'answer')
+    assert work_queue.put(entry('a2', 'answer'), 'answer')[0]['id'] == 'a2'
+    assert work_queue.put(entry('t1', 'extract_trending_sentences'), 'extract_trending_sentences')[0]['id'] == 't1'
+    assert work_queue.queued('a1') and not work_queue.queued('a2')
+    # Unknown actions get the default priority
+    assert work_queue.put(entry('x', 'other'), 'other')[0]['id'] == 'x'
+
+def test_overloaded_reply(monkeypatch, capsys):
+    monkeypatch.setattr(worker_common, 'overloaded_counts', worker_common.Counter())
+    work_queue = worker_common.RequestQueue(1, PRIORITIES)
+    work_queue.put(entry('a1', 'answer'), 'answer')
+    rejected = work_queue.put(entry('t1', 'extract_trending_sentences'), 'extract_trending_sentences')
+    worker_common.reject_overloaded(rejected[0], work_queue, 'answer')
+    (response,) = map(json.loads, capsys.readouterr().out.splitlines())
+    assert response == {'id': 't1', 'error': 'Worker overloaded, try again later', 'overloaded': True, 'queue_depth': 1}
+    assert worker_common.overloaded_counts == {'extract_trending_sentences': 1}
@@ -0,0 +1,61 @@
+"""split_segments: long texts split at sentence boundaries and joined back in order"""
+import pytest
+
+SENTENCES = [
+    'The first sentence is short.',
+    'The second one has a few more words in it!',
+    'Is the third a question?',
+    'The fourth sentence ends the paragraph.'
+]
+
+@pytest.fixture
+def tokenizer(translation_worker):
+    # The stub tokenizer counts one token per word
+    return translation_worker.StubTokenizer()
+
+def rejoin(segments):
+    return ''.join(segment + separator for segment, separator in segments)
+
+def test_short_text_is_one_segment(translation_worker, tokenizer):
+    assert translation_worker.split_segments(tokenizer, 'Just one sentence.', 50) == [('Just one sentence.', '')]
+
+@pytest.mark.parametrize('max_tokens', [3, 8, 12, 20, 100])
+def test_segments_rejoin_to_the_text(translation_worker, tokenizer, max_tokens):
+    text = ' '.join(SENTENCES) + '\n\n' + ' '.join(reversed(SENTENCES)) + '\nLast line'
+    segments = translation_worker.split_segments(tokenizer, text, max_tokens)
+    assert rejoin(segments) == text
+    budget = max(1, max_tokens - 2)
+    assert all(translation_worker.token_count(tokenizer, segment) <= budget for segment, _ in segments)
+
+def test_sentences_are_packed_until_the_budget(translation_worker, tokenizer):
+    segments = translation_worker.split_segments(tokenizer, ' '.join(SENTENCES), 16)
+    # A budget of 14 tokens: 5 + 10 and 10 + 5 words don't fit together, 5 + 6 do
+    assert [segment for segment, _ in segments] == [SENTENCES[0], SENTENCES[1], ' '.join(SENTENCES[2:])]
+
+def test_line_breaks_always_end_a_segment(translation_worker, tokenizer):
+    segments = translation_worker.split_segments(tokenizer, 'One.\nTwo.\n\nThree.', 100)
+    assert segments == [('One.', '\n'), ('Two.', '\n\n'), ('Three.', '')]
+
+def test_whitespace_between_sentences_is_kept(translation_worker, tokenizer):
+    segments = translation_worker.split_segments(tokenizer, '  First one.    Second one.\tThird one.  ', 4)
+    assert segments == [('First one.', '    '), ('Second one.', '\t'), ('Third one.', '')]
+
+def test_full_width_punctuation_ends_a_sentence(translation_worker, tokenizer):
+    text = '今天天气很好。我们去公园吧！你来吗？ 好的。'
+    segments = translation_worker.split_segments(tokenizer, text, 3)
+    assert segments == [('今天天气很好。', ''), ('我们去公园吧！', ''), ('你来吗？', ' '), ('好的。', '')]
+
+class CharTokenizer:
+    """One token per character, so a text without spaces can be over budget"""
+
+    def __call__(self, text, add_special_tokens=False):
+        return {'input_ids': [ord(character) for character in text]}
+
+    def decode(self, input_ids, skip_special_tokens=True):
+        return ''.join(map(chr, input_ids))
+
+def test_words_over_budget_are_split_into_token_windows(translation_worker):
+    text = '今天天气很好我们去公园吧 你来吗'
+    segments = translation_worker.split_segments(CharTokenizer(), text, 6)
+    assert rejoin(segments) == text
+    assert [segment for segment, _ in segments] == ['今天天气', '很好我们', '去公园吧', '你来吗']
@@ -0,0 +1,86 @@
+"""TranslationMemory keying, LRU bound and SQLite tier"""
+import json
+import time
+
+def test_key_ignores_whitespace_differences(translation_worker):
+    make_key = translation_worker.TranslationMemory.make_key
+    assert make_key('hello   world\n', 'en', 'fr') == make_key(' hello world', 'en', 'fr')
+
+def test_key_depends_on_language_pair(translation_worker):
+    make_key = translation_worker.TranslationMemory.make_key
+    keys = {make_key('hello', 'en', 'fr'), make_key('hello', 'en', 'de'), make_key('hello', 'de', 'fr')}
+    assert len(keys) == 3
+
+def test_key_depends_on_backend_and_precision(translation_worker, monkeypatch):
+    make_key = translation_worker.TranslationMemory.make_key
+    stub_key = make_key('hello', 'en', 'fr')
+    monkeypatch.setattr(translation_worker, 'INFERENCE_BACKEND', 'pytorch')
+    pytorch_key = make_key('hello', 'en', 'fr')
+    monkeypatch.setattr(translation_worker, 'MODEL_DTYPE', 'bfloat16')
+    bfloat16_key = make_key('hello', 'en', 'fr')
+    assert len({stub_key, pytorch_key, bfloat16_key}) == 3
+
+def test_key_depends_on_generation_settings(translation_worker, monkeypatch):
+    make_key = translation_worker.TranslationMemory.make_key
+    default_key = make_key('hello', 'en', 'fr')
+    monkeypatch.setitem(translation_worker.TRANSLATION_GENERATION_KWARGS, 'num_beams', 4)
+    assert make_key('hello', 'en', 'fr') != default_key
+
+def test_memory_tier_drops_least_recently_used(translation_worker):
+    memory = translation_worker.TranslationMemory(max_entries=2)
+    memory.put('one', 'en', 'fr', 'un')
+    memory.put('two', 'en', 'fr', 'deux')
+    assert memory.get('one', 'en', 'fr') == 'un'
+    memory.put('three', 'en', 'fr', 'trois')
+    assert memory.get('two', 'en', 'fr') is None
+    assert memory.get('one', 'en', 'fr') == 'un'
+    assert memory.get_stats()['memory_entries'] == 2
+
+def test_disk_tier_outlives_the_process_cache(translation_worker, tmp_path):
+    path = str(tmp_path / 'memory.sqlite3')
+    translation_worker.TranslationMemory(path).put('hello', 'en', 'fr', 'bonjour')
+    memory = translation_worker.TranslationMemory(path)
+    assert memory.get('hello', 'en', 'fr') == 'bonjour'
+    assert memory.get('hello', 'en', 'fr') == 'bonjour'
+    stats = memory.get_stats()
+    assert (stats['disk_hits'], stats['memory_hits']) == (1, 1)
+
+def test_stub_backend_keeps_no_translation_memory(translation_worker):
+    translation_worker.open_translation_memory()
+    assert translation_worker.translation_memory is None
+
+def test_disk_tier_keeps_the_newest_rows(translation_worker, tmp_path, monkeypatch):
+    monkeypatch.setattr(translation_worker.TranslationMemory, 'DISK_TRIM_INTERVAL', 1)
+    path = str(tmp_path / 'memory.sqlite3')
+    memory = translation_worker.TranslationMemory(path, max_disk_entries=2)
+    for text, translation in [('one', 'un'), ('two', 'deux'), ('three', 'trois')]:
+        memory.put(text, 'en', 'fr', translation)
+        time.sleep(0.01)
+    assert memory.get_stats()['disk_evictions'] == 1
+    reopened = translation_worker.TranslationMemory(path)
+    assert reopened.get('one', 'en', 'fr') is None
+    assert reopened.get('three', 'en', 'fr') == 'trois'
+
+def test_size_zero_disables_the_memory(translation_worker, monkeypatch):
+    monkeypatch.setattr(translation_worker, 'INFERENCE_BACKEND', 'pytorch')
+    monkeypatch.setattr(translation_worker, 'TRANSLATION_MEMORY_SIZE', 0)
+    translation_worker.open_translation_memory()
+    assert translation_worker.translation_memory is None
+    assert translation_worker.TranslationMemory(max_entries=0).max_entries == 0
+
+def test_memory_hits_are_answered_without_the_model(translation_worker, monkeypatch, capsys):
+    memory = translation_worker.TranslationMemory()
+    memory.put('hello', 'en', 'fr', 'bonjour')
+    monkeypatch.setattr(translation_worker, 'translation_memory', memory)
+
+    def unloaded(name):
+        raise AssertionError('the model was loaded')
+
+    monkeypatch.setattr(translation_worker.residency, 'using', unloaded)
+    translation_worker.handle_resident_request({'id': 1, 'text': 'hello'})
+    translation_worker.handle_resident_request({'id': 2, 'action': 'translate_batch', 'items': [{'text': 'hello'}, {'text': ' '}]})
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert responses[0]['translation'] == 'bonjour'
+    assert responses[1]['translations'] == ['bonjour', ' ']
+    assert memory.get_stats()['memory_hits'] == 2
+    assert not translation_worker.in_translation_memory({'text': 'goodbye'})
@@ -0,0 +1,121 @@
+"""TrendingState: incremental grouping and eviction of feedbacks that leave the time window"""
+import pickle
+import random
+import time
+
+def add(state, key, timestamp, *sentences, sentiment='negative', question='q'):
+    state.add_scored(key, timestamp, [
+        (sentence, sentence.lower().rstrip('.'), sentiment, question) for sentence in sentences
+    ])
+
+def test_eviction_drops_old_feedbacks_and_empty_groups(analysis_worker):
+    state = analysis_worker.TrendingState()
+    add(state, 'old', 100, 'The app is slow.', 'Login is broken.')
+    add(state, 'new', 200, 'The app is slow.')
+    assert state.evict_before(150) == 1
+    assert set(state.feedbacks) == {'new'}
+    assert [group['representative'] for group in state.groups.values()] == ['The app is slow.']
+    assert state.evict_before(150) == 0
+
+def test_eviction_promotes_the_oldest_remaining_sentence(analysis_worker):
+    state = analysis_worker.TrendingState()
+    add(state, 'a', 100, 'The app is slow.', question='first')
+    add(state, 'b', 200, 'The app is so slow.', question='second')
+    add(state, 'c', 300, 'The app is so slow.', question='second')
+    (group,) = state.groups.values()
+    assert group['representative'] == 'The app is slow.'
+    state.evict_before(150)
+    assert group['representative'] == 'The app is so slow.'
+    assert group['cleaned'] == 'the app is so slow'
+    assert dict(group['questions']) == {'second': 2}
+    assert state.top() == [{'text': 'The app is so slow.', 'sentiment': 'negative', 'count': 2, 'questions': ['second']}]
+
+def test_eviction_forgets_matches_of_sentences_that_left(analysis_worker):
+    state = analysis_worker.TrendingState()
+    add(state, 'a', 100, 'Export is slow.')
+    add(state, 'b', 200, 'Export is too slow.')
+    state.evict_before(150)
+    assert set(state.matched_groups) == {('negative', 'export is too slow')}
+    state.evict_before(250)
+    assert state.groups == {} and state.matched_groups == {} and state.expiry == []
+
+def test_matches_are_kept_per_sentiment(analysis_worker):
+    state = analysis_worker.TrendingState()
+    add(state, 'a', 100, 'It is fine.', sentiment='neutral')
+    add(state, 'b', 100, 'It is fine.', sentiment='positive')
+    assert len(state.groups) == 2
+
+def test_refresh_evicts_feedbacks_outside_the_window(analysis_worker):
+    state = analysis_worker.TrendingState()
+    now = time.time()
+    day = 24 * 60 * 60
+    feedbacks = {
+        '1': {'question': 'q', 'answer': 'The app is slow.', 'created_at': now - 3 * day},
+        '2': {'question': 'q', 'answer': 'The app is slow.', 'created_at': now - day},
+        '3': {'question': 'q', 'answer': 'The app is slow.', 'created_at': now}
+    }
+    sentences, _ = analysis_worker.refresh_trending_state(state, feedbacks, time_window_days=7)
+    assert sentences[0]['count'] == 3
+    sentences, window = analysis_worker.refresh_trending_state(state, {}, time_window_days=2)
+    assert sentences[0]['count'] == 2
+    assert window['evicted'] == 1
+    # Feedbacks already outside the window are never added
+    late = {'4': {'answer': 'The app is slow.', 'created_at': now - 5 * day}}
+    _, window = analysis_worker.refresh_trending_state(state, late, time_window_days=2)
+    assert window['added'] == 0
+
+def test_least_recently_used_surveys_are_dropped(analysis_worker, monkeypatch):
+    monkeypatch.setattr(analysis_worker, 'TRENDING_STATE_SURVEYS', 2)
+    monkeypatch.setattr(analysis_worker, 'trending_states', analysis_worker.OrderedDict())
+    first, created = analysis_worker.get_trending_state('a')
+    assert created
+    analysis_worker.get_trending_state('b')
+    assert analysis_worker.get_trending_state('a') == (first, False)
+    analysis_worker.get_trending_state('c')
+    assert list(analysis_worker.trending_states) == ['a', 'c']
+    assert analysis_worker.get_trending_state('b')[1]
+    assert analysis_worker.get_trending_state('a', reset=True)[0] is not first
+
+def test_compact_state_keeps_counts_only(analysis_worker):
+    full, compact = analysis_worker.TrendingState(), analysis_worker.TrendingState(compact=True)
+    for state in (full, compact):
+        add(state, 'a', 100, 'The app is slow.', 'Login is broken.')
+        add(state, 'b', 200, 'The app is so slow.', question='other')
+        add(state, 'c', 300, 'Login is broken.')
+    assert compact.top() == full.top()
+    assert all('members' not in group for group in compact.groups.values())
+    assert compact.expiry == [] and set(compact.feedbacks) == {'a', 'b', 'c'}
+    # The match memo is only a shortcut, checkpoints leave it out
+    restored = pickle.loads(pickle.dumps(compact))
+    assert restored.matched_groups == {}
+    add(restored, 'd', 400, 'The app is slow.')
+    assert restored.top()[0]['count'] == 3
+
+def brute_force_top(analysis_worker, scored, limit=10):
+    """Group every sentence against every earlier group, like the grouping loop before the n-gram index"""
+    groups = []
+    for sentence, cleaned, sentiment, question in scored:
+        for group in groups:
+            if group['sentiment'] == sentiment and analysis_worker.are_cleaned_sentences_similar(cleaned, group['cleaned']):
+                break
+        else:
+            group = {'text': sentence, 'cleaned': cleaned, 'sentiment': sentiment, 'count': 0, 'questions': {}}
+            groups.append(group)
+        group['count'] += 1
+        group['questions'][question] = None
+    top = sorted((group for group in groups if group['count'] > 1), key=lambda group: -group['count'])[:limit]
+    return [{'text': g['text'], 'sentiment': g['sentiment'], 'count': g['count'], 'questions': list(g['questions'])} for g in top]
+
+def test_indexed_grouping_matches_comparing_every_group(analysis_worker):
+    rng = random.Random(7)
+    subjects = ['the app', 'login', 'the export', 'support', 'the dashboard', 'search', 'it', 'ui']
+    verbs = ['is slow', 'is so slow', 'keeps crashing', 'crashes a lot', 'is great', 'is very good', 'is ok', 'works']
+    extras = ['', ' on my phone', ' today', ' again', ' for me']
+    scored = []
+    for _ in range(600):
+        sentence = f"{rng.choice(subjects)} {rng.choice(verbs)}{rng.choice(extras)}.".capitalize()
+        scored.append((sentence, analysis_worker.clean_sentence(sentence), rng.choice(['positive', 'negative']), rng.choice('qr')))
+    state = analysis_worker.TrendingState()
+    for position in range(0, len(scored), 3):
+        state.add_scored(str(position), 100, scored[position:position + 3])
+    assert state.top() == brute_force_top(analysis_worker, scored)
@@ -0,0 +1,12 @@
+// Copies the worker output parser shared with the main service into src/worker.
+// The image build copies it there itself, so outside a checkout this does nothing.
+const fs = require('fs');
+const path = require('path');
+
+const source = path.join(__dirname, '..', 'src', 'worker', 'worker-output.ts');
+const target = path.join(__dirname, 'src', 'worker', 'worker-output.ts');
+
+if (fs.existsSync(source)) {
+    fs.mkdirSync(path.dirname(target), { recursive: true });
+    fs.copyFileSync(source, target);
+}
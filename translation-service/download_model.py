@@ -1,4 +1,5 @@
 import os
+import argparse
 import logging
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, pipeline
 
@@ -65,7 +66,42 @@ class TranslationService:
             logger.error(f"Translation failed for text '{text}': {str(error)}")
             raise
 
-def main():
+# Models served by the analysis and translation workers, by short name
+EXPORTABLE_MODELS = {
+    "m2m100": ("facebook/m2m100_418M", "seq2seq"),
+    "bart": ("facebook/bart-large-cnn", "seq2seq"),
+    "sentiment": ("distilbert-base-uncased-finetuned-sst-2-english", "sequence-classification"),
+}
+
+def export_onnx(model_name, task, output_dir, cache_dir="./models", quantize=False):
+    """Export a model to ONNX Runtime graphs, optionally with int8 dynamic quantization"""
+    # Optional dependency, only needed to build the ONNX backend
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    model_class = ORTModelForSeq2SeqLM if task == "seq2seq" else ORTModelForSequenceClassification
+    logger.info(f"Exporting {model_name} to ONNX in {output_dir}...")
+    model = model_class.from_pretrained(model_name, export=True, cache_dir=cache_dir)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir).save_pretrained(output_dir)
+
+    if quantize:
+        # Seq2seq exports have separate encoder/decoder graphs, quantize each in place
+        quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        for file_name in sorted(os.listdir(output_dir)):
+            if not file_name.endswith(".onnx"):
+                continue
+            logger.info(f"Quantizing {file_name}...")
+            quantizer = ORTQuantizer.from_pretrained(output_dir, file_name=file_name)
+            quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+            os.replace(
+                os.path.join(output_dir, file_name.replace(".onnx", "_quantized.onnx")),
+                os.path.join(output_dir, file_name)
+            )
+
+    logger.info(f"Exported {model_name} to {output_dir}")
+
+def demo():
     # Example usage
     translator = TranslationService()
     
@@ -84,5 +120,36 @@ def main():
         except Exception as e:
             print(f"Error translating '{text}': {str(e)}")
 
+def main():
+    parser = argparse.ArgumentParser(description="Download, test and export the translation models")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("download", help="Download the model and run example translations (default)")
+    export_parser = subparsers.add_parser("export", help="Export models to ONNX for INFERENCE_BACKEND=onnx")
+    export_parser.add_argument("models", nargs="*", metavar="MODEL",
+                               help=f"Models to export: {', '.join(sorted(EXPORTABLE_MODELS))} (default: m2m100)")
+    export_parser.add_argument("--cache-dir", default=os.getenv("TRANSFORMERS_CACHE", "./models"))
+    export_parser.add_argument("--output-dir", default=None,
+                               help="Export directory, defaults to ONNX_MODEL_DIR or <cache-dir>/onnx")
+    export_parser.add_argument("--quantize", action="store_true", help="Apply int8 dynamic quantization to the graphs")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        unknown_models = set(args.models) - set(EXPORTABLE_MODELS)
+        if unknown_models:
+            parser.error(f"Unknown models: {', '.join(sorted(unknown_models))}")
+        output_dir = args.output_dir or os.getenv("ONNX_MODEL_DIR", os.path.join(args.cache_dir, "onnx"))
+        for name in args.models or ["m2m100"]:
+            model_name, task = EXPORTABLE_MODELS[name]
+            # Same layout the model loaders read from
+            export_onnx(
+                model_name,
+                task,
+                os.path.join(output_dir, model_name.replace("/", "--")),
+                cache_dir=args.cache_dir,
+                quantize=args.quantize
+            )
+    else:
+        demo()
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 
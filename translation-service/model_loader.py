@@ -1,115 +1,675 @@
 import os
+import re
 import sys
 import json
+import time
+import fcntl
+import termios
+import statistics
+import threading
 import torch
+from collections import defaultdict
 from transformers import M2M100ForConditionalGeneration, M2M100Tokenizer
+# The image copies worker_common.py next to this file, in a checkout it is at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from worker_common import (
+    WORKER_POOL_SIZE, MAX_QUEUED_REQUESTS, METRICS_FILE, INFERENCE_BACKEND, MODEL_DTYPE, MODEL_COMPILE,
+    stats_lock, token_counts, timed_stage, log_event, onnx_model_path, StubTokenizer, StubSeq2SeqModel,
+    peak_rss_bytes, pretrained_kwargs, model_kwargs, compile_model, warmup_text, warmup_batches, run_warmup,
+    WARMUP_GENERATE_LENGTH, ModelResidency, TwoTierCache, get_request_control, finish_request,
+    stopping_criteria, stream_generate, ResponseStream, wants_stream, parse_action_priorities, RequestQueue,
+    send_response, start_metrics_writer, collect_worker_stats, render_prometheus, read_requests,
+    start_heartbeat, serve_pool_requests, serve_with_pool, backend_argument_parser, timed_repeats,
+    profile_backends, agreement, similarity, check_framing
+)
 
-def load_model(cache_dir=None):
-    """Load the multilingual translation model"""
-    try:
-        # Use environment variable for cache directory or default to ./models
-        cache_dir = cache_dir or os.getenv('TRANSFORMERS_CACHE', './models')
-        os.makedirs(cache_dir, exist_ok=True)
-        
-        print(f"Using cache directory: {cache_dir}", file=sys.stderr)
-        
-        # Load tokenizer and model
-        model_name = "facebook/m2m100_418M"
-        
-        tokenizer = M2M100Tokenizer.from_pretrained(
-            model_name,
-            cache_dir=cache_dir,
-            local_files_only=False
-        )
-        
-        # Load model with basic optimizations
-        model = M2M100ForConditionalGeneration.from_pretrained(
-            model_name,
-            cache_dir=cache_dir,
-            local_files_only=False
+# Input/output length limits for a single text
+MAX_TRANSLATION_TOKENS = 512
+# Batch translation limits: texts per generate call and batch size x longest input
+TRANSLATION_BATCH_SIZE = int(os.getenv('TRANSLATION_BATCH_SIZE', '16'))
+TRANSLATION_MAX_BATCH_TOKENS = int(os.getenv('TRANSLATION_MAX_BATCH_TOKENS', '4096'))
+# Texts longer than this many tokens are split at sentence boundaries into segments of at
+# most this size, which are translated in padded batches and joined back in order
+TRANSLATION_SEGMENT_TOKENS = min(int(os.getenv('TRANSLATION_SEGMENT_TOKENS', '256')), MAX_TRANSLATION_TOKENS)
+# Whitespace after sentence-ending punctuation, or around a line break. Full-width
+# punctuation ends a sentence even without whitespace, CJK text has none between sentences
+SENTENCE_BOUNDARY = re.compile(r'((?<=[.!?\u061f])\s+|(?<=[\u3002\uff01\uff1f])\s*|\s*\n\s*)')
+
+MODEL_NAME = "facebook/m2m100_418M"
+
+# Token lengths run through the model after it loads when MODEL_WARMUP is set
+MODEL_WARMUP_LENGTHS = os.getenv('MODEL_WARMUP_LENGTHS', '16,64,256')
+TRANSLATION_GENERATION_KWARGS = {
+    'max_length': MAX_TRANSLATION_TOKENS,
+    'num_beams': 2,
+    'length_penalty': 1.0
+}
+# Streamed translations decode greedily, transformers streamers don't support beam search
+TRANSLATION_STREAM_GENERATION_KWARGS = {
+    'max_length': MAX_TRANSLATION_TOKENS,
+    'num_beams': 1
+}
+
+# Translation memory: in-process LRU entries (0 disables the memory), SQLite file
+# ("" keeps it in memory only) and the most rows it keeps (0 for no limit)
+TRANSLATION_MEMORY_SIZE = int(os.getenv('TRANSLATION_MEMORY_SIZE', '10000'))
+TRANSLATION_MEMORY_PATH = os.getenv('TRANSLATION_MEMORY_PATH')
+TRANSLATION_MEMORY_DISK_ENTRIES = int(os.getenv('TRANSLATION_MEMORY_DISK_ENTRIES', '1000000'))
+
+# Admission control priorities by action, lower ones start first (see worker_common.RequestQueue)
+ACTION_PRIORITIES = os.getenv('ACTION_PRIORITIES', 'translate=0,stats=0,translate_batch=1')
+
+translation_memory = None
+request_queue = None  # requests waiting to start, reported in stats
+
+class TranslationMemory(TwoTierCache):
+    """Finished translations, in memory and in a SQLite file.
+
+    Entries are keyed on the normalized text, the language pair, the model name,
+    the inference backend, the weight precision and the generation settings.
+    """
+
+    def __init__(self, path=None, max_entries=None, max_disk_entries=None):
+        super().__init__(
+            'Translation memory', 'translations', ('translation',), path,
+            TRANSLATION_MEMORY_SIZE if max_entries is None else max_entries,
+            TRANSLATION_MEMORY_DISK_ENTRIES if max_disk_entries is None else max_disk_entries
         )
-        
-        # Basic optimization for inference
-        model.eval()
-        
-        print(f"Model loaded successfully from {model_name}", file=sys.stderr)
-        return model, tokenizer
-        
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.split())
+
+    @staticmethod
+    def make_key(text, source_lang, target_lang):
+        return TwoTierCache.hash_key([
+            TranslationMemory.normalize(text),
+            source_lang,
+            target_lang,
+            MODEL_NAME,
+            INFERENCE_BACKEND,
+            MODEL_DTYPE,
+            TRANSLATION_GENERATION_KWARGS
+        ])
+
+    def has(self, text, source_lang, target_lang):
+        return self.contains(self.make_key(text, source_lang, target_lang))
+
+    def get(self, text, source_lang, target_lang):
+        cached = self.lookup(self.make_key(text, source_lang, target_lang))
+        return None if cached is None else cached[0]
+
+    def put(self, text, source_lang, target_lang, translation):
+        self.store(self.make_key(text, source_lang, target_lang), translation)
+
+def load_translation_model(name, cache_dir, backend):
+    """Load the multilingual translation model, returns ((model, tokenizer), model)"""
+    if backend == 'stub':
+        print("Using stub model, translations echo their input", file=sys.stderr)
+        return (StubSeq2SeqModel(), StubTokenizer()), None
+
+    if backend == 'onnx':
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        model_path = onnx_model_path(MODEL_NAME, cache_dir)
+        return (ORTModelForSeq2SeqLM.from_pretrained(model_path), M2M100Tokenizer.from_pretrained(model_path)), None
+
+    tokenizer = M2M100Tokenizer.from_pretrained(MODEL_NAME, **pretrained_kwargs(cache_dir))
+    model = M2M100ForConditionalGeneration.from_pretrained(MODEL_NAME, **model_kwargs(cache_dir, backend))
+    model.eval()
+    if backend == 'int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif MODEL_COMPILE:
+        model = compile_model(model)
+    return (model, tokenizer), model
+
+WARMUP_TEXT = "Please describe what we could improve in the checkout process, the pricing page is confusing."
+
+def warmup_model(name, loaded, source_lang='en', target_lang='fr'):
+    """Run representative input lengths and batch sizes through a freshly loaded model"""
+    model, tokenizer = loaded
+
+    def warm(lengths):
+        tokenizer.src_lang = source_lang
+        encoded = [
+            tokenizer(warmup_text(WARMUP_TEXT, length), max_length=length, truncation=True)['input_ids']
+            for length in lengths
+        ]
+        for batch in warmup_batches(encoded, TRANSLATION_BATCH_SIZE):
+            inputs = tokenizer.pad({'input_ids': batch}, return_tensors="pt")
+            model.generate(
+                **inputs,
+                forced_bos_token_id=tokenizer.get_lang_id(target_lang),
+                **{**TRANSLATION_GENERATION_KWARGS, 'max_length': WARMUP_GENERATE_LENGTH}
+            )
+
+    run_warmup(name, MODEL_WARMUP_LENGTHS, MAX_TRANSLATION_TOKENS, warm)
+
+# The model is loaded on first use and, with MODEL_IDLE_UNLOAD_SECONDS, unloaded when idle
+residency = ModelResidency(['translation'], load_translation_model, warmup=warmup_model)
+
+def load_model(cache_dir=None, backend=None):
+    """Load the multilingual translation model, returns (model, tokenizer)"""
+    try:
+        return residency.ensure('translation', cache_dir, backend)
     except Exception as e:
         print(f"Error loading model: {str(e)}", file=sys.stderr)
         sys.exit(1)
 
-def translate_text(model, tokenizer, text, source_lang="en", target_lang="fr"):
+def count_generated_tokens(encoded, generated_tokens, tokenizer, spans=None):
+    """Add the input and output token counts of one generate call to the stats"""
+    input_tokens = int(encoded['attention_mask'].sum())
+    output_tokens = int((generated_tokens != tokenizer.pad_token_id).sum())
+    with stats_lock:
+        token_counts['input_tokens'] += input_tokens
+        token_counts['output_tokens'] += output_tokens
+    if spans is not None:
+        spans['input_tokens'] = spans.get('input_tokens', 0) + input_tokens
+        spans['output_tokens'] = spans.get('output_tokens', 0) + output_tokens
+
+def token_count(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False)['input_ids'])
+
+def sentence_pieces(tokenizer, text, separator, budget):
+    """Yield (text, tokens, separator) pieces of at most budget tokens.
+
+    A text over budget is split between words, and a word over budget (like a
+    CJK sentence, which has no spaces) into windows of its tokens. Each piece
+    keeps the whitespace that followed it.
+    """
+    tokens = token_count(tokenizer, text)
+    if tokens <= budget:
+        yield text, tokens, separator
+        return
+    words = re.split(r'(\s+)', text)
+    if len(words) > 1:
+        for position in range(0, len(words), 2):
+            word_separator = words[position + 1] if position + 1 < len(words) else separator
+            yield from sentence_pieces(tokenizer, words[position], word_separator, budget)
+        return
+    input_ids = tokenizer(text, add_special_tokens=False)['input_ids']
+    for start in range(0, len(input_ids), budget):
+        window = input_ids[start:start + budget]
+        last = start + budget >= len(input_ids)
+        yield tokenizer.decode(window, skip_special_tokens=True), len(window), separator if last else ''
+
+def split_segments(tokenizer, text, max_tokens=None):
+    """Split a long text into (segment, separator) pairs of at most max_tokens tokens each.
+
+    Whole sentences are packed into segments, and line breaks always end one.
+    The separator joins a segment's translation to the next: the whitespace that
+    followed the segment in the source text.
+    """
+    # Leave room for the language code and end of sentence tokens added to every segment
+    budget = max(1, (max_tokens or TRANSLATION_SEGMENT_TOKENS) - 2)
+    segments = []  # [text, tokens, separator]
+    parts = SENTENCE_BOUNDARY.split(text.strip())
+    for position in range(0, len(parts), 2):
+        sentence = parts[position]
+        boundary = parts[position + 1] if position + 1 < len(parts) else ''
+        if not sentence:
+            if segments:
+                segments[-1][2] += boundary
+            continue
+        for piece, tokens, separator in sentence_pieces(tokenizer, sentence, boundary, budget):
+            last = segments[-1] if segments else None
+            if last is not None and '\n' not in last[2] and last[1] + tokens <= budget:
+                last[0] += last[2] + piece
+                last[1] += tokens
+                last[2] = separator
+            else:
+                segments.append([piece, tokens, separator])
+    if segments:
+        segments[-1][2] = ''
+    return [(segment, separator) for segment, _, separator in segments]
+
+def stream_segments(model, tokenizer, text, target_lang, stream, control=None):
+    """Translate a long text one segment after another, streaming each as it is generated"""
+    translation = []
+    for segment, separator in split_segments(tokenizer, text):
+        if control is not None and control.should_stop():
+            break
+        encoded = tokenizer(
+            TranslationMemory.normalize(segment),
+            return_tensors="pt",
+            truncation=True,
+            max_length=MAX_TRANSLATION_TOKENS
+        )
+        translation.append(stream_generate(
+            model,
+            tokenizer,
+            {
+                **encoded,
+                'forced_bos_token_id': tokenizer.get_lang_id(target_lang),
+                'stopping_criteria': stopping_criteria([control])
+            },
+            TRANSLATION_STREAM_GENERATION_KWARGS,
+            stream.send_delta
+        ).strip())
+        if separator:
+            stream.send_delta(separator)
+            translation.append(separator)
+    return ''.join(translation)
+
+def translate_text(model, tokenizer, text, source_lang="en", target_lang="fr", spans=None, stream=None, control=None):
     """Translate text between any supported language pair"""
     try:
         if not text or text.isspace():
             return text
+
+        # Check the translation memory before touching the tokenizer or model
+        if translation_memory is not None:
+            with timed_stage('cache_lookup', spans):
+                cached = translation_memory.get(text, source_lang, target_lang)
+            if cached is not None:
+                return cached
             
         # Set the source language
         tokenizer.src_lang = source_lang
         
         # Tokenize with basic settings
-        encoded = tokenizer(text, return_tensors="pt", truncation=True, max_length=512)
-        
+        with timed_stage('tokenize', spans):
+            encoded = tokenizer(TranslationMemory.normalize(text), return_tensors="pt")
+        long_text = len(encoded['input_ids'][0]) > TRANSLATION_SEGMENT_TOKENS
+        if long_text and stream is None:
+            # Segments of a long text are translated together as one padded batch
+            return translate_batch(
+                model,
+                tokenizer,
+                [{'text': text, 'source_lang': source_lang, 'target_lang': target_lang}],
+                spans,
+                control
+            )[0]
+
+        if stream is not None:
+            # Greedy translations are not stored, the memory holds beam search translations only
+            with timed_stage('generate', spans):
+                if long_text:
+                    return stream_segments(model, tokenizer, text, target_lang, stream, control)
+                return stream_generate(
+                    model,
+                    tokenizer,
+                    {
+                    **encoded,
+                    'forced_bos_token_id': tokenizer.get_lang_id(target_lang),
+                    'stopping_criteria': stopping_criteria([control])
+                },
+                    TRANSLATION_STREAM_GENERATION_KWARGS,
+                    stream.send_delta
+                ).strip()
+
         # Generate translation
-        with torch.no_grad():
+        with timed_stage('generate', spans), torch.no_grad():
             generated_tokens = model.generate(
                 **encoded,
                 forced_bos_token_id=tokenizer.get_lang_id(target_lang),
-                max_length=512,
-                num_beams=2,
-                length_penalty=1.0
+                stopping_criteria=stopping_criteria([control]),
+                **TRANSLATION_GENERATION_KWARGS
             )
+        count_generated_tokens(encoded, generated_tokens, tokenizer, spans)
+        if control is not None and control.should_stop():
+            # Cut short, keep it out of the translation memory
+            return text
         
         # Decode the translation
-        translation = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)[0]
+        with timed_stage('decode', spans):
+            translation = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)[0]
+        if translation_memory is not None:
+            translation_memory.put(text, source_lang, target_lang, translation)
         return translation
         
     except Exception as e:
         print(f"Translation error: {str(e)}", file=sys.stderr)
         return text
 
+def length_buckets(encoded_items, batch_size=None, max_batch_tokens=None):
+    """Split (index, input_ids) pairs into length-sorted buckets that pad cheaply"""
+    batch_size = batch_size or TRANSLATION_BATCH_SIZE
+    max_batch_tokens = max_batch_tokens or TRANSLATION_MAX_BATCH_TOKENS
+    buckets = []
+    bucket = []
+    for item in sorted(encoded_items, key=lambda item: len(item[1])):
+        # Items are sorted, so the newest one is always the longest in the bucket
+        if bucket and (len(bucket) >= batch_size or len(item[1]) * (len(bucket) + 1) > max_batch_tokens):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(item)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+def translate_batch(model, tokenizer, items, spans=None, control=None):
+    """Translate a list of {text, source_lang, target_lang} items with few generate calls"""
+    translations = [item.get('text', '') for item in items]
+
+    # Group by language pair, the tokenizer and forced BOS token depend on it
+    groups = defaultdict(list)
+    for index, item in enumerate(items):
+        text = item.get('text', '')
+        if not text or text.isspace():
+            continue
+        source_lang = item.get('source_lang', 'en')
+        target_lang = item.get('target_lang', 'fr')
+        # Texts already in the translation memory never reach the tokenizer
+        if translation_memory is not None:
+            with timed_stage('cache_lookup', spans):
+                cached = translation_memory.get(text, source_lang, target_lang)
+            if cached is not None:
+                translations[index] = cached
+                continue
+        groups[(source_lang, target_lang)].append(index)
+
+    for (source_lang, target_lang), indices in groups.items():
+        # Each text is one unit keyed (index, 0), or one unit per segment when it's too long
+        encoded_items = []
+        separators = {}  # index -> segment separators of texts split into segments
+        try:
+            tokenizer.src_lang = source_lang
+            with timed_stage('tokenize', spans):
+                for index in indices:
+                    text = items[index]['text']
+                    input_ids = tokenizer(TranslationMemory.normalize(text))['input_ids']
+                    if len(input_ids) <= TRANSLATION_SEGMENT_TOKENS:
+                        encoded_items.append(((index, 0), input_ids))
+                        continue
+                    segments = split_segments(tokenizer, text)
+                    separators[index] = [separator for _, separator in segments]
+                    for position, (segment, _) in enumerate(segments):
+                        encoded_items.append(((index, position), tokenizer(
+                            TranslationMemory.normalize(segment),
+                            truncation=True,
+                            max_length=MAX_TRANSLATION_TOKENS
+                        )['input_ids']))
+            target_lang_id = tokenizer.get_lang_id(target_lang)
+        except Exception as e:
+            print(f"Translation error: {str(e)}", file=sys.stderr)
+            continue
+
+        translated = {}  # (index, position) -> translation
+        buckets = length_buckets(encoded_items)
+        for bucket in buckets:
+            if control is not None and control.should_stop():
+                break
+            try:
+                with timed_stage('generate', spans):
+                    encoded = tokenizer.pad({'input_ids': [input_ids for _, input_ids in bucket]}, return_tensors="pt")
+                    with torch.no_grad():
+                        generated_tokens = model.generate(
+                            **encoded,
+                            forced_bos_token_id=target_lang_id,
+                            stopping_criteria=stopping_criteria([control]),
+                            **TRANSLATION_GENERATION_KWARGS
+                        )
+                count_generated_tokens(encoded, generated_tokens, tokenizer, spans)
+                if control is not None and control.should_stop():
+                    break
+                with timed_stage('decode', spans):
+                    decoded = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+                for (key, _), translation in zip(bucket, decoded):
+                    translated[key] = translation
+            except Exception as e:
+                # Leave the bucket untranslated, like translate_text does on failure
+                print(f"Translation error: {str(e)}", file=sys.stderr)
+
+        # Join segments back in order, a text missing any segment stays untranslated
+        for index in indices:
+            if index in separators:
+                parts = [translated.get((index, position)) for position in range(len(separators[index]))]
+                if None in parts:
+                    continue
+                translation = ''.join(part.strip() + separator for part, separator in zip(parts, separators[index]))
+            elif (index, 0) in translated:
+                translation = translated[(index, 0)]
+            else:
+                continue
+            translations[index] = translation
+            if translation_memory is not None:
+                translation_memory.put(items[index]['text'], source_lang, target_lang, translation)
+
+        log_event(
+            'translate_batch',
+            source_lang=source_lang,
+            target_lang=target_lang,
+            texts=len(indices),
+            segments=len(encoded_items),
+            batches=len(buckets),
+            padded_shapes=[[len(bucket), max(len(input_ids) for _, input_ids in bucket)] for bucket in buckets]
+        )
+
+    return translations
+
+# Representative texts used to profile and compare inference backends
+SAMPLE_TRANSLATIONS = [
+    {'text': 'How satisfied are you with our service?', 'source_lang': 'en', 'target_lang': 'fr'},
+    {'text': 'Yes', 'source_lang': 'en', 'target_lang': 'fr'},
+    {'text': 'Please describe what we could improve in the checkout process.', 'source_lang': 'en', 'target_lang': 'he'},
+    {'text': 'Very dissatisfied', 'source_lang': 'en', 'target_lang': 'es'},
+    {'text': 'Would you recommend us to a friend or colleague?', 'source_lang': 'en', 'target_lang': 'de'}
+]
+
+def profile_backend(backend, repeats=3):
+    """Load the model with one backend and measure load time, latency, memory and outputs"""
+    start_time = time.perf_counter()
+    model, tokenizer = load_model(backend=backend)
+    load_seconds = time.perf_counter() - start_time
+
+    translations = []
+    latencies = []
+    for item in SAMPLE_TRANSLATIONS:
+        translations.append(timed_repeats(
+            lambda: translate_text(model, tokenizer, item['text'], item['source_lang'], item['target_lang']),
+            repeats,
+            latencies
+        ))
+
+    return {
+        'backend': backend,
+        'load_seconds': load_seconds,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'translation_latency_median_seconds': statistics.median(latencies),
+        'translations': translations
+    }
+
+def compare_backends(backend, repeats=3):
+    """Compare a backend against PyTorch fp32, each profiled in a fresh process"""
+    baseline, candidate = profile_backends(os.path.abspath(__file__), backend, repeats)
+    return {
+        'baseline': baseline,
+        'candidate': candidate,
+        'translation_exact_agreement': agreement(baseline['translations'], candidate['translations']),
+        'translation_similarity': similarity(baseline['translations'], candidate['translations']),
+        'translation_speedup': baseline['translation_latency_median_seconds'] / candidate['translation_latency_median_seconds'],
+        'peak_rss_ratio': candidate['peak_rss_bytes'] / baseline['peak_rss_bytes']
+    }
+
+def parse_args(argv):
+    return backend_argument_parser("Translation model worker, reads JSON requests from stdin").parse_args(argv)
+
+def open_translation_memory():
+    """Open the translation memory, kept next to the model cache so it survives restarts"""
+    global translation_memory
+    if INFERENCE_BACKEND == 'stub' or TRANSLATION_MEMORY_SIZE <= 0:
+        # Stub output only echoes its input, it must never be served as a translation
+        translation_memory = None
+        return
+    memory_path = TRANSLATION_MEMORY_PATH
+    if memory_path is None:
+        memory_path = os.path.join(os.getenv('TRANSFORMERS_CACHE', './models'), 'translation_memory.sqlite3')
+    translation_memory = TranslationMemory(memory_path)
+
+def cache_stats():
+    """Hit and size counters of the worker's caches, keyed by cache name"""
+    if translation_memory is None:
+        return {}
+    return {'translation_memory': translation_memory.get_stats()}
+
+def pending_input_bytes():
+    """Bytes of requests waiting unread on stdin, the only queue this worker has"""
+    try:
+        return int.from_bytes(fcntl.ioctl(sys.stdin.fileno(), termios.FIONREAD, b'\0\0\0\0'), sys.byteorder)
+    except (OSError, ValueError):
+        return 0
+
+def collect_stats():
+    """Snapshot of the stage latencies, token counts, queue depth, caches and memory"""
+    # Pool workers only see their own pipe, the queue is in the parent
+    depth = request_queue.depth() if request_queue is not None else {}
+    stats = collect_worker_stats(depth, cache_stats(), residency)
+    # "model" stays for existing callers, the analysis worker only reports "models"
+    return {**stats, 'pending_input_bytes': pending_input_bytes(), 'model': stats['models']['translation']}
+
+def handle_request(model, tokenizer, input_data, spans=None, start_time=None):
+    """Run one parsed request and send back its response"""
+    start_time = start_time or time.perf_counter()
+    spans = spans if spans is not None else {}
+    request_id = input_data.get('id')
+    action = input_data.get('action', 'translate')
+    control = get_request_control(request_id)
+    stream = None
+    try:
+        # Only single translations stream, batches answer in one line as before
+        if action == 'translate' and wants_stream(input_data):
+            stream = ResponseStream(request_id, control)
+        if control is not None and control.should_stop():
+            # Skip requests whose caller has already given up
+            result = control.stopped_response()
+        else:
+            result = process_request(model, tokenizer, input_data, spans, stream)
+            if control is not None and control.should_stop():
+                result = control.stopped_response()
+    except Exception as e:
+        result = {"error": str(e)}
+    finally:
+        finish_request(request_id)
+    if stream is not None:
+        stream.finish(result)
+    else:
+        send_response(result, request_id)
+    if action != 'stats':
+        log_event('request', id=request_id, action=action, total_seconds=time.perf_counter() - start_time, spans=spans)
+
+def in_translation_memory(input_data):
+    """Whether the translation memory has every text of a translate or translate_batch request"""
+    if translation_memory is None:
+        return False
+    action = input_data.get('action', 'translate')
+    if action == 'translate':
+        items = [input_data]
+    elif action == 'translate_batch':
+        items = input_data.get('items', [])
+    else:
+        return False
+    if not isinstance(items, list):
+        return False
+    for item in items:
+        # Malformed items get their error from the normal path
+        if not isinstance(item, dict) or not isinstance(item.get('text', ''), str):
+            return False
+        text = item.get('text', '')
+        if text and not text.isspace() and not translation_memory.has(
+            text, item.get('source_lang', 'en'), item.get('target_lang', 'fr')
+        ):
+            return False
+    return True
+
+def handle_resident_request(input_data, spans=None, start_time=None):
+    """Run one request with the model kept loaded, reloading it if it was unloaded while idle"""
+    if input_data.get('action') == 'stats' or in_translation_memory(input_data):
+        # Stats polls and translations the memory already has must not reload an unloaded model
+        handle_request(None, None, input_data, spans, start_time)
+        return
+    with residency.using('translation') as (model, tokenizer):
+        handle_request(model, tokenizer, input_data, spans, start_time)
+
+def process_request(model, tokenizer, input_data, spans=None, stream=None):
+    """Run a single parsed request and return its result"""
+    action = input_data.get('action', 'translate')
+
+    if action == 'stats':
+        # translation_memory stays at the top level for existing callers
+        stats = collect_stats()
+        return {**stats, 'translation_memory': stats['caches'].get('translation_memory')}
+    elif action == 'translate_batch':
+        # Translate many texts at once, results keep the input order
+        items = input_data.get('items', [])
+        return {
+            'translations': translate_batch(model, tokenizer, items, spans, get_request_control(input_data.get('id'))),
+            'count': len(items)
+        }
+
+    text = input_data.get('text', '')
+    source_lang = input_data.get('source_lang', 'en')
+    target_lang = input_data.get('target_lang', 'fr')
+
+    # Translate
+    control = get_request_control(input_data.get('id'))
+    translation = translate_text(model, tokenizer, text, source_lang, target_lang, spans, stream, control)
+
+    # Output result
+    return {
+        'translation': translation,
+        'source_lang': source_lang,
+        'target_lang': target_lang
+    }
+
+def run_pool(model, tokenizer):
+    """Serve requests from stdin with a pool of forked worker processes"""
+    def serve():
+        # Each worker opens its own translation memory connection after the fork
+        open_translation_memory()
+        serve_pool_requests(
+            lambda input_data, spans, received: handle_request(model, tokenizer, input_data, spans, received),
+            lambda: render_prometheus(collect_stats())
+        )
+
+    def ready():
+        print("Translation service ready", file=sys.stderr)
+        sys.stderr.flush()
+
+    serve_with_pool(serve, ACTION_PRIORITIES, 'translate', ready)
+
 def main():
+    global request_queue
+    check_framing()
     try:
-        # Load the model once
+        # Load the model up front so the first request doesn't wait for it
         model, tokenizer = load_model()
+
+        if WORKER_POOL_SIZE > 1:
+            # The pool workers share the weights loaded before forking and keep them
+            run_pool(model, tokenizer)
+            return
+        # Requests get the model from residency.using, holding no reference here lets an idle unload free it
+        del model, tokenizer
+        residency.start_idle_unloader()
+
+        open_translation_memory()
+        start_metrics_writer(METRICS_FILE, lambda: render_prometheus(collect_stats()))
         print("Translation service ready", file=sys.stderr)
         sys.stderr.flush()
         
+        # Requests are read on their own thread so cancels arrive during generation
+        work_queue = request_queue = RequestQueue(MAX_QUEUED_REQUESTS, parse_action_priorities(ACTION_PRIORITIES))
+        reader = threading.Thread(target=read_requests, args=(work_queue, 'translate'), daemon=True)
+        reader.start()
+        start_heartbeat(work_queue)
+
         # Process requests
-        for line in sys.stdin:
-            try:
-                # Parse input JSON
-                input_data = json.loads(line.strip())
-                text = input_data.get('text', '')
-                source_lang = input_data.get('source_lang', 'en')
-                target_lang = input_data.get('target_lang', 'fr')
-                
-                # Translate
-                translation = translate_text(model, tokenizer, text, source_lang, target_lang)
-                
-                # Output result
-                result = {
-                    'translation': translation,
-                    'source_lang': source_lang,
-                    'target_lang': target_lang
-                }
-                print(json.dumps(result))
-                sys.stdout.flush()
-                
-            except json.JSONDecodeError as e:
-                print(json.dumps({"error": f"Invalid JSON input: {str(e)}"}))
-                sys.stdout.flush()
-            except Exception as e:
-                print(json.dumps({"error": str(e)}))
-                sys.stdout.flush()
-            
-            sys.stdout.flush()
+        while True:
+            entry = work_queue.get()
+            if entry is None:
+                break
+            input_data, spans, start_time = entry
+            handle_resident_request(input_data, spans, start_time)
             
     except Exception as e:
-        print(json.dumps({"error": f"Fatal error: {str(e)}"}))
-        sys.stdout.flush()
+        send_response({"error": f"Fatal error: {str(e)}"})
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    if args.profile_backend:
+        print(json.dumps(profile_backend(args.profile_backend, args.repeats)))
+    elif args.compare_backends:
+        print(json.dumps(compare_backends(args.compare_backends, args.repeats), indent=2))
+    else:
+        main() 
\ No newline at end of file
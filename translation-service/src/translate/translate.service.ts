@@ -1,5 +1,5 @@
 import { Injectable, Logger } from '@nestjs/common';
-import { TranslatorService } from './translator.service';
+import { TranslatorService, TranslationItem } from './translator.service';
 import { TranslationLanguages } from '../consts';
 import { SurveyService } from './survey.service';
 import { RedisService } from '../redis/redis.service';
@@ -41,53 +41,30 @@ export class TranslateService {
                             componentCount: originalComponents.length
                         });
                         
-                        // Translate components sequentially
-                        const translatedComponents = [];
-                        for (const [index, component] of originalComponents.entries()) {
-                            try {
-                                // Create a new component object for this translation
-                                const translatedComponent = { ...component };
-                                
-                                // Translate title
-                                this.logger.debug(`Translating component ${index + 1}/${originalComponents.length} title`);
-                                translatedComponent.title = await this.translatorService.translate(
-                                    component.title,
-                                    sourceLang,
-                                    targetLang,
-                                    surveyId
-                                );
-                                this.logger.debug(`Translated title: ${translatedComponent.title}`);
-                                
-                                // Translate options if they exist
-                                if (component.options?.length) {
-                                    this.logger.debug(`Translating ${component.options.length} options for component ${index + 1}`);
-                                    translatedComponent.options = [];
-                                    
-                                    // Translate options sequentially
-                                    for (const [optionIndex, option] of component.options.entries()) {
-                                        const translated = await this.translatorService.translate(
-                                            option,
-                                            sourceLang,
-                                            targetLang,
-                                            surveyId
-                                        );
-                                        this.logger.debug(`Translated option ${optionIndex + 1}/${component.options.length}: ${translated}`);
-                                        translatedComponent.options.push(translated);
-                                    }
-                                }
-                                
-                                this.logger.debug(`Completed component ${index + 1}/${originalComponents.length}`);
-                                translatedComponents.push(translatedComponent);
-                            } catch (error) {
-                                this.logger.error(`Failed to translate component ${index + 1}`, {
-                                    error,
-                                    component: component.title
-                                });
-
-                                throw error;
+                        // Collect every title and option so the whole survey translates in one batch
+                        const items: TranslationItem[] = [];
+                        for (const component of originalComponents) {
+                            items.push({ text: component.title, source_lang: sourceLang, target_lang: targetLang });
+                            for (const option of component.options || []) {
+                                items.push({ text: option, source_lang: sourceLang, target_lang: targetLang });
                             }
                         }
 
+                        const translations = await this.translatorService.translateBatch(items);
+                        this.logger.debug(`Translated ${translations.length} texts for ${surveyId}`);
+
+                        // Put the translations back in the same order they were collected
+                        let translationIndex = 0;
+                        const translatedComponents = originalComponents.map(component => {
+                            // Create a new component object for this translation
+                            const translatedComponent = { ...component };
+                            translatedComponent.title = translations[translationIndex++];
+                            if (component.options?.length) {
+                                translatedComponent.options = component.options.map(() => translations[translationIndex++]);
+                            }
+                            return translatedComponent;
+                        });
+
                         this.logger.log(`All components translated for ${surveyId} to ${targetLang}`, { 
                             componentCount: translatedComponents.length 
                         });
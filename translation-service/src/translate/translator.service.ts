@@ -2,6 +2,20 @@ import { Injectable, Logger } from '@nestjs/common';
 import { spawn } from 'child_process';
 import { RedisService } from '../redis/redis.service';
 import { TranslationLanguages } from '../consts';
+import { v4 as uuidv4 } from 'uuid';
+import { WorkerOutput } from '../worker/worker-output';
+
+export interface TranslationItem {
+    text: string;
+    source_lang: string;
+    target_lang: string;
+}
+
+interface PendingRequest {
+    resolve: (result: any) => void;
+    reject: (error: Error) => void;
+    timeoutId: NodeJS.Timeout;
+}
 
 interface TranslationStatus {
     status: 'in_progress' | 'completed' | 'failed';
@@ -15,6 +29,12 @@ export class TranslatorService {
     private pythonProcess: any;
     private isInitialized: boolean = false;
     private readonly TRANSLATION_TIMEOUT = 60000; // 60 seconds timeout
+    private readonly BATCH_TRANSLATION_TIMEOUT = 300000; // 5 minutes timeout for a whole batch
+    private readonly pendingRequests = new Map<string, PendingRequest>();
+    private readonly workerOutput = new WorkerOutput(
+        (response) => this.handleResponse(response),
+        (line) => this.logger.debug(`Python stdout: ${line.substring(0, 100)}`)
+    );
 
     constructor(private readonly redisService: RedisService) {
         this.initializeModel();
@@ -29,8 +49,10 @@ export class TranslatorService {
             this.logger.log('Starting translation model initialization...');
             
             // Start the Python process
+            // WorkerOutput parses JSON lines, whatever FRAMING this service runs with
             this.pythonProcess = spawn('python3', ['model_loader.py'], {
-                stdio: ['pipe', 'pipe', 'pipe']
+                stdio: ['pipe', 'pipe', 'pipe'],
+                env: { ...process.env, FRAMING: 'jsonl' }
             });
 
             // Handle Python process errors and output
@@ -38,9 +60,8 @@ export class TranslatorService {
                 this.logger.log(`Python Model Output: ${data.toString().trim()}`);
             });
 
-            this.pythonProcess.stdout.on('data', (data) => {
-                this.logger.debug(`Python stdout: ${data.toString().trim()}`);
-            });
+            // One dispatcher for all responses, matched to their request by the echoed ID
+            this.pythonProcess.stdout.on('data', (data: Buffer) => this.workerOutput.push(data));
 
             this.pythonProcess.on('error', (error) => {
                 this.logger.error('Failed to start Python process', error);
@@ -53,6 +74,12 @@ export class TranslatorService {
                     this.logger.error(`Python process exited with code ${code}, signal ${signal}`);
                     this.isInitialized = false;
                 }
+                // Nothing will answer the requests still waiting on this process
+                for (const [requestId, pending] of this.pendingRequests) {
+                    clearTimeout(pending.timeoutId);
+                    this.pendingRequests.delete(requestId);
+                    pending.reject(new Error('Translation worker exited'));
+                }
             });
 
             this.isInitialized = true;
@@ -69,79 +96,15 @@ export class TranslatorService {
 
     async translate(text: string, sourceLang: string = 'en', targetLang: string = 'fr', surveyId?: string): Promise<string> {
         try {
-            if (!this.isInitialized || !this.pythonProcess) {
-                await this.initializeModel();
-            }
-
-            return new Promise((resolve, reject) => {
-                let responseData = '';
-                let timeoutId: NodeJS.Timeout;
-
-                // Create a request object with language parameters
-                const request = {
-                    text,
-                    source_lang: sourceLang,
-                    target_lang: targetLang
-                };
-
-                const cleanup = () => {
-                    if (timeoutId) clearTimeout(timeoutId);
-                    this.pythonProcess.stdout.removeListener('data', handleOutput);
-                };
-
-                // Handle the response
-                const handleOutput = (data: Buffer) => {
-                    try {
-                        responseData += data.toString();
-                        
-                        // Try to parse the accumulated data
-                        try {
-                            const response = JSON.parse(responseData);
-                            // Clear the accumulated data
-                            responseData = '';
-                            
-                            if (response.error) {
-                                cleanup();
-                                this.logger.error('Translation error from Python:', response.error);
-                                reject(new Error(response.error));
-                            } else {
-                                cleanup();
-                                resolve(response.translation);
-                            }
-                        } catch (e) {
-                            // If we can't parse the JSON yet, wait for more data
-                            if (!(e instanceof SyntaxError)) {
-                                cleanup();
-                                throw e;
-                            }
-                        }
-                    } catch (error) {
-                        cleanup();
-                        this.logger.error('Error parsing Python response:', error);
-                        reject(error);
-                    }
-                };
-
-                // Set a timeout for the translation request
-                timeoutId = setTimeout(() => {
-                    cleanup();
-                    this.logger.error(`Translation timed out for text: "${text.substring(0, 50)}..."`);
-                    reject(new Error(`Translation timed out after ${this.TRANSLATION_TIMEOUT/1000} seconds`));
-                }, this.TRANSLATION_TIMEOUT);
-
-                // Listen for response
-                this.pythonProcess.stdout.on('data', handleOutput);
-
-                // Send the request to Python process
-                try {
-                    this.pythonProcess.stdin.write(JSON.stringify(request) + '\n');
-                } catch (error) {
-                    cleanup();
-                    this.logger.error('Failed to write to Python process:', error);
-                    reject(new Error('Failed to send translation request to Python process'));
-                }
-            });
-
+            // Create a request object with language parameters
+            const request = {
+                text,
+                source_lang: sourceLang,
+                target_lang: targetLang
+            };
+
+            const response = await this.sendRequest(request, this.TRANSLATION_TIMEOUT);
+            return response.translation;
         } catch (error) {
             this.logger.error('Translation failed', {
                 error: error instanceof Error ? error.message : 'Unknown error',
@@ -152,4 +115,77 @@ export class TranslatorService {
             throw error;
         }
     }
-} 
\ No newline at end of file
+
+    async translateBatch(items: TranslationItem[]): Promise<string[]> {
+        try {
+            if (!items.length) {
+                return [];
+            }
+
+            // The worker groups items by language pair and translates them in padded batches
+            const response = await this.sendRequest({
+                action: 'translate_batch',
+                items
+            }, this.BATCH_TRANSLATION_TIMEOUT);
+            return response.translations;
+        } catch (error) {
+            this.logger.error('Batch translation failed', {
+                error: error instanceof Error ? error.message : 'Unknown error',
+                itemCount: items.length
+            });
+            throw error;
+        }
+    }
+
+    private handleResponse(response: any): void {
+        const pending = response.id ? this.pendingRequests.get(response.id) : undefined;
+        // Late responses to requests that already timed out, and streamed partial lines
+        if (!pending || response.done === false) {
+            return;
+        }
+
+        clearTimeout(pending.timeoutId);
+        this.pendingRequests.delete(response.id);
+        if (response.error) {
+            this.logger.error('Translation error from Python:', response.error);
+            pending.reject(new Error(response.error));
+        } else {
+            pending.resolve(response);
+        }
+    }
+
+    private async sendRequest(request: Record<string, any>, timeout: number): Promise<any> {
+        if (!this.isInitialized || !this.pythonProcess) {
+            await this.initializeModel();
+        }
+
+        if (this.workerOutput.isFull()) {
+            // The worker would only turn the request away, fail fast instead of adding to its backlog
+            throw new Error('Translation worker overloaded');
+        }
+
+        return new Promise((resolve, reject) => {
+            const requestId = uuidv4();
+
+            // Set a timeout for the translation request
+            const timeoutId = setTimeout(() => {
+                this.pendingRequests.delete(requestId);
+                // Stop the generation instead of letting it finish for nobody
+                this.pythonProcess.stdin.write(JSON.stringify({ action: 'cancel', target_id: requestId }) + '\n');
+                this.logger.error(`Translation request timed out: "${JSON.stringify(request).substring(0, 50)}..."`);
+                reject(new Error(`Translation timed out after ${timeout/1000} seconds`));
+            }, timeout);
+            this.pendingRequests.set(requestId, { resolve, reject, timeoutId });
+
+            // Send the request to Python process, the worker drops it once the timeout has passed
+            try {
+                this.pythonProcess.stdin.write(JSON.stringify({ ...request, id: requestId, timeout_ms: timeout }) + '\n');
+            } catch (error) {
+                clearTimeout(timeoutId);
+                this.pendingRequests.delete(requestId);
+                this.logger.error('Failed to write to Python process:', error);
+                reject(new Error('Failed to send translation request to Python process'));
+            }
+        });
+    }
+}
@@ -0,0 +1,1475 @@
+"""Request protocol, admission control, worker pool, model residency, caching and
+instrumentation shared by the model workers (model_loader.py and
+translation-service/model_loader.py).
+
+The translation-service image copies this file next to its model_loader.py.
+"""
+import os
+import sys
+import gc
+import argparse
+import json
+import time
+import hashlib
+import sqlite3
+import heapq
+import itertools
+import zlib
+import signal
+import struct
+import bisect
+import resource
+import statistics
+import subprocess
+import threading
+import traceback
+import torch
+try:
+    import msgpack  # Optional, only needed for FRAMING=msgpack
+except ImportError:
+    msgpack = None
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+from collections import defaultdict, Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+from difflib import SequenceMatcher
+
+# Message framing on stdin/stdout: "jsonl" (one JSON object per line) or "msgpack"
+# (a 4-byte big-endian length, then a msgpack map), the same in both directions and on
+# the pool's pipes. msgpack is for Python callers only, the Node services parse JSON lines
+# (src/worker/worker-output.ts) and spawn the workers with FRAMING=jsonl
+FRAMING = os.getenv('FRAMING', 'jsonl')
+FRAME_HEADER = struct.Struct('>I')
+
+# Pool mode: fork this many worker processes sharing the parent's weights (0 or 1 disables it)
+WORKER_POOL_SIZE = int(os.getenv('WORKER_POOL_SIZE', '0'))
+# Torch threads per pool worker, 0 splits the CPU cores evenly between workers
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '0'))
+
+# Latency instrumentation: recent samples kept per stage for percentiles,
+# histogram bucket upper bounds in seconds, and an optional Prometheus text dump
+STATS_WINDOW = int(os.getenv('STATS_WINDOW', '1024'))
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '15'))
+
+# Admission control: at most this many requests wait to start (0 means no limit), more are
+# answered right away with an "overloaded" error. Lower priorities start first and, when
+# the queue is full, push out queued requests of a higher priority value
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '64'))
+DEFAULT_ACTION_PRIORITY = 1
+# Seconds between heartbeat lines reporting the queue depth on stdout (0 disables them)
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '5'))
+
+# Inference backend: "pytorch" (fp32), "int8" (dynamically quantized linear layers),
+# "onnx" (ONNX Runtime graphs exported with download_model.py export) or "stub"
+# (no weights, for benchmarking the protocol and the pre- and post-processing)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'pytorch')
+INFERENCE_BACKENDS = ('pytorch', 'int8', 'onnx', 'stub')
+# Offline mode only resolves weights from the pre-populated TRANSFORMERS_CACHE, never the hub
+MODEL_OFFLINE = os.getenv('MODEL_OFFLINE', os.getenv('HF_HUB_OFFLINE', '0')).lower() in ('1', 'true', 'yes')
+# Weight precision of the pytorch backend: float32, or bfloat16 to halve the resident weights
+MODEL_DTYPE = os.getenv('MODEL_DTYPE', 'float32')
+MODEL_DTYPES = ('float32', 'bfloat16')
+# RAM budget for the loaded models in MB (0 for no budget). Loading a model first unloads
+# the least recently used idle ones until it fits, going over it anyway is logged as model_over_budget
+MODEL_MEMORY_BUDGET_MB = float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0'))
+# Unload a model nobody used for this many seconds (0 keeps models loaded), it reloads on the next request
+MODEL_IDLE_UNLOAD_SECONDS = float(os.getenv('MODEL_IDLE_UNLOAD_SECONDS', '0'))
+# Run inputs of MODEL_WARMUP_LENGTHS tokens through each model right after it loads, so the first
+# requests don't pay for lazy kernel initialization and allocator growth
+MODEL_WARMUP = os.getenv('MODEL_WARMUP', '0').lower() in ('1', 'true', 'yes')
+# Compile the encoders with torch.compile (pytorch backend only).
+# Compiling happens on first use, so it is best combined with MODEL_WARMUP
+MODEL_COMPILE = os.getenv('MODEL_COMPILE', '0').lower() in ('1', 'true', 'yes')
+
+output_lock = threading.Lock()
+
+class StageHistogram:
+    """Latency histogram for one stage: cumulative buckets plus a rolling window for percentiles"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=STATS_WINDOW)
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def snapshot(self):
+        recent = sorted(self.recent)
+
+        def percentile(fraction):
+            return recent[min(len(recent) - 1, int(fraction * len(recent)))] if recent else None
+
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS + ('+Inf',), self.bucket_counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        return {
+            'count': self.count,
+            'sum_seconds': self.total,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': recent[-1] if recent else None,
+            'buckets': buckets
+        }
+
+stats_lock = threading.Lock()
+stage_histograms = defaultdict(StageHistogram)
+token_counts = Counter()  # input/output tokens seen by generate
+overloaded_counts = Counter()  # requests turned away by admission control, by action
+started_at = time.time()
+
+@contextmanager
+def timed_stage(stage, spans=None):
+    """Time a block into the stage histogram and, when given, the request's spans"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        with stats_lock:
+            stage_histograms[stage].observe(elapsed)
+        if spans is not None:
+            spans[stage] = spans.get(stage, 0.0) + elapsed
+
+def log_event(event, **fields):
+    """Write one structured JSON log line to stderr"""
+    print(json.dumps({'event': event, 'time': time.time(), **fields}), file=sys.stderr)
+    sys.stderr.flush()
+
+def onnx_model_path(model_name, cache_dir):
+    """Directory an exported ONNX model is read from"""
+    onnx_dir = os.getenv('ONNX_MODEL_DIR', os.path.join(cache_dir, 'onnx'))
+    return os.path.join(onnx_dir, model_name.replace('/', '--'))
+
+def resolve_cache_dir(cache_dir=None):
+    # Use environment variable for cache directory or default to ./models
+    cache_dir = cache_dir or os.getenv('TRANSFORMERS_CACHE', './models')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def check_backend(backend=None):
+    """The backend to load with, INFERENCE_BACKEND by default, raises ValueError for unknown settings"""
+    backend = backend or INFERENCE_BACKEND
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+    if MODEL_DTYPE not in MODEL_DTYPES:
+        raise ValueError(f"Unknown MODEL_DTYPE '{MODEL_DTYPE}', expected one of {', '.join(MODEL_DTYPES)}")
+    return backend
+
+def pretrained_kwargs(cache_dir):
+    """Common from_pretrained arguments, restricted to the local cache when offline"""
+    return {
+        'cache_dir': cache_dir,
+        'local_files_only': MODEL_OFFLINE
+    }
+
+def dtype_kwargs(backend):
+    """from_pretrained arguments for MODEL_DTYPE, int8 quantization needs float32 weights"""
+    if backend == 'pytorch' and MODEL_DTYPE == 'bfloat16':
+        return {'torch_dtype': torch.bfloat16}
+    return {}
+
+def model_kwargs(cache_dir, backend=None):
+    """from_pretrained arguments for model weights, in MODEL_DTYPE when the backend is given"""
+    # low_cpu_mem_usage maps the safetensors weights in place instead of
+    # initializing a random model first and copying them over
+    return {
+        'low_cpu_mem_usage': True,
+        **(dtype_kwargs(backend) if backend else {}),
+        **pretrained_kwargs(cache_dir)
+    }
+
+def compile_model(loaded_model):
+    """Compile the encoder of a seq2seq model, or the base model of a classifier, with torch.compile.
+
+    generate keeps calling the encoder through model.get_encoder(), so it runs compiled.
+    """
+    if not hasattr(torch, 'compile'):
+        print("MODEL_COMPILE needs torch 2.0 or later, running uncompiled", file=sys.stderr)
+        return loaded_model
+    base = getattr(loaded_model, loaded_model.base_model_prefix)
+    # Dynamic shapes, so every input length doesn't compile a graph of its own
+    if loaded_model.config.is_encoder_decoder:
+        base.encoder = torch.compile(base.encoder, dynamic=True)
+    else:
+        setattr(loaded_model, loaded_model.base_model_prefix, torch.compile(base, dynamic=True))
+    return loaded_model
+
+def warmup_text(sample, words):
+    """Text of the given number of words, repeating the words of sample"""
+    sample = sample.split()
+    return ' '.join(sample[i % len(sample)] for i in range(words))
+
+# A few decoder steps are enough to initialize the beam search kernels
+WARMUP_GENERATE_LENGTH = 16
+
+def warmup_batches(encoded, batch_size):
+    """Each encoded length on its own, then the shortest one as a full batch"""
+    return [[input_ids] for input_ids in encoded] + [encoded[:1] * batch_size]
+
+def run_warmup(name, lengths_setting, max_length, warm):
+    """Warm up a freshly loaded model, warm(lengths) runs inputs of these token lengths through it"""
+    lengths = sorted({min(int(length), max_length) for length in lengths_setting.split(',') if length.strip()})
+    start_time = time.perf_counter()
+    try:
+        with torch.no_grad():
+            warm(lengths)
+    except Exception as e:
+        # A failed warm-up only means the first requests run cold
+        print(f"Error warming up {name} model: {str(e)}", file=sys.stderr)
+        return
+    log_event('model_warmup', model=name, lengths=lengths, compiled=MODEL_COMPILE, seconds=time.perf_counter() - start_time)
+
+class StubTokenizer:
+    """Whitespace tokenizer with the tokenizer methods the workers use, for INFERENCE_BACKEND=stub"""
+
+    pad_token_id = 0
+    src_lang = 'en'
+
+    def __init__(self):
+        self.words = ['<pad>']
+        self.vocab = {'<pad>': 0}
+
+    def __call__(self, text, return_tensors=None, max_length=None, truncation=False, **kwargs):
+        if isinstance(text, list):
+            return {'input_ids': [self(t, max_length=max_length, truncation=truncation)['input_ids'] for t in text]}
+        words = text.split()
+        if truncation and max_length:
+            words = words[:max_length]
+        input_ids = []
+        for word in words:
+            if word not in self.vocab:
+                self.vocab[word] = len(self.words)
+                self.words.append(word)
+            input_ids.append(self.vocab[word])
+        if return_tensors == "pt":
+            return self.pad({'input_ids': [input_ids]}, return_tensors)
+        return {'input_ids': input_ids}
+
+    def pad(self, encoded, return_tensors=None, **kwargs):
+        longest = max(len(input_ids) for input_ids in encoded['input_ids'])
+        input_ids = [ids + [self.pad_token_id] * (longest - len(ids)) for ids in encoded['input_ids']]
+        attention_mask = [[1] * len(ids) + [0] * (longest - len(ids)) for ids in encoded['input_ids']]
+        return {'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask)}
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [
+            ' '.join(self.words[token] for token in tokens if token != self.pad_token_id)
+            for tokens in (sequence.tolist() if hasattr(sequence, 'tolist') else sequence for sequence in sequences)
+        ]
+
+    def decode(self, sequence, skip_special_tokens=True):
+        return self.batch_decode([sequence], skip_special_tokens)[0]
+
+    def get_lang_id(self, lang):
+        return self.pad_token_id
+
+class StubSeq2SeqModel:
+    """Echoes the end of its input instead of generating, for INFERENCE_BACKEND=stub"""
+
+    def eval(self):
+        return self
+
+    def generate(self, input_ids=None, attention_mask=None, max_length=150, streamer=None, stopping_criteria=None, **kwargs):
+        output = input_ids[:, -max_length:]
+        if stopping_criteria is not None:
+            # Like generate, the criteria are checked after every token
+            for length in range(1, output.shape[1] + 1):
+                if any(criteria(output[:, :length], None) for criteria in stopping_criteria):
+                    output = output[:, :length]
+                    break
+        if streamer is not None:
+            # Like generate, the decoder start token comes first and then one token per step
+            streamer.put(torch.tensor([[StubTokenizer.pad_token_id]]))
+            for token in output[0].tolist():
+                streamer.put(torch.tensor([[token]]))
+            streamer.end()
+        return output
+
+def tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        # Dynamically quantized linear layers keep their weight and bias as a packed tuple
+        return sum(tensor_bytes(item) for item in value)
+    return 0
+
+def weight_bytes(loaded_model):
+    """Bytes of a torch model's weights and buffers, None when it isn't a torch module"""
+    state_dict = getattr(loaded_model, 'state_dict', None)
+    if state_dict is None:
+        return None
+    try:
+        return sum(tensor_bytes(value) for value in state_dict().values())
+    except Exception:
+        return None
+
+def release_freed_memory():
+    """Hand freed heap pages back to the OS, glibc keeps them in its arenas otherwise"""
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def current_rss_bytes():
+    """Current resident set size of this process, 0 where /proc is unavailable"""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def peak_rss_bytes():
+    """Peak resident set size of this process"""
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class ModelResidency:
+    """Models loaded on first use that share MODEL_MEMORY_BUDGET_MB and unload when idle.
+
+    load(name, cache_dir, backend) returns (loaded, weights): what requests get
+    from using(), and the torch module whose weights count against the budget
+    (None to measure the RSS growth instead). unload(name) drops any other
+    reference the worker holds, warmup(name, loaded) runs before the model is
+    marked loaded when MODEL_WARMUP is set.
+    """
+
+    def __init__(self, names, load, unload=None, warmup=None):
+        # Per-model load state: not_loaded, loading, loaded or failed
+        self.states = {
+            name: {
+                'state': 'not_loaded', 'load_seconds': None, 'error': None,
+                'resident_bytes': 0, 'in_use': 0, 'last_used': None, 'loads': 0, 'unloads': 0
+            }
+            for name in names
+        }
+        self.loaded = {}
+        self.load_locks = {name: threading.Lock() for name in names}
+        # Guards in_use, last_used and unloading, never held while a model loads
+        self.lock = threading.Lock()
+        self.load = load
+        self.unload = unload
+        self.warmup = warmup
+
+    def load_if_needed(self, name, cache_dir=None, backend=None):
+        """Load one model unless it is loaded, concurrent callers wait for the same load"""
+        state = self.states[name]
+        if state['state'] == 'loaded':
+            return
+        with self.load_locks[name]:
+            # Another request may have finished loading while we waited
+            if state['state'] == 'loaded':
+                return
+
+            cache_dir = resolve_cache_dir(cache_dir)
+            backend = check_backend(backend)
+            print(f"Loading {name} model from {cache_dir}, inference backend: {backend}, offline: {MODEL_OFFLINE}", file=sys.stderr)
+            # Make room using the size of the last load, a first load is checked once it is measured
+            with self.lock:
+                self.unload_to_fit(state['resident_bytes'], name)
+            state['state'] = 'loading'
+            start_time = time.perf_counter()
+            rss_before = current_rss_bytes()
+            try:
+                loaded, weights = self.load(name, cache_dir, backend)
+            except Exception as e:
+                state['state'] = 'failed'
+                state['error'] = str(e)
+                print(f"Error loading {name} model: {str(e)}", file=sys.stderr)
+                raise
+            resident_bytes = weight_bytes(weights)
+            if resident_bytes is None:
+                # ONNX Runtime and stub models don't expose their weights, fall back to the RSS growth
+                resident_bytes = max(0, current_rss_bytes() - rss_before)
+            if MODEL_WARMUP and self.warmup is not None:
+                # Still marked loading, so requests wait for the warm-up instead of running cold
+                self.warmup(name, loaded)
+            with self.lock:
+                self.loaded[name] = loaded
+                state['state'] = 'loaded'
+                state['error'] = None
+                state['load_seconds'] = time.perf_counter() - start_time
+                state['resident_bytes'] = resident_bytes
+                state['last_used'] = time.time()
+                state['loads'] += 1
+                self.unload_to_fit(0, name)
+            print(f"Loaded {name} model in {state['load_seconds']:.2f}s", file=sys.stderr)
+            log_event(
+                'model_load', model=name, backend=backend, dtype=MODEL_DTYPE,
+                load_seconds=state['load_seconds'], resident_bytes=resident_bytes,
+                total_resident_bytes=self.total_resident_bytes()
+            )
+
+    def ensure(self, name, cache_dir=None, backend=None):
+        """Load a model if needed and return what its loader returned"""
+        while True:
+            self.load_if_needed(name, cache_dir, backend)
+            with self.lock:
+                # It may have been unloaded again between loading and getting here
+                if self.states[name]['state'] == 'loaded':
+                    return self.loaded[name]
+
+    @contextmanager
+    def using(self, name):
+        """Load a model if needed and keep it loaded until the block exits"""
+        state = self.states[name]
+        while True:
+            self.load_if_needed(name)
+            with self.lock:
+                if state['state'] == 'loaded':
+                    state['in_use'] += 1
+                    loaded = self.loaded[name]
+                    break
+        try:
+            yield loaded
+        finally:
+            with self.lock:
+                state['in_use'] -= 1
+                state['last_used'] = time.time()
+
+    def total_resident_bytes(self):
+        return sum(state['resident_bytes'] for state in self.states.values() if state['state'] == 'loaded')
+
+    def unload_model(self, name, reason):
+        """Drop a loaded, unused model so its weights can be freed, called with the lock held"""
+        state = self.states[name]
+        self.loaded.pop(name, None)
+        if self.unload is not None:
+            self.unload(name)
+        state['state'] = 'not_loaded'
+        state['unloads'] += 1
+        gc.collect()
+        release_freed_memory()
+        log_event(
+            'model_unload', model=name, reason=reason, resident_bytes=state['resident_bytes'],
+            idle_seconds=time.time() - state['last_used'], total_resident_bytes=self.total_resident_bytes()
+        )
+
+    def unload_to_fit(self, needed_bytes, loading=None):
+        """Unload least recently used idle models until needed_bytes more fit in the budget.
+
+        Models in use are never unloaded, so the budget can be exceeded while they run.
+        Called with the lock held.
+        """
+        if MODEL_MEMORY_BUDGET_MB <= 0:
+            return
+        budget = MODEL_MEMORY_BUDGET_MB * 1024 * 1024
+        idle = sorted(
+            (state['last_used'], name) for name, state in self.states.items()
+            if name != loading and state['state'] == 'loaded' and state['in_use'] == 0
+        )
+        for _, name in idle:
+            if self.total_resident_bytes() + needed_bytes <= budget:
+                return
+            self.unload_model(name, 'budget')
+        if self.total_resident_bytes() + needed_bytes > budget:
+            log_event('model_over_budget', budget_bytes=int(budget), total_resident_bytes=self.total_resident_bytes() + needed_bytes)
+
+    def unload_idle(self):
+        """Unload models unused for MODEL_IDLE_UNLOAD_SECONDS, checking a few times per timeout"""
+        while True:
+            time.sleep(max(1.0, min(60.0, MODEL_IDLE_UNLOAD_SECONDS / 4)))
+            now = time.time()
+            with self.lock:
+                for name, state in self.states.items():
+                    if (state['state'] == 'loaded' and state['in_use'] == 0
+                            and now - state['last_used'] >= MODEL_IDLE_UNLOAD_SECONDS):
+                        self.unload_model(name, 'idle')
+
+    def start_idle_unloader(self):
+        if MODEL_IDLE_UNLOAD_SECONDS > 0:
+            threading.Thread(target=self.unload_idle, name="model-unloader", daemon=True).start()
+
+    def snapshot(self):
+        """Residency counters of every model, for stats"""
+        with self.lock:
+            return {
+                name: {key: state[key] for key in ('state', 'resident_bytes', 'in_use', 'last_used', 'loads', 'unloads')}
+                for name, state in self.states.items()
+            }
+
+class TwoTierCache:
+    """Two-tier cache of generated outputs: an in-process LRU backed by a SQLite table.
+
+    Entries are tuples of the table's value columns plus the time they were
+    written. Keys are built by the subclass from everything the output depends
+    on, so changing any of it never serves a stale entry. The table keeps at
+    most max_disk_entries rows (0 for no limit), the oldest written go first.
+    """
+
+    # Writes between two trims of the SQLite table
+    DISK_TRIM_INTERVAL = 100
+
+    def __init__(self, label, table, columns, path=None, max_entries=1000, max_disk_entries=0):
+        self.label = label
+        self.table = table
+        self.columns = columns
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'writes': 0, 'disk_evictions': 0}
+        self.db = None
+        self.path = path
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, "
+                    + ''.join(f"{column} TEXT NOT NULL, " for column in columns)
+                    + "created_at REAL NOT NULL)"
+                )
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+                self._trim_disk()
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"{label} disk tier disabled: {str(e)}", file=sys.stderr)
+                self.db = None
+
+    @staticmethod
+    def hash_key(parts):
+        """Key of an entry depending on the JSON-serializable parts"""
+        key_data = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """Return (*values, created_at, tier) or None"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return (*self.entries[key], 'memory')
+            if self.db is not None:
+                try:
+                    row = self.db.execute(
+                        f"SELECT {', '.join(self.columns)}, created_at FROM {self.table} WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    # Pool workers share the file, a locked database is just a miss
+                    print(f"{self.label} read failed: {str(e)}", file=sys.stderr)
+                    row = None
+                if row is not None:
+                    self.stats['disk_hits'] += 1
+                    self._remember(key, tuple(row))
+                    return (*row, 'disk')
+            self.stats['misses'] += 1
+            return None
+
+    def contains(self, key):
+        """Whether an entry is cached, without counting a lookup or refreshing its place"""
+        with self.lock:
+            if key in self.entries:
+                return True
+            if self.db is None:
+                return False
+            try:
+                return self.db.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone() is not None
+            except sqlite3.Error:
+                return False
+
+    def store(self, key, *values):
+        entry = (*values, time.time())
+        with self.lock:
+            self._remember(key, entry)
+            self.stats['writes'] += 1
+            if self.db is not None:
+                try:
+                    self.db.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self.columns)}, created_at) "
+                        f"VALUES ({', '.join('?' * (len(entry) + 1))})",
+                        (key, *entry)
+                    )
+                    if self.stats['writes'] % self.DISK_TRIM_INTERVAL == 0:
+                        self._trim_disk()
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print(f"{self.label} write failed: {str(e)}", file=sys.stderr)
+
+    def _trim_disk(self):
+        """Delete the rows older than the newest max_disk_entries, caller commits"""
+        if not self.max_disk_entries:
+            return
+        cursor = self.db.execute(
+            f"DELETE FROM {self.table} WHERE created_at < (SELECT created_at FROM {self.table} "
+            "ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_disk_entries - 1,)
+        )
+        self.stats['disk_evictions'] += max(cursor.rowcount, 0)
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+            hits = self.stats['memory_hits'] + self.stats['disk_hits']
+            return {
+                **self.stats,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.entries),
+                'disk_enabled': self.db is not None
+            }
+
+class RequestControl:
+    """Deadline and cancellation flag of one request, checked while it waits and while it generates"""
+
+    def __init__(self, request_id, deadline=None, idle_timeout=None):
+        self.request_id = request_id
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout  # seconds a streamed request may go without a partial result
+        self.cancelled = threading.Event()
+
+    def touch(self):
+        """A partial result was sent, so the caller's idle timer restarts and so does the deadline"""
+        if self.idle_timeout is not None:
+            self.deadline = time.time() + self.idle_timeout
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def should_stop(self):
+        return self.cancelled.is_set() or self.expired()
+
+    def stopped_response(self):
+        reason = 'cancelled' if self.cancelled.is_set() else 'deadline_exceeded'
+        return {"error": f"Request stopped: {reason.replace('_', ' ')}", "stopped": reason}
+
+class RequestStoppingCriteria(StoppingCriteria):
+    """Stops generate once every request in the batch is cancelled or past its deadline"""
+
+    def __init__(self, controls):
+        self.controls = controls
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return all(control.should_stop() for control in self.controls)
+
+request_controls = {}  # request ID -> RequestControl, from arrival until the response is sent
+request_controls_lock = threading.Lock()
+current_control = None  # request a pool worker is running, for the cancel signal
+
+def request_deadline(input_data, now=None):
+    """Absolute deadline in epoch seconds from "deadline" (epoch seconds or ms) or "timeout_ms" """
+    deadline = input_data.get('deadline')
+    if isinstance(deadline, (int, float)):
+        # JavaScript timestamps are in milliseconds
+        return deadline / 1000.0 if deadline > 1e11 else float(deadline)
+    timeout_ms = input_data.get('timeout_ms')
+    if isinstance(timeout_ms, (int, float)):
+        return (now or time.time()) + timeout_ms / 1000.0
+    return None
+
+def register_request(input_data):
+    """Track a request so it can be cancelled or expire, returns its control"""
+    request_id = input_data.get('id')
+    if request_id is None:
+        return None
+    idle_timeout_ms = input_data.get('idle_timeout_ms')
+    idle_timeout = idle_timeout_ms / 1000.0 if isinstance(idle_timeout_ms, (int, float)) else None
+    control = RequestControl(request_id, input_data.get('deadline'), idle_timeout)
+    with request_controls_lock:
+        if request_id in request_controls:
+            raise ValueError(f"Request id {request_id!r} is already in flight")
+        request_controls[request_id] = control
+    return control
+
+def get_request_control(request_id):
+    with request_controls_lock:
+        return request_controls.get(request_id)
+
+def finish_request(request_id):
+    with request_controls_lock:
+        request_controls.pop(request_id, None)
+
+def cancel_request(request_id):
+    """Flag a queued or running request as cancelled, returns whether it was found"""
+    control = get_request_control(request_id)
+    if control is None:
+        return False
+    control.cancelled.set()
+    return True
+
+def cancel_current_request(signum, frame):
+    """SIGUSR1 handler in pool workers: the parent cancels whatever this worker is running"""
+    if current_control is not None:
+        current_control.cancelled.set()
+
+def stopping_criteria(controls):
+    """Criteria for a generate over these requests, None when one of them has no control and can't stop"""
+    controls = list(controls or ())
+    if not controls or any(control is None for control in controls):
+        return None
+    return StoppingCriteriaList([RequestStoppingCriteria(controls)])
+
+def stream_generate(generation_model, decoder, inputs, generation_kwargs, on_delta):
+    """Run generate on a helper thread, passing decoded text to on_delta as it is produced.
+
+    Returns the full generated text once generation has finished.
+    """
+    streamer = TextIteratorStreamer(decoder, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def run():
+        try:
+            with torch.no_grad():
+                generation_model.generate(**inputs, streamer=streamer, **generation_kwargs)
+        except Exception as e:
+            errors.append(e)
+            # Wake up the reader below
+            streamer.end()
+
+    thread = threading.Thread(target=run, name="stream-generate", daemon=True)
+    thread.start()
+    text = []
+    for delta in streamer:
+        if delta:
+            text.append(delta)
+            on_delta(delta)
+    thread.join()
+    if errors:
+        raise errors[0]
+    return ''.join(text)
+
+class ResponseStream:
+    """Sends a request's partial results as numbered lines: id, seq, delta, done"""
+
+    def __init__(self, request_id, control=None):
+        self.request_id = request_id
+        self.control = control
+        self.seq = 0
+
+    def send_delta(self, delta):
+        send_response({'seq': self.seq, 'delta': delta, 'done': False}, self.request_id)
+        self.seq += 1
+        if self.control is not None:
+            self.control.touch()
+
+    def finish(self, result):
+        """Send the final line, which carries the complete result"""
+        send_response({'seq': self.seq, 'done': True, **result}, self.request_id)
+
+def wants_stream(input_data):
+    # Partial lines are matched to their request by ID, so streaming needs one
+    return bool(input_data.get('stream')) and input_data.get('id') is not None
+
+def is_partial_message(frame):
+    """True for a streamed partial result, which is not the end of its request"""
+    # Partial results end with their "done": false entry (see ResponseStream.send_delta),
+    # so the raw bytes tell without decoding the frame
+    if FRAMING == 'msgpack':
+        return frame.endswith(b'\xa4done\xc2')
+    return frame.rstrip().endswith(b'"done": false}')
+
+def parse_action_priorities(spec):
+    """Parse an "action=priority,..." spec into a dict of per-action priorities"""
+    priorities = {}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        action, priority = part.split('=', 1)
+        try:
+            priorities[action.strip()] = int(priority)
+        except ValueError:
+            print(f"Ignoring invalid action priority: {part}", file=sys.stderr)
+    return priorities
+
+class RequestQueue:
+    """Bounded queue of admitted requests, ordered by action priority, then by arrival.
+
+    Entries are tuples starting with the request dict. When the queue is full, a
+    new request takes the place of the newest queued request with a higher
+    priority value, or is turned away itself if there is none.
+    """
+
+    def __init__(self, capacity, priorities):
+        self.capacity = capacity
+        self.priorities = priorities
+        self.entries = []  # heap of (priority, arrival, action, entry)
+        self.arrivals = itertools.count()
+        self.closed = False
+        self.changed = threading.Condition()
+
+    def __len__(self):
+        with self.changed:
+            return len(self.entries)
+
+    def put(self, entry, action):
+        """Queue an entry, returns the entry turned away to make room or None"""
+        item = (self.priorities.get(action, DEFAULT_ACTION_PRIORITY), next(self.arrivals), action, entry)
+        with self.changed:
+            rejected = None
+            if self.capacity and len(self.entries) >= self.capacity:
+                lowest = max(self.entries)
+                if lowest[0] <= item[0]:
+                    return entry
+                self.entries.remove(lowest)
+                heapq.heapify(self.entries)
+                rejected = lowest[3]
+            heapq.heappush(self.entries, item)
+            self.changed.notify_all()
+            return rejected
+
+    def get(self, can_start=None):
+        """Take the first entry can_start accepts, waiting until there is one. None once closed and empty"""
+        with self.changed:
+            while True:
+                for item in sorted(self.entries):
+                    if can_start is None or can_start(item[3]):
+                        self.entries.remove(item)
+                        heapq.heapify(self.entries)
+                        return item[3]
+                if self.closed and not self.entries:
+                    return None
+                self.changed.wait()
+
+    def queued(self, request_id):
+        """Whether a request with this ID is waiting in the queue"""
+        with self.changed:
+            return request_id is not None and any(item[3][0].get('id') == request_id for item in self.entries)
+
+    def remove(self, request_id):
+        """Take a queued request out by ID, returns its entry or None"""
+        with self.changed:
+            for item in self.entries:
+                if request_id is not None and item[3][0].get('id') == request_id:
+                    self.entries.remove(item)
+                    heapq.heapify(self.entries)
+                    return item[3]
+        return None
+
+    def depth(self):
+        """Number of queued requests by action"""
+        with self.changed:
+            return dict(Counter(item[2] for item in self.entries))
+
+    def notify(self):
+        """Wake up get() when something its can_start depends on has changed"""
+        with self.changed:
+            self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+def encode_message(message):
+    """Serialize one protocol message with the configured framing"""
+    if FRAMING == 'msgpack':
+        payload = msgpack.packb(message, use_bin_type=True)
+        return FRAME_HEADER.pack(len(payload)) + payload
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+def decode_message(frame):
+    """Parse one framed message as returned by read_frames"""
+    if FRAMING == 'msgpack':
+        return msgpack.unpackb(frame[FRAME_HEADER.size:], raw=False)
+    return json.loads(frame)
+
+def read_frames(stream):
+    """Yield complete framed messages from a binary stream until EOF"""
+    if FRAMING == 'msgpack':
+        while True:
+            header = stream.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            (length,) = FRAME_HEADER.unpack(header)
+            payload = stream.read(length)
+            if len(payload) < length:
+                return
+            yield header + payload
+    else:
+        for line in stream:
+            if line.strip():
+                yield line
+
+def send_response(result, request_id=None):
+    """Write one response message, echoing the request ID when there is one"""
+    if request_id is not None:
+        result = {'id': request_id, **result}
+    data = encode_message(result)
+    with output_lock:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+def parse_frame(frame):
+    """Parse one framed request, timing it as the parse stage. Invalid requests are answered here"""
+    spans = {}
+    try:
+        with timed_stage('parse', spans):
+            input_data = decode_message(frame)
+        if not isinstance(input_data, dict):
+            raise ValueError("Request must be a JSON object")
+    except ValueError as e:
+        send_response({"error": f"Invalid {'JSON' if FRAMING == 'jsonl' else FRAMING} input: {str(e) or type(e).__name__}"})
+        return None, spans
+    request_id = input_data.get('id')
+    if request_id is not None and (isinstance(request_id, bool) or not isinstance(request_id, (str, int))):
+        # IDs key the request controls and are matched by the callers, so they must be plain values
+        send_response({"error": "Request id must be a string or an integer"}, request_id)
+        return None, spans
+    return input_data, spans
+
+def write_metrics_periodically(path, render):
+    """Rewrite the Prometheus metrics file with render() every METRICS_INTERVAL seconds"""
+    while True:
+        try:
+            # Write then rename so a scraper never reads a half-written file
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as metrics_file:
+                metrics_file.write(render())
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Failed to write metrics file {path}: {str(e)}", file=sys.stderr)
+        time.sleep(METRICS_INTERVAL)
+
+def start_metrics_writer(path, render):
+    if path:
+        threading.Thread(target=write_metrics_periodically, args=(path, render), name="metrics-writer", daemon=True).start()
+
+def collect_worker_stats(queue_depth, caches, residency):
+    """Snapshot of the stage latencies, token counts, queue depth, caches and memory"""
+    with stats_lock:
+        stages = {stage: histogram.snapshot() for stage, histogram in stage_histograms.items()}
+        tokens = dict(token_counts)
+        overloaded = dict(overloaded_counts)
+    models = residency.snapshot()
+    return {
+        'pid': os.getpid(),
+        'uptime_seconds': time.time() - started_at,
+        'stages': stages,
+        'tokens': tokens,
+        'queue_depth': queue_depth,
+        'max_queued': MAX_QUEUED_REQUESTS,
+        'overloaded': overloaded,
+        'caches': caches,
+        'models': models,
+        'model_resident_bytes': sum(model['resident_bytes'] for model in models.values() if model['state'] == 'loaded'),
+        'model_memory_budget_bytes': int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+        'rss_bytes': current_rss_bytes(),
+        'peak_rss_bytes': peak_rss_bytes()
+    }
+
+def render_prometheus(stats):
+    """Render a stats snapshot in the Prometheus text exposition format"""
+    lines = [
+        '# TYPE worker_stage_seconds histogram'
+    ]
+    for stage, snapshot in sorted(stats['stages'].items()):
+        for bound, count in snapshot['buckets'].items():
+            lines.append(f'worker_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'worker_stage_seconds_sum{{stage="{stage}"}} {snapshot["sum_seconds"]}')
+        lines.append(f'worker_stage_seconds_count{{stage="{stage}"}} {snapshot["count"]}')
+    lines.append('# TYPE worker_tokens_total counter')
+    for kind, count in sorted(stats['tokens'].items()):
+        lines.append(f'worker_tokens_total{{kind="{kind}"}} {count}')
+    if 'pending_input_bytes' in stats:
+        lines.append('# TYPE worker_pending_input_bytes gauge')
+        lines.append(f'worker_pending_input_bytes {stats["pending_input_bytes"]}')
+    lines.append('# TYPE worker_queue_depth gauge')
+    for action, count in sorted(stats['queue_depth'].items()):
+        lines.append(f'worker_queue_depth{{action="{action}"}} {count}')
+    lines.append('# TYPE worker_overloaded_total counter')
+    for action, count in sorted(stats['overloaded'].items()):
+        lines.append(f'worker_overloaded_total{{action="{action}"}} {count}')
+    lines.append('# TYPE worker_cache_stat gauge')
+    for cache, values in sorted(stats['caches'].items()):
+        for name, value in sorted(values.items()):
+            if isinstance(value, (int, float)):
+                lines.append(f'worker_cache_stat{{cache="{cache}",stat="{name}"}} {value}')
+    lines.append('# TYPE worker_model_resident_bytes gauge')
+    for name, model_stats in sorted(stats['models'].items()):
+        resident_bytes = model_stats['resident_bytes'] if model_stats['state'] == 'loaded' else 0
+        lines.append(f'worker_model_resident_bytes{{model="{name}"}} {resident_bytes}')
+    lines.append('# TYPE worker_model_loads_total counter')
+    for name, model_stats in sorted(stats['models'].items()):
+        lines.append(f'worker_model_loads_total{{model="{name}"}} {model_stats["loads"]}')
+    lines.append('# TYPE worker_model_unloads_total counter')
+    for name, model_stats in sorted(stats['models'].items()):
+        lines.append(f'worker_model_unloads_total{{model="{name}"}} {model_stats["unloads"]}')
+    lines.append('# TYPE worker_rss_bytes gauge')
+    lines.append(f'worker_rss_bytes {stats["rss_bytes"]}')
+    lines.append('# TYPE worker_peak_rss_bytes gauge')
+    lines.append(f'worker_peak_rss_bytes {stats["peak_rss_bytes"]}')
+    return '\n'.join(lines) + '\n'
+
+def reject_overloaded(input_data, work_queue, default_action):
+    """Answer a request turned away by admission control"""
+    request_id = input_data.get('id')
+    action = input_data.get('action', default_action)
+    finish_request(request_id)
+    with stats_lock:
+        overloaded_counts[action] += 1
+    send_response({
+        "error": "Worker overloaded, try again later",
+        "overloaded": True,
+        "queue_depth": len(work_queue)
+    }, request_id)
+    log_event('overloaded', id=request_id, action=action)
+
+def drop_queued(work_queue, request_id):
+    """Answer a request still waiting in the work queue as cancelled, returns whether it was there"""
+    entry = work_queue.remove(request_id)
+    if entry is None:
+        return False
+    control = get_request_control(request_id) or RequestControl(request_id)
+    control.cancelled.set()
+    finish_request(request_id)
+    send_response(control.stopped_response(), request_id)
+    return True
+
+def send_heartbeats(work_queue):
+    """Report the work queue depth on stdout every HEARTBEAT_INTERVAL seconds"""
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        queued = work_queue.depth()
+        send_response({
+            "status": "heartbeat",
+            "queue_depth": sum(queued.values()),
+            "queued": queued,
+            "max_queued": MAX_QUEUED_REQUESTS
+        })
+
+def start_heartbeat(work_queue):
+    if HEARTBEAT_INTERVAL > 0:
+        threading.Thread(target=send_heartbeats, args=(work_queue,), name="heartbeat", daemon=True).start()
+
+def read_requests(work_queue, default_action, cancel=cancel_request, in_flight=None):
+    """Read requests from stdin into the work queue until EOF.
+
+    Entries are (request, spans, arrival perf_counter). Cancel requests are
+    answered right here, so they overtake the queue and reach requests that
+    are still generating, and requests that don't fit in the queue are
+    rejected here as overloaded. Requests without an action count as
+    default_action. Requests are registered here unless in_flight is given,
+    then in_flight(request_id) tells whether a request with the ID is
+    still running. Either way a request reusing such an ID is answered with
+    an error.
+    """
+    try:
+        for frame in read_frames(sys.stdin.buffer):
+            received = time.perf_counter()
+            input_data, spans = parse_frame(frame)
+            if input_data is None:
+                continue
+            try:
+                if input_data.get('action') == 'cancel':
+                    target_id = input_data.get('target_id')
+                    cancelled = drop_queued(work_queue, target_id) or cancel(target_id)
+                    send_response({'cancelled': cancelled, 'target_id': target_id}, input_data.get('id'))
+                    continue
+                # Relative timeouts count from arrival here, not from when a worker picks the request up
+                input_data['deadline'] = request_deadline(input_data)
+                if in_flight is None:
+                    register_request(input_data)
+                elif in_flight(input_data.get('id')):
+                    raise ValueError(f"Request id {input_data['id']!r} is already in flight")
+                rejected = work_queue.put((input_data, spans, received), input_data.get('action', default_action))
+                if rejected is not None:
+                    reject_overloaded(rejected[0], work_queue, default_action)
+            except Exception as e:
+                # One bad request must not stop the reader, and with it the worker
+                send_response({"error": f"Error processing request: {str(e)}"}, input_data.get('id'))
+    finally:
+        # Tell the dispatcher no more requests are coming
+        work_queue.close()
+
+def serve_pool_requests(handle, render_metrics):
+    """Pool worker loop: handle(request, spans, arrival perf_counter) each request the parent sends, one at a time"""
+    global current_control
+    # Each worker keeps its own stats, so each gets its own metrics file
+    start_metrics_writer(METRICS_FILE and f"{METRICS_FILE}.{os.getpid()}", render_metrics)
+    for frame in read_frames(sys.stdin.buffer):
+        received = time.perf_counter()
+        input_data, spans = parse_frame(frame)
+        if input_data is None:
+            continue
+        try:
+            current_control = register_request(input_data)
+        except ValueError as e:
+            # The parent turns duplicates away, every request still needs its one response
+            send_response({"error": f"Error processing request: {str(e)}"}, input_data.get('id'))
+            continue
+        handle(input_data, spans, received)
+        current_control = None
+
+def merge_pool_stats(worker_stats, queue_depth):
+    """Pool-wide stats from each worker's stats response.
+
+    Counters and histogram buckets are summed, percentiles are the slowest
+    worker's and the queue depth is the parent's, where requests wait. Each
+    worker's own snapshot is kept under 'workers'.
+    """
+    stages = {}
+    tokens = Counter()
+    with stats_lock:
+        overloaded = Counter(overloaded_counts)
+    for stats in worker_stats:
+        tokens.update(stats.get('tokens', {}))
+        overloaded.update(stats.get('overloaded', {}))
+        for stage, snapshot in stats.get('stages', {}).items():
+            merged = stages.setdefault(stage, {
+                'count': 0, 'sum_seconds': 0.0, 'p50': None, 'p95': None, 'p99': None, 'max': None,
+                'buckets': dict.fromkeys(snapshot['buckets'], 0)
+            })
+            merged['count'] += snapshot['count']
+            merged['sum_seconds'] += snapshot['sum_seconds']
+            for key in ('p50', 'p95', 'p99', 'max'):
+                if snapshot[key] is not None:
+                    merged[key] = max(merged[key] or 0.0, snapshot[key])
+            for bound, count in snapshot['buckets'].items():
+                merged['buckets'][bound] += count
+    return {
+        'pid': os.getpid(),
+        'uptime_seconds': time.time() - started_at,
+        'pool_size': len(worker_stats),
+        'stages': stages,
+        'tokens': dict(tokens),
+        'queue_depth': queue_depth,
+        'max_queued': MAX_QUEUED_REQUESTS,
+        'overloaded': dict(overloaded),
+        'workers': worker_stats
+    }
+
+def serve_with_pool(serve, action_priorities, default_action, on_ready, affinity=None):
+    """Serve requests from stdin with a pool of forked worker processes, each running serve().
+
+    affinity(request) returns the key of requests that must always reach the same worker, or None.
+    Stats requests go to every worker and are answered with their merged stats.
+    """
+    affinity = affinity or (lambda input_data: None)
+    threads = WORKER_THREADS or max(1, (os.cpu_count() or 1) // WORKER_POOL_SIZE)
+    # Requests wait in the parent's work queue until a worker is free, so priorities
+    # decide which one goes next
+    work_queue = RequestQueue(MAX_QUEUED_REQUESTS, parse_action_priorities(action_priorities))
+    pool = WorkerPool(WORKER_POOL_SIZE, threads, serve, on_idle=work_queue.notify)
+    pool.start()
+    on_ready()
+    start_heartbeat(work_queue)
+
+    # Workers track their own requests, the parent only finds which worker to signal
+    def in_flight(request_id):
+        return work_queue.queued(request_id) or pool.has_request(request_id)
+
+    reader = threading.Thread(target=read_requests, args=(work_queue, default_action, pool.cancel, in_flight), daemon=True)
+    reader.start()
+
+    def send_pool_stats(request_id, responses):
+        worker_stats = [
+            {key: value for key, value in response.items() if key != 'id'}
+            for response in responses if 'error' not in response
+        ]
+        send_response(merge_pool_stats(worker_stats, work_queue.depth()), request_id)
+
+    while True:
+        entry = work_queue.get(lambda entry: entry[0].get('action') == 'stats' or pool.has_idle_worker(affinity(entry[0])))
+        if entry is None:
+            break
+        input_data = entry[0]
+        if input_data.get('action') == 'stats':
+            pool.broadcast(encode_message(input_data), partial(send_pool_stats, input_data.get('id')))
+        else:
+            pool.submit(encode_message(input_data), input_data.get('id'), affinity(input_data))
+    pool.close()
+
+class WorkerPool:
+    """Pre-forked worker processes that share the parent's model weights copy-on-write.
+
+    The parent loads the model weights, then forks the workers. Each worker reads
+    requests from its own pipe, handles one at a time and writes one response
+    line per request. The parent sends every request to an idle worker (or
+    queues it until one frees up) and forwards responses to stdout as they
+    arrive. Requests with an affinity key always go to the same worker, so
+    state kept per key (like a survey's trending state) stays in one process.
+
+    Queued requests are (frame, request ID, on_response). Responses to requests
+    with an on_response callback are decoded and handed to it instead of stdout.
+    """
+
+    def __init__(self, size, threads_per_worker, serve, on_idle=None):
+        self.size = size
+        self.threads_per_worker = threads_per_worker
+        self.serve = serve
+        self.on_idle = on_idle  # called whenever a worker finishes a request
+        self.workers = []
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.readers = []
+
+    def start(self):
+        # Keep the loaded objects out of the garbage collector's reach, otherwise
+        # collections in the workers touch their pages and copy them
+        gc.freeze()
+        # Inherited by the workers, so a cancel that reaches one before it starts serving
+        # doesn't hit SIGUSR1's default action and kill it
+        signal.signal(signal.SIGUSR1, cancel_current_request)
+        for index in range(self.size):
+            self.workers.append(self.spawn(index))
+        for worker in self.workers:
+            reader = threading.Thread(target=self.read_responses, args=(worker,), name=f"pool-reader-{worker['index']}", daemon=True)
+            reader.start()
+            self.readers.append(reader)
+        print(f"Worker pool started: {self.size} workers, {self.threads_per_worker} torch threads each", file=sys.stderr)
+
+    def spawn(self, index):
+        request_read, request_write = os.pipe()
+        response_read, response_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # The request pipe becomes stdin and the response pipe stdout. Pipes of
+                # workers forked earlier are closed so they still see EOF on shutdown
+                for worker in self.workers:
+                    worker['stdin'].close()
+                    worker['stdout'].close()
+                os.close(request_write)
+                os.close(response_read)
+                os.dup2(request_read, 0)
+                os.dup2(response_write, 1)
+                os.close(request_read)
+                os.close(response_write)
+                sys.stdin = os.fdopen(0, 'r')
+                sys.stdout = os.fdopen(1, 'w')
+                torch.set_num_threads(self.threads_per_worker)
+                self.serve()
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+
+        os.close(request_read)
+        os.close(response_write)
+        return {
+            'index': index,
+            'pid': pid,
+            'stdin': os.fdopen(request_write, 'wb'),
+            'stdout': os.fdopen(response_read, 'rb'),
+            'request': None,
+            'pending': deque(),  # requests pinned to this worker by affinity
+            'alive': True
+        }
+
+    def submit(self, frame, request_id=None, affinity=None):
+        """Queue one framed request, request_id is only used to report a lost request"""
+        with self.lock:
+            if affinity is not None:
+                worker = self.workers[zlib.crc32(affinity.encode('utf-8')) % self.size]
+                if worker['request'] is not None or not worker['alive']:
+                    worker['pending'].append((frame, request_id, None))
+                    if not worker['alive']:
+                        self.fail_pinned(worker)
+                    return
+            else:
+                worker = next((w for w in self.workers if w['alive'] and w['request'] is None), None)
+            if worker is None:
+                self.pending.append((frame, request_id, None))
+            else:
+                self.send(worker, (frame, request_id, None))
+
+    def broadcast(self, frame, on_responses):
+        """Send a request to every live worker after what it already has queued.
+
+        on_responses gets the decoded responses in worker order once all of them arrived.
+        """
+        with self.lock:
+            alive = [worker for worker in self.workers if worker['alive']]
+            responses = [None] * len(alive)
+            remaining = [len(alive)]
+            collect_lock = threading.Lock()
+
+            def collect(position, response):
+                with collect_lock:
+                    responses[position] = response
+                    remaining[0] -= 1
+                    finished = remaining[0] == 0
+                if finished:
+                    on_responses(responses)
+
+            for position, worker in enumerate(alive):
+                request = (frame, None, lambda response, position=position: collect(position, response))
+                if worker['request'] is None:
+                    self.send(worker, request)
+                else:
+                    worker['pending'].append(request)
+        if not alive:
+            on_responses([])
+
+    def has_idle_worker(self, affinity=None):
+        """Whether a request submitted now would start right away instead of waiting in the pool"""
+        with self.lock:
+            if affinity is not None:
+                worker = self.workers[zlib.crc32(affinity.encode('utf-8')) % self.size]
+                # Requests pinned to a dead worker are failed on submit, they don't wait either
+                return not worker['alive'] or worker['request'] is None
+            alive = [w for w in self.workers if w['alive']]
+            return not alive or any(w['request'] is None for w in alive)
+
+    def has_request(self, request_id):
+        """Whether a request with this ID is waiting for or running on a worker"""
+        if request_id is None:
+            return False
+        with self.lock:
+            requests = list(self.pending)
+            for worker in self.workers:
+                requests.extend(worker['pending'])
+                if worker['request'] is not None:
+                    requests.append(worker['request'])
+            return any(request[1] == request_id for request in requests)
+
+    def cancel(self, request_id):
+        """Drop a queued request or signal the worker running it, returns whether it was found"""
+        if request_id is None:
+            return False
+        with self.lock:
+            for pending in [self.pending] + [worker['pending'] for worker in self.workers]:
+                for request in pending:
+                    if request[1] == request_id:
+                        pending.remove(request)
+                        control = RequestControl(request_id)
+                        control.cancelled.set()
+                        send_response(control.stopped_response(), request_id)
+                        return True
+            for worker in self.workers:
+                if worker['alive'] and worker['request'] is not None and worker['request'][1] == request_id:
+                    # A worker only runs one request, so the signal always hits the right one
+                    os.kill(worker['pid'], signal.SIGUSR1)
+                    return True
+        return False
+
+    def fail_pinned(self, worker):
+        lost = list(worker['pending'])
+        worker['pending'].clear()
+        for request in lost:
+            self.fail(request)
+
+    @staticmethod
+    def fail(request):
+        response = {"error": "Worker process exited while processing request"}
+        if request[2] is not None:
+            request[2](response)
+        else:
+            send_response(response, request[1])
+
+    def send(self, worker, request):
+        worker['request'] = request
+        worker['stdin'].write(request[0])
+        worker['stdin'].flush()
+
+    def read_responses(self, worker):
+        # Responses are passed through as they are, only those the parent asked for itself are decoded
+        for frame in read_frames(worker['stdout']):
+            # Only this thread clears the worker's request, so it can't change under us
+            on_response = worker['request'][2] if worker['request'] is not None else None
+            if on_response is None:
+                with output_lock:
+                    sys.stdout.buffer.write(frame)
+                    sys.stdout.buffer.flush()
+            if is_partial_message(frame):
+                # Streamed requests keep the worker busy until their final line
+                continue
+            if on_response is not None:
+                on_response(decode_message(frame))
+            with self.lock:
+                worker['request'] = None
+                if worker['pending']:
+                    self.send(worker, worker['pending'].popleft())
+                elif self.pending:
+                    self.send(worker, self.pending.popleft())
+                self.idle.notify_all()
+            if self.on_idle is not None:
+                self.on_idle()
+
+        # The worker exited, fail whatever it was working on
+        with self.lock:
+            worker['alive'] = False
+            lost = [worker['request']] if worker['request'] is not None else []
+            lost.extend(worker['pending'])
+            worker['pending'].clear()
+            worker['request'] = None
+            if not any(w['alive'] for w in self.workers):
+                lost.extend(self.pending)
+                self.pending.clear()
+            self.idle.notify_all()
+        if lost:
+            print(f"Pool worker {worker['index']} (pid {worker['pid']}) exited unexpectedly", file=sys.stderr)
+        for request in lost:
+            self.fail(request)
+
+    def close(self):
+        """Wait for queued and in-flight requests, then stop the workers"""
+        with self.lock:
+            while self.pending or any(w['alive'] and (w['request'] is not None or w['pending']) for w in self.workers):
+                self.idle.wait()
+            for worker in self.workers:
+                if worker['alive']:
+                    worker['stdin'].close()
+        for reader in self.readers:
+            reader.join()
+        for worker in self.workers:
+            os.waitpid(worker['pid'], 0)
+
+def backend_argument_parser(description):
+    """Command line of a worker script: serving by default, or profiling inference backends"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--profile-backend', choices=INFERENCE_BACKENDS,
+                        help="Profile one inference backend and print the results as JSON")
+    parser.add_argument('--compare-backends', choices=INFERENCE_BACKENDS, metavar='BACKEND',
+                        help="Compare a backend against PyTorch fp32 and print a JSON report")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed repetitions per sample input")
+    return parser
+
+def timed_repeats(run, repeats, latencies):
+    """Call run() repeats times, adding each latency to latencies, and return its last result"""
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = run()
+        latencies.append(time.perf_counter() - start_time)
+    return result
+
+def profile_backends(script, backend, repeats):
+    """Profile PyTorch fp32 and a backend, each with --profile-backend in a fresh process"""
+    profiles = {}
+    for name in ('pytorch', backend):
+        completed = subprocess.run(
+            [sys.executable, script, '--profile-backend', name, '--repeats', str(repeats)],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        profiles[name] = json.loads(completed.stdout.strip().splitlines()[-1])
+    return profiles['pytorch'], profiles[backend]
+
+def agreement(baseline, candidate):
+    """Fraction of outputs that are exactly the same"""
+    return sum(a == b for a, b in zip(baseline, candidate)) / len(baseline)
+
+def similarity(baseline, candidate):
+    """Mean sequence ratio of the outputs"""
+    return statistics.mean(SequenceMatcher(None, a, b).ratio() for a, b in zip(baseline, candidate))
+
+def check_framing():
+    """Exit early when the configured framing can't be used, there is no way to report it otherwise"""
+    if FRAMING not in ('jsonl', 'msgpack'):
+        print(f"Unknown FRAMING {FRAMING}, expected jsonl or msgpack", file=sys.stderr)
+        sys.exit(1)
+    if FRAMING == 'msgpack' and msgpack is None:
+        print("FRAMING=msgpack needs the msgpack package (pip install msgpack)", file=sys.stderr)
+        sys.exit(1)